@@ -0,0 +1,60 @@
+"""
+CONNECT packet build throughput: uncached Thrift serialization + zlib level 9
+against cached FBNSConnectTemplate.
+
+    python benchmarks/bench_connect_package.py [--seconds 2] [--level 9]
+"""
+import argparse
+import time
+import zlib
+
+from fbns_mqtt.fbns_mqtt import FBNSAuth, FBNSConnectPackageFactor, FBNSMQTTProtocol, serialize_connect, _session_id
+
+AUTH_DATA = {
+    'ck': '100000000000001',
+    'cs': 'AbCdEfGhIjKlMnOpQrStUvWxYz012345',
+    'di': '0d1e2f3a-4b5c-6d7e-8f90-a1b2c3d4e5f6',
+    'ds': 'ZyXwVuTsRqPoNmLkJiHgFeDcBa987654',
+}
+
+
+def uncached(fbns_auth, level):
+    return zlib.compress(serialize_connect(fbns_auth, _session_id()), level)
+
+
+def cached(fbns_auth, level):
+    return FBNSConnectPackageFactor.build_package(fbns_auth, True, 900, FBNSMQTTProtocol,
+                                                  compression_level=level)
+
+
+def measure(func, fbns_auth, level, seconds):
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            func(fbns_auth, level)
+        count += 100
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=2)
+    parser.add_argument('--level', type=int, default=9)
+    args = parser.parse_args()
+
+    fbns_auth = FBNSAuth(AUTH_DATA)
+
+    # Cached payload must decode to the same Thrift message
+    template = FBNSConnectPackageFactor.get_template(fbns_auth, args.level)
+    assert zlib.decompress(template.build(123456789)) == serialize_connect(fbns_auth, 123456789)
+
+    before = measure(uncached, fbns_auth, args.level, args.seconds)
+    after = measure(cached, fbns_auth, args.level, args.seconds)
+    print('uncached: {:10.0f} packets/sec'.format(before))
+    print('cached:   {:10.0f} packets/sec ({:.1f}x)'.format(after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Event loop lag while a burst of large pushes is decoded inline and in an executor.
+
+    python benchmarks/bench_decode_offload.py [--pushes 2000] [--size 200000] [--executor thread|process]
+"""
+import argparse
+import asyncio
+import json
+import random
+import string
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.loop_lag import LoopLagMonitor
+
+
+def make_payload(size):
+    text = ''.join(random.choice(string.ascii_letters) for _ in range(size))
+    push = {
+        'token': 'token', 'ck': 1, 'pn': 'com.instagram.android', 'cp': 'direct_v2_message', 'nid': '1',
+        'fbpushnotif': json.dumps({'m': text, 'collapse_key': 'direct_v2_message'}),
+    }
+    return zlib.compress(json.dumps(push).encode('utf8'))
+
+
+async def run(executor, payloads):
+    received = 0
+    done = asyncio.Event()
+
+    def on_fbns_message(push):
+        nonlocal received
+        received += 1
+        if received == len(payloads):
+            done.set()
+
+    client = FBNSMQTTClient(decode_executor=executor, decode_threshold=1024)
+    client.on_fbns_message = on_fbns_message
+
+    monitor = LoopLagMonitor(interval=0.005)
+    monitor.start()
+    await asyncio.sleep(0.05)
+
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    # Packets arrive in small chunks as from a socket read loop
+    for i in range(0, len(payloads), 10):
+        for payload in payloads[i:i + 10]:
+            client.on_message(client, FBNSMQTTClient.MESSAGE_TOPIC_ID, payload, 1, {})
+        await asyncio.sleep(0)
+    await done.wait()
+    elapsed = loop.time() - started
+    monitor.stop()
+    return elapsed, monitor.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pushes', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=200000)
+    parser.add_argument('--executor', choices=('thread', 'process'), default='process')
+    args = parser.parse_args()
+
+    payloads = [make_payload(args.size)] * args.pushes
+    loop = asyncio.get_event_loop()
+
+    executor = ProcessPoolExecutor() if args.executor == 'process' else ThreadPoolExecutor(1)
+    for name, ex in (('inline', None), (args.executor, executor)):
+        elapsed, stats = loop.run_until_complete(run(ex, payloads))
+        print('{:8} {:.2f}s  lag mean {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+            name, elapsed, stats['mean'] * 1000, stats['p99'] * 1000, stats['max'] * 1000))
+    executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Cold import time of fbns_mqtt.fbns_mqtt, measured in fresh interpreters
+started from an unrelated working directory.
+
+    python benchmarks/bench_import.py [--runs 10] [--max-ms 250]
+
+Exits with status 1 when the median import time exceeds --max-ms.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+
+IMPORT_CODE = '''
+import time
+started = time.perf_counter()
+import fbns_mqtt.fbns_mqtt
+print((time.perf_counter() - started) * 1000)
+'''
+
+
+def import_time_ms(cwd):
+    out = subprocess.check_output([sys.executable, '-c', IMPORT_CODE], cwd=cwd)
+    return float(out.decode().strip())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cwd:
+        times = [import_time_ms(cwd) for _ in range(args.runs)]
+
+    median = statistics.median(times)
+    print('import fbns_mqtt.fbns_mqtt: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms ({} runs)'.format(
+        median, min(times), max(times), args.runs))
+
+    if args.max_ms is not None and median > args.max_ms:
+        print('FAIL: median import time is above {} ms'.format(args.max_ms))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Memory of idle connected sessions against a local FBNSTestBroker.
+
+    python benchmarks/bench_session_memory.py [--sessions 1000] [--full] [--max-bytes N]
+
+Python heap growth per session is measured with tracemalloc after warm up
+sessions have loaded the thrift schema and filled interpreter caches, RSS
+growth is reported alongside. Sessions are lean unless --full is given.
+
+Exits with status 1 when heap bytes per session exceed --max-bytes
+(default LEAN_SESSION_BYTES for lean sessions, no limit for full ones).
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+from fbns_mqtt.fbns_mqtt import LEAN_SESSION_BYTES
+from fbns_mqtt.pool import FBNSMQTTPool, STATE_CONNECTED
+
+WARMUP_SESSIONS = 20
+
+
+def rss_bytes():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def connect_sessions(pool, first, count):
+    for account_id in range(first, first + count):
+        pool.add_account(account_id)
+    await pool.connect()
+    # Let registration and token exchange finish
+    await asyncio.sleep(1)
+    gc.collect()
+
+
+async def measure(port, sessions, lean):
+    pool = FBNSMQTTPool('127.0.0.1', port, ssl=False, max_concurrent_connects=100,
+                        client_kwargs={'metrics': False, 'lean': lean})
+    await connect_sessions(pool, 0, WARMUP_SESSIONS)
+
+    tracemalloc.start()
+    rss_before = rss_bytes()
+    heap_before = tracemalloc.get_traced_memory()[0]
+    await connect_sessions(pool, WARMUP_SESSIONS, sessions)
+    heap_after = tracemalloc.get_traced_memory()[0]
+    rss_after = rss_bytes()
+    tracemalloc.stop()
+
+    connected = pool.count_by_state().get(STATE_CONNECTED, 0) - WARMUP_SESSIONS
+    await pool.disconnect()
+    connected = max(connected, 1)
+    return (heap_after - heap_before) / connected, (rss_after - rss_before) / connected, connected
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--full', action='store_true', help='measure sessions created without lean=True')
+    parser.add_argument('--max-bytes', type=int, default=None)
+    args = parser.parse_args()
+
+    lean = not args.full
+    max_bytes = args.max_bytes
+    if max_bytes is None and lean:
+        max_bytes = LEAN_SESSION_BYTES
+
+    logging.basicConfig(level=logging.ERROR)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    port = 19830 + os.getpid() % 1000
+    broker = subprocess.Popen([sys.executable, '-m', 'fbns_mqtt.broker', '--port', str(port)],
+                              stdout=subprocess.PIPE)
+    broker.stdout.readline()
+    try:
+        loop = asyncio.get_event_loop()
+        heap, rss, connected = loop.run_until_complete(measure(port, args.sessions, lean))
+    finally:
+        broker.terminate()
+        broker.wait()
+
+    print('{} idle {} sessions: {:.0f} heap bytes/session, {:.0f} RSS bytes/session'.format(
+        connected, 'lean' if lean else 'full', heap, rss))
+
+    if connected < args.sessions:
+        print('FAIL: only {} of {} sessions connected'.format(connected, args.sessions))
+        sys.exit(1)
+    if max_bytes is not None and heap > max_bytes:
+        print('FAIL: heap bytes per session are above {}'.format(max_bytes))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
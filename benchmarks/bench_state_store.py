@@ -0,0 +1,53 @@
+"""
+SQLiteStateStore write and bulk load speed.
+
+    python benchmarks/bench_state_store.py [--accounts 10000]
+
+Saves credentials and token of every account, flushes and loads them back
+with load_all() as done on startup.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from fbns_mqtt.state import SQLiteStateStore
+
+
+async def run(path, accounts):
+    store = SQLiteStateStore(path)
+    started = time.perf_counter()
+    for account_id in range(accounts):
+        store.save_auth(account_id, {'ck': 10 ** 14 + account_id, 'cs': 'x' * 32, 'di': 'd' * 36, 'ds': 's' * 32})
+        store.save_token(account_id, 't' * 64)
+    queued = time.perf_counter()
+    await store.flush()
+    flushed = time.perf_counter()
+    batches = store.batches
+    await store.close()
+
+    store = SQLiteStateStore(path)
+    started_load = time.perf_counter()
+    states = await store.load_all()
+    loaded = time.perf_counter()
+    await store.close()
+    assert len(states) == accounts
+
+    print('{} accounts: save calls {:.1f} ms on loop, written in {} batches in {:.1f} ms, '
+          'load_all {:.1f} ms'.format(accounts, (queued - started) * 1000, batches,
+                                      (flushed - queued) * 1000, (loaded - started_load) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(run(os.path.join(directory, 'state.sqlite'), args.accounts))
+
+
+if __name__ == '__main__':
+    main()
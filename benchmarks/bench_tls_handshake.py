@@ -0,0 +1,117 @@
+"""
+TLS connect cost against the local test broker: a new default SSL context per connection
+(what ssl=True did before) against one shared FBNSSSLContext resuming TLS sessions.
+Client CPU time per connect and handshake counts are reported, the broker runs in a subprocess.
+
+    python benchmarks/bench_tls_handshake.py [--connections 300] [--concurrency 20]
+
+A self-signed certificate for localhost is generated with the openssl command unless
+--certfile/--keyfile are given.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.tls import create_ssl_context
+
+HOST = 'localhost'
+
+
+def generate_certificate(directory):
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                           '-keyout', keyfile, '-out', certfile, '-days', '1', '-nodes', '-subj', '/CN=' + HOST,
+                           '-addext', 'subjectAltName=DNS:' + HOST],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run(port, connections, concurrency, make_context):
+    # Connects and disconnects clients, concurrency at a time, returns client CPU seconds and wall seconds
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect_one():
+        async with semaphore:
+            client = FBNSMQTTClient(lean=True, metrics=False)
+            await client.connect(HOST, port, ssl=make_context(), keepalive=900)
+            await client.disconnect()
+
+    cpu, wall = time.process_time(), time.perf_counter()
+    await asyncio.gather(*[connect_one() for _ in range(connections)])
+    return time.process_time() - cpu, time.perf_counter() - wall
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    args = parser.parse_args()
+    # Python 3.7 asyncio logs an SSL error for every connection the broker closes after DISCONNECT
+    logging.getLogger('asyncio').setLevel(logging.CRITICAL)
+    logging.getLogger('gmqtt').setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = (args.certfile, args.keyfile) if args.certfile else generate_certificate(directory)
+        port = free_port()
+        broker = subprocess.Popen([sys.executable, '-m', 'fbns_mqtt.broker', '--host', '127.0.0.1',
+                                   '--port', str(port), '--certfile', certfile] +
+                                  (['--keyfile', keyfile] if keyfile else []),
+                                  stdout=subprocess.DEVNULL)
+        try:
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(wait_port(port))
+
+            def per_connection_context():
+                context = ssl.create_default_context()
+                context.load_verify_locations(certfile)
+                return context
+
+            shared = create_ssl_context(cafile=certfile, metrics=False)
+
+            results = {}
+            for name, make_context in (('per-connection', per_connection_context), ('shared', lambda: shared)):
+                cpu, wall = loop.run_until_complete(run(port, args.connections, args.concurrency, make_context))
+                results[name] = cpu
+                print('{:15} {:7.2f} ms CPU/connect {:8.0f} connects/sec'.format(
+                    name, cpu / args.connections * 1000, args.connections / wall))
+            print('shared context: {} handshakes, {} resumed, {} full, {:.2f} ms average handshake'.format(
+                shared.stats['handshakes'], shared.stats['resumed'], shared.stats['full'],
+                shared.handshake_time / max(shared.stats['handshakes'], 1) * 1000))
+            print('CPU per connect: {:.1f}x less'.format(results['per-connection'] / results['shared']))
+        finally:
+            broker.terminate()
+            broker.wait()
+
+
+if __name__ == '__main__':
+    main()
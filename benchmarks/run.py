@@ -0,0 +1,216 @@
+"""
+Benchmark harness running FBNSMQTTClient against a local FBNSTestBroker.
+
+    python benchmarks/run.py [--sessions 100,1000,10000] [--output results.json]
+
+Measures CONNECT -> CONNACK -> token latency, push throughput through
+on_message -> FBNSPush -> callback, event loop lag under push bursts and
+RSS per connected session. Results are written as JSON.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import zlib
+
+from fbns_mqtt.broker import make_push
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.loop_lag import LoopLagMonitor
+from fbns_mqtt.pool import FBNSMQTTPool, STATE_CONNECTED
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        'count': len(values),
+        'mean': statistics.mean(values),
+        'p50': values[len(values) // 2],
+        'p90': values[int(len(values) * 0.9)],
+        'p99': values[min(int(len(values) * 0.99), len(values) - 1)],
+        'max': values[-1],
+    }
+
+
+def rss_bytes():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    # Not Linux, peak RSS is the best available approximation
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def bench_connect_latency(port, count):
+    auth_times = []
+    token_times = []
+    for _ in range(count):
+        client = FBNSMQTTClient(metrics=False)
+        loop = asyncio.get_event_loop()
+        token_received = asyncio.Event()
+        started = loop.time()
+        client.on_fbns_auth = lambda auth: auth_times.append(loop.time() - started)
+        client.on_fbns_token = lambda token: (token_times.append(loop.time() - started), token_received.set())
+        session = asyncio.ensure_future(client.connect('127.0.0.1', port))
+        await asyncio.wait_for(token_received.wait(), 10)
+        session.cancel()
+        await client.disconnect()
+    return {'connack_seconds': percentiles(auth_times), 'token_seconds': percentiles(token_times)}
+
+
+async def bench_push_throughput(count, size):
+    received = 0
+
+    def on_fbns_message(push):
+        nonlocal received
+        received += 1
+
+    client = FBNSMQTTClient(metrics=False)
+    client.on_fbns_message = on_fbns_message
+    payloads = [zlib.compress(json.dumps(make_push(size)).encode('utf8')) for _ in range(1000)]
+    topic = FBNSMQTTClient.MESSAGE_TOPIC_ID
+
+    started = time.perf_counter()
+    for i in range(count):
+        client.on_message(client, topic, payloads[i % len(payloads)], 1, {})
+    elapsed = time.perf_counter() - started
+    assert received == count
+    return {'pushes': count, 'push_size': size, 'seconds': elapsed, 'pushes_per_second': count / elapsed}
+
+
+async def bench_burst_lag(port, sessions, seconds):
+    # Broker publishes pushes at a fixed rate to all sessions
+    pool = FBNSMQTTPool('127.0.0.1', port, ssl=False, max_concurrent_connects=100,
+                        client_kwargs={'metrics': False})
+    received = 0
+
+    def on_fbns_message(account_id, push):
+        nonlocal received
+        received += 1
+
+    pool.on_fbns_message = on_fbns_message
+    for i in range(sessions):
+        pool.add_account(i)
+    await pool.connect()
+
+    monitor = LoopLagMonitor(interval=0.005)
+    monitor.start()
+    received = 0
+    await asyncio.sleep(seconds)
+    monitor.stop()
+    await pool.disconnect()
+    result = {'sessions': sessions, 'seconds': seconds, 'pushes_received': received,
+              'pushes_per_second': received / seconds}
+    result.update(('lag_' + k, v) for k, v in monitor.stats().items())
+    return result
+
+
+async def bench_memory(port, sessions):
+    gc.collect()
+    before = rss_bytes()
+    pool = FBNSMQTTPool('127.0.0.1', port, ssl=False, max_concurrent_connects=200,
+                        client_kwargs={'metrics': False})
+    for i in range(sessions):
+        pool.add_account(i)
+    started = time.perf_counter()
+    await pool.connect()
+    connect_seconds = time.perf_counter() - started
+    await asyncio.sleep(1)
+    gc.collect()
+    after = rss_bytes()
+    connected = pool.count_by_state().get(STATE_CONNECTED, 0)
+    await pool.disconnect()
+    return {
+        'sessions': sessions,
+        'connected': connected,
+        'connect_seconds': connect_seconds,
+        'rss_delta_bytes': after - before,
+        'rss_bytes_per_session': (after - before) / max(connected, 1),
+    }
+
+
+def start_broker_process(port, push_rate=0, push_size=512):
+    # Broker in a separate process keeps its memory and CPU out of the measurements
+    process = subprocess.Popen([sys.executable, '-m', 'fbns_mqtt.broker', '--port', str(port),
+                                '--push-rate', str(push_rate), '--push-size', str(push_size)],
+                               stdout=subprocess.PIPE)
+    process.stdout.readline()
+    return process
+
+
+def raise_nofile_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+async def run(args):
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+    }
+
+    results['push_throughput'] = await bench_push_throughput(args.pushes, args.push_size)
+
+    port = 18830 + os.getpid() % 1000
+    process = start_broker_process(port + 1, args.burst_rate, args.push_size)
+    try:
+        results['burst_lag'] = await bench_burst_lag(port + 1, args.burst_sessions, args.burst_seconds)
+    finally:
+        process.terminate()
+        process.wait()
+
+    nofile = raise_nofile_limit()
+    process = start_broker_process(port)
+    try:
+        results['connect_latency'] = await bench_connect_latency(port, args.connects)
+        results['memory'] = []
+        for sessions in args.sessions:
+            if sessions * 2 + 100 > nofile:
+                logging.warning('Skipping %s sessions, open files limit is %s', sessions, nofile)
+                continue
+            results['memory'].append(await bench_memory(port, sessions))
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', default='100,1000,10000',
+                        type=lambda v: [int(x) for x in v.split(',')])
+    parser.add_argument('--connects', type=int, default=100)
+    parser.add_argument('--pushes', type=int, default=20000)
+    parser.add_argument('--push-size', type=int, default=512)
+    parser.add_argument('--burst-sessions', type=int, default=100)
+    parser.add_argument('--burst-rate', type=int, default=5000, help='pushes per second in burst')
+    parser.add_argument('--burst-seconds', type=float, default=5)
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run(args))
+
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(data)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(data)
+
+
+if __name__ == '__main__':
+    main()
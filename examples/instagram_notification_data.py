@@ -128,74 +128,98 @@ from urllib.parse import urlsplit, parse_qs
 #     - error - An exception of severity "error" occurred. It's not guaranteed that the Push client will continue to work.
 
 
-def _spop(d, k):
-    if k in d:
-        return d.pop(k)
-    return None
+_BADGE_COUNT_KEYS = frozenset(('di', 'ds', 'dt', 'ac'))
+
 
 class BadgeCount(object):
+    __slots__ = ('direct', 'ds', 'td', 'activities')
+
     def __init__(self, data):
-        if isinstance(data,str):
+        if isinstance(data, str):
             data = json.loads(data)
-        self.direct = _spop(data, 'di')
-        self.ds = _spop(data, 'ds')
-        self.td = _spop(data, 'dt')
-        self.activities = _spop(data, 'ac')
-        if data:
+        if not _BADGE_COUNT_KEYS.issuperset(data):
             raise Exception('BadgeCount unexpected data: {data}'.format(**locals()))
+        get = data.get
+        self.direct = get('di')
+        self.ds = get('ds')
+        self.td = get('dt')
+        self.activities = get('ac')
+
+
+_NOTIFICATION_KEYS = frozenset(('t', 'm', 'tt', 'ig', 'collapse_key', 'i', 'a', 'sound', 'pi', 'PushNotifID', 'c',
+                                'u', 's', 'igo', 'bc', 'ia', 'SuppressBadge', 'it', 'si', 'badge'))
 
 
 class InstagramNotification(object):
+    __slots__ = ('title', 'message', 'tickerText', 'igAction', 'collapseKey', 'optionalImage', 'optionalAvatarUrl',
+                 'sound', 'pushId', 'pushCategory', 'intendedRecipientUserId', 'sourceUserId', 'igActionOverride',
+                 'inAppActors', 'suppressBadge', 'it', 'si', 'badge', '_badgeCount', '_action')
+
     def __str__(self):
-        return str(self.__dict__)
+        fields = [name for name in self.__slots__ if not name.startswith('_')]
+        fields += ['actionPath', 'actionParams', 'badgeCount']
+        return str({name: getattr(self, name) for name in fields})
 
     def __init__(self, data):
         if isinstance(data, str):
             data = json.loads(data)
 
-        # For sentry debug
-        original_data = dict(data)
+        if not _NOTIFICATION_KEYS.issuperset(data):
+            raise Exception('InstagramNotification unexpected data: {data}'.format(**locals()))
+
+        get = data.get
+        self.title = get('t')
+        self.message = get('m')
+        self.tickerText = get('tt')
 
-        self.title = _spop(data, 't')
-        self.message = _spop(data, 'm')
-        self.tickerText = _spop(data, 'tt')
+        # actionPath and actionParams are parsed from igAction on first access
+        self.igAction = get('ig')
+        self._action = None
 
-        self.igAction = _spop(data, 'ig')
-        self.actionPath = None
-        self.actionParams = None
+        self.collapseKey = get('collapse_key')
+        self.optionalImage = get('i')
+        self.optionalAvatarUrl = get('a')
+        self.sound = get('sound')
+        self.pushId = get('pi')
 
+        self.pushCategory = get('c')
+
+        # Идентификатор чей пост прокомментировали
+        self.intendedRecipientUserId = get('u')
+        self.sourceUserId = get('s')
+        self.igActionOverride = get('igo')
+        self._badgeCount = get('bc')
+        self.inAppActors = get('ia')
+        self.suppressBadge = get('SuppressBadge')
+
+        self.it = get('it')
+        self.si = get('si')
+        self.badge = get('badge')
+
+    def _parse_action(self):
+        action_path = None
+        action_params = None
         if self.igAction:
             scheme, netloc, path, query_string, fragment = urlsplit(self.igAction)
             query_params = parse_qs(query_string)
             query_params = dict((k, v if len(v) > 1 else v[0]) for k, v in query_params.items())
             if path:
-                self.actionPath = path
+                action_path = path
             if query_params:
-                self.actionParams = query_params
-
-        self.collapseKey = _spop(data, 'collapse_key')
-        self.optionalImage = _spop(data, 'i')
-        self.optionalAvatarUrl = _spop(data, 'a')
-        self.sound = _spop(data, 'sound')
-        self.pushId = _spop(data, 'pi')
-        if 'PushNotifID' in data:
-            _spop(data, 'PushNotifID')
-
-        self.pushCategory = _spop(data, 'c')
-
-        # Идентификатор чей пост прокомментировали
-        self.intendedRecipientUserId = _spop(data, 'u')
-        self.sourceUserId = _spop(data, 's')
-        self.igActionOverride = _spop(data, 'igo')
-        self.badgeCount = _spop(data, 'bc')
-        if self.badgeCount:
-            self.badgeCount = BadgeCount(self.badgeCount)
-        self.inAppActors = _spop(data, 'ia')
-        self.suppressBadge = _spop(data, 'SuppressBadge')
-
-        self.it = _spop(data, 'it')
-        self.si = _spop(data, 'si')
-        self.badge = _spop(data, 'badge')
-
-        if data:
-            raise Exception('InstagramNotification unexpected data: {data}'.format(**locals()))
+                action_params = query_params
+        self._action = (action_path, action_params)
+        return self._action
+
+    @property
+    def actionPath(self):
+        return (self._action or self._parse_action())[0]
+
+    @property
+    def actionParams(self):
+        return (self._action or self._parse_action())[1]
+
+    @property
+    def badgeCount(self):
+        if self._badgeCount and not isinstance(self._badgeCount, BadgeCount):
+            self._badgeCount = BadgeCount(self._badgeCount)
+        return self._badgeCount
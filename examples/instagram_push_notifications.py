@@ -3,10 +3,10 @@ import os
 import pickle
 import sys
 import asyncio
-from datetime import datetime
 from instagram_private_api import Client, ClientCookieExpiredError, ClientLoginRequiredError
-from dateutil.relativedelta import relativedelta
-from fbns_mqtt.fbns_mqtt import FBNSMQTTClient, FBNSAuth
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.registration import TokenRegistration
+from fbns_mqtt.state import SQLiteStateStore
 
 ABSOLUTE_PATH = lambda x: os.path.abspath(os.path.join(os.path.abspath(os.path.dirname(__file__)), x))
 sys.path.append(ABSOLUTE_PATH('.'))
@@ -20,6 +20,8 @@ STOP = asyncio.Event()
 USERNAME = ''
 PASSWORD = ''
 SETTINGS_FILE = 'fbns_mqtt_settings_{USERNAME}.pickle'.format(**locals())
+# FBNS credentials and token
+STATE_FILE = 'fbns_mqtt_state.sqlite'
 
 
 def save_settings(data):
@@ -49,27 +51,11 @@ async def instagram_listener_worker():
     else:
         settings = {}
 
-    client = FBNSMQTTClient()
-
-    fbns_auth = settings.get('fbns_auth')
-    if fbns_auth:
-        client.set_fbns_auth(FBNSAuth(fbns_auth))
-
     def on_login_callback(client):
         settings['api_settings'] = client.settings
         save_settings(settings)
 
-    def on_fbns_auth(auth):
-        settings['fbns_auth'] = auth
-        settings['fbns_auth_received'] = datetime.now()
-        save_settings(settings)
-
-    def on_fbns_token(token):
-        if settings.get('fbns_token', None) == token:
-            if 'fbns_token_received' in settings and settings['fbns_token_received'] > datetime.now() - relativedelta(hours=24):
-                # Do not register token twice in 24 hours
-                return
-
+    def register_push(account_id, token):
         device_id = settings.get('device_id')
         try:
             if settings.get('api_settings'):
@@ -81,25 +67,31 @@ async def instagram_listener_worker():
 
         client.register_push(token)
 
-        settings['fbns_token'] = token
-        settings['fbns_token_received'] = datetime.now()
-        save_settings(settings)
+    # Received credentials and token are saved by client in background.
+    # Token is registered in Instagram API once in 24 hours, blocking register_push is run in executor
+    # and retried on errors.
+    state_store = SQLiteStateStore(ABSOLUTE_PATH(STATE_FILE))
+    registration = TokenRegistration(register_push, concurrency=1, ttl=24 * 3600, state_store=state_store)
+    client = FBNSMQTTClient(state_store=state_store, account_id=USERNAME, registration=registration)
+    await client.load_state()
+
+    def on_comment(push):
+        notification = InstagramNotification(push.notification)
+        print(notification.message)
 
-    def on_fbns_message(push):
-        if push.payload:
-            notification = InstagramNotification(push.payload)
-            if notification.collapseKey == 'comment':
-                print(notification.message)
-            elif notification.collapseKey == 'direct_v2_message':
-                print(notification.it)
+    def on_direct_message(push):
+        notification = InstagramNotification(push.notification)
+        print(notification.it)
 
-    client.on_fbns_auth = on_fbns_auth
-    client.on_fbns_token = on_fbns_token
-    client.on_fbns_message = on_fbns_message
+    client.set_push_filter(collapse_keys={'comment', 'direct_v2_message'})
+    client.add_push_handler('comment', on_comment)
+    client.add_push_handler('direct_v2_message', on_direct_message)
 
     await client.connect('mqtt-mini.facebook.com', 443, ssl=True, keepalive=900)
     await STOP.wait()
     await client.disconnect()
+    await registration.close()
+    await state_store.close()
 
 
 if __name__ == "__main__":
@@ -9,9 +9,13 @@ setup(name='fbns_mqtt',
       packages=['fbns_mqtt', ],
       package_dir={'fbns_mqtt': 'src'},
       entry_points={
+          'console_scripts': ['fbns-mqtt = fbns_mqtt.cli:main'],
       },
       install_requires=[
-          'gmqtt',
+          'gmqtt>=0.6.10,<0.7',
           'thriftpy',
       ],
+      extras_require={
+          'uvloop': ['uvloop'],
+      },
       include_package_data=True,)
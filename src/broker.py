@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import random
+import ssl
+import string
+import struct
+import uuid
+import zlib
+
+from gmqtt.client import logger
+from gmqtt.mqtt.constants import MQTTCommands
+from gmqtt.mqtt.utils import pack_variable_byte_integer
+
+from .fbns_mqtt import FBNSMQTTClient, deserialize_connect
+
+PUSH_CATEGORIES = ('comment', 'like', 'direct_v2_message', 'new_follower', 'post', 'live_broadcast')
+
+
+def _random_string(length):
+    return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length))
+
+
+def _pack_string(value):
+    return struct.pack('!H', len(value)) + value
+
+
+def make_push(size=512, collapse_key=None, nid=None):
+    # Synthetic fbns_msg push envelope, size is the length of notification text
+    collapse_key = collapse_key or random.choice(PUSH_CATEGORIES)
+    notification = {
+        't': '',
+        'm': 'x' * size,
+        'ig': 'media?id=1111111111111111111_1111111111',
+        'collapse_key': collapse_key,
+        'pi': uuid.uuid4().hex,
+        'c': collapse_key,
+        's': '1111111111',
+        'u': 2222222222,
+    }
+    return {
+        'token': _random_string(16),
+        'ck': 1111111111,
+        'pn': FBNSMQTTClient.PACKAGE_NAME,
+        'cp': collapse_key,
+        'fbpushnotif': json.dumps(notification),
+        'nid': nid or uuid.uuid4().hex,
+        'bu': '0',
+    }
+
+
+class BrokerSession(object):
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.connect_payload = None
+        self.auth = None
+        self.keepalive = None
+        self._mid = itertools.cycle(range(1, 65536))
+
+    @property
+    def client_id(self):
+        return self.connect_payload.clientIdentifier if self.connect_payload else None
+
+    def write(self, command, body=b''):
+        data = bytes([command]) + pack_variable_byte_integer(len(body)) + body
+        self.broker.stats['bytes_out'] += len(data)
+        self.writer.write(data)
+
+    def publish(self, topic, data, qos=1):
+        payload = zlib.compress(json.dumps(data).encode('utf8'))
+        body = _pack_string(topic.encode('utf8'))
+        if qos:
+            body += struct.pack('!H', next(self._mid))
+        self.write(MQTTCommands.PUBLISH | (qos << 1), body + payload)
+
+    async def read_packet(self):
+        command, = await self.reader.readexactly(1)
+        length = 0
+        multiplier = 1
+        for _ in range(4):
+            byte, = await self.reader.readexactly(1)
+            length += (byte & 127) * multiplier
+            multiplier *= 128
+            if not byte & 128:
+                break
+        return command, await self.reader.readexactly(length)
+
+    def handle_connect(self, body):
+        name_length, = struct.unpack('!H', body[:2])
+        offset = 2 + name_length
+        proto_name = body[2:offset]
+        proto_ver, flags, self.keepalive = struct.unpack('!BBH', body[offset:offset + 4])
+        self.connect_payload = deserialize_connect(zlib.decompress(body[offset + 4:]))
+        logger.debug('[BROKER CONNECT] %s v%s keepalive %s client %s', proto_name, proto_ver, self.keepalive,
+                     self.client_id)
+
+        code = self.broker.connack_code
+        self.broker.stats['connack_{}'.format(code)] += 1
+        if code != 0:
+            self.write(MQTTCommands.CONNACK, bytes([0, code]))
+            return False
+
+        self.auth = self.broker.authenticate(self.connect_payload)
+        auth = json.dumps(self.auth).encode('utf8')
+        self.write(MQTTCommands.CONNACK, bytes([0, 0]) + _pack_string(auth))
+        return True
+
+    def handle_publish(self, command, body):
+        qos = (command & 0x06) >> 1
+        topic_length, = struct.unpack('!H', body[:2])
+        topic = body[2:2 + topic_length].decode('utf8')
+        offset = 2 + topic_length
+        if qos:
+            mid, = struct.unpack('!H', body[offset:offset + 2])
+            offset += 2
+            self.write(MQTTCommands.PUBACK, struct.pack('!H', mid))
+        payload = json.loads(zlib.decompress(body[offset:]))
+
+        if topic in (FBNSMQTTClient.REG_REQ_TOPIC, FBNSMQTTClient.REG_REQ_TOPIC_ID):
+            self.broker.stats['registrations'] += 1
+            if self.broker.register_error:
+                self.publish(FBNSMQTTClient.REG_RESP_TOPIC_ID, {'token': '', 'error': self.broker.register_error})
+                return
+            token = self.broker.token_for(self.auth['di'], payload)
+            self.publish(FBNSMQTTClient.REG_RESP_TOPIC_ID, {'token': token, 'error': ''})
+
+    async def run(self):
+        command, body = await self.read_packet()
+        if command & 0xF0 != MQTTCommands.CONNECT or not self.handle_connect(body):
+            return
+        while True:
+            command, body = await self.read_packet()
+            cmd_type = command & 0xF0
+            if cmd_type == MQTTCommands.PUBLISH:
+                self.handle_publish(command, body)
+            elif cmd_type == MQTTCommands.PINGREQ:
+                self.broker.stats['pingreq'] += 1
+                if self.broker.pingresp:
+                    self.write(MQTTCommands.PINGRESP)
+            elif cmd_type == MQTTCommands.DISCONNECT:
+                return
+
+
+class FBNSTestBroker(object):
+    # Local stand-in for mqtt-mini.facebook.com speaking the MQTToT dialect:
+    # decodes Thrift CONNECT, answers JSON CONNACK and /fbns_reg_req with a token,
+    # publishes synthetic pushes at push_rate per second in total to connected sessions.
+    # push_sizes is a sequence of (notification size, weight).
+    # register_error is answered to /fbns_reg_req instead of a token when set,
+    # PINGREQ is left unanswered with pingresp=False.
+    def __init__(self, host='127.0.0.1', port=0, ssl=None, push_rate=0.0, push_sizes=((512, 1),),
+                 connack_code=0, register_error='', pingresp=True):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.push_rate = push_rate
+        self.push_sizes = tuple(push_sizes)
+        self.connack_code = connack_code
+        self.register_error = register_error
+        self.pingresp = pingresp
+
+        self.sessions = collections.OrderedDict()
+        self.tokens = {}
+        self.stats = collections.Counter()
+
+        self._server = None
+        self._push_task = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port, ssl=self.ssl)
+        self.port = self._server.sockets[0].getsockname()[1]
+        if self.push_rate:
+            self._push_task = asyncio.ensure_future(self._push_loop())
+        return self
+
+    async def stop(self):
+        if self._push_task is not None:
+            self._push_task.cancel()
+            self._push_task = None
+        if self._server is not None:
+            self._server.close()
+            for session in list(self.sessions.values()):
+                session.writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def authenticate(self, connect_payload):
+        # Known device keeps its credentials, new one gets generated
+        client_info = connect_payload.clientInfo
+        if client_info.userId and connect_payload.password:
+            return {'ck': client_info.userId, 'cs': connect_payload.password,
+                    'di': client_info.deviceId, 'ds': client_info.deviceSecret, 'sr': '', 'rc': ''}
+        self.stats['new_devices'] += 1
+        return {'ck': random.randint(10 ** 14, 10 ** 15), 'cs': _random_string(32),
+                'di': str(uuid.uuid4()), 'ds': _random_string(32), 'sr': '', 'rc': ''}
+
+    def token_for(self, device_id, payload):
+        # Device keeps its token across reconnects
+        token = self.tokens.get(device_id)
+        if token is None:
+            token = self.tokens[device_id] = _random_string(64)
+        return token
+
+    def random_push_size(self):
+        sizes, weights = zip(*self.push_sizes)
+        return random.choices(sizes, weights)[0]
+
+    def publish_push(self, session=None, data=None):
+        if session is None:
+            if not self.sessions:
+                return False
+            session = random.choice(list(self.sessions.values()))
+        session.publish(FBNSMQTTClient.MESSAGE_TOPIC_ID, data or make_push(self.random_push_size()))
+        self.stats['pushes'] += 1
+        return True
+
+    async def _push_loop(self):
+        tick = 0.01
+        loop = asyncio.get_event_loop()
+        budget = 0.0
+        turn = 0
+        while True:
+            started = loop.time()
+            await asyncio.sleep(tick)
+            sessions = [session for session in self.sessions.values()
+                        if session.auth is not None and not session.writer.is_closing()]
+            if not sessions:
+                budget = 0.0
+                continue
+            budget += (loop.time() - started) * self.push_rate
+            while budget >= 1:
+                turn += 1
+                self.publish_push(sessions[turn % len(sessions)])
+                budget -= 1
+
+    async def _handle_client(self, reader, writer):
+        session = BrokerSession(self, reader, writer)
+        key = id(session)
+        self.sessions[key] = session
+        self.stats['connects'] += 1
+        try:
+            await session.run()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error('[BROKER] session error', exc_info=e)
+        finally:
+            self.sessions.pop(key, None)
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local FBNS stand-in broker')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--push-rate', type=float, default=0.0, help='pushes per second to all sessions')
+    parser.add_argument('--push-size', type=int, action='append', help='notification size, may be repeated')
+    parser.add_argument('--certfile', help='serve TLS with this certificate chain (PEM)')
+    parser.add_argument('--keyfile', help='private key of --certfile if not included in it')
+    args = parser.parse_args()
+
+    sizes = [(size, 1) for size in args.push_size or [512]]
+    server_ssl = None
+    if args.certfile:
+        server_ssl = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        server_ssl.load_cert_chain(args.certfile, args.keyfile)
+    broker = FBNSTestBroker(args.host, args.port, ssl=server_ssl, push_rate=args.push_rate, push_sizes=sizes)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(broker.start())
+    print('FBNS test broker listening on {}:{}'.format(broker.host, broker.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(broker.stop())
+
+
+if __name__ == '__main__':
+    main()
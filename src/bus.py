@@ -0,0 +1,142 @@
+import asyncio
+
+from gmqtt.client import logger
+
+from .delivery import PushQueue, OVERFLOW_BLOCK
+from .fbns_mqtt import FBNSMQTTClient
+from .metrics import get_default_metrics
+
+
+class Subscription(PushQueue):
+    # Bounded queue of one PushBus subscriber, consumed with `async for` or by the handler task.
+    # Items are pushes of a client source and (account_id, push) of pool and supervisor sources.
+    def __init__(self, bus, name, collapse_keys=None, maxsize=1000, overflow=OVERFLOW_BLOCK, sample_rate=0.1):
+        super().__init__(maxsize, overflow, on_full=bus._pause_reading, on_drain=bus._resume_reading,
+                         on_drop=self._on_drop, sample_rate=sample_rate)
+        self.name = name
+        self.collapse_keys = frozenset(collapse_keys) if collapse_keys is not None else None
+        self._bus = bus
+        self._handler_task = None
+
+    def get_nowait(self):
+        item = super().get_nowait()
+        if self._bus._metrics is not None:
+            self._bus._metrics.bus_queue_depth.set(len(self), (self.name,))
+        return item
+
+    def _on_drop(self, item):
+        if self._bus._metrics is not None:
+            self._bus._metrics.bus_dropped.inc((self.name,))
+
+    async def _run_handler(self, handler):
+        async for item in self:
+            try:
+                result = handler(*item) if isinstance(item, tuple) else handler(item)
+                if asyncio.iscoroutine(result):
+                    await result
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.error('[BUS] subscriber %s handler failed', self.name, exc_info=exc)
+
+
+class PushBus(object):
+    # Fans pushes of attached FBNSMQTTClient, FBNSMQTTPool or FBNSSupervisor out to subscribers.
+    # Every subscriber has its own bounded queue and overflow policy, so a slow one only
+    # affects others with OVERFLOW_BLOCK: its full queue pauses reading of all sources.
+    # The same FBNSPush object is put into every queue.
+    def __init__(self, metrics=None):
+        self._subscriptions = {}
+        self._sources = []
+        self._blocked_queues = 0
+        # FBNSMetrics (default registry if None, False disables) for queue depth and drops by subscriber
+        self._metrics = get_default_metrics() if metrics is None else (metrics or None)
+        self._filtered = False
+
+        self.published = 0
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def attach(self, source):
+        if isinstance(source, FBNSMQTTClient):
+            source.on_fbns_message = self.publish
+        else:
+            source.on_fbns_message = lambda account_id, push: self.publish(push, account_id)
+        self._sources.append(source)
+        if self._blocked_queues:
+            source._pause_reading(self)
+
+    def subscribe(self, name, handler=None, collapse_keys=None, maxsize=1000, overflow=OVERFLOW_BLOCK,
+                  sample_rate=0.1):
+        # handler (plain or coroutine function) is called for every item by a task of the subscription,
+        # without handler iterate the returned Subscription. collapse_keys limits pushes delivered.
+        if name in self._subscriptions:
+            raise ValueError('Subscriber {name} already exists'.format(**locals()))
+        if handler is not None and not callable(handler):
+            raise ValueError
+        subscription = Subscription(self, name, collapse_keys, maxsize, overflow, sample_rate)
+        self._subscriptions[name] = subscription
+        self._filtered = any(sub.collapse_keys is not None for sub in self._subscriptions.values())
+        if handler is not None:
+            subscription._handler_task = asyncio.ensure_future(subscription._run_handler(handler))
+        return subscription
+
+    async def unsubscribe(self, name, drain=True):
+        # Closes the queue, the handler task finishes queued items unless drain is False
+        subscription = self._subscriptions.pop(name)
+        self._filtered = any(sub.collapse_keys is not None for sub in self._subscriptions.values())
+        subscription.close()
+        if self._metrics is not None:
+            self._metrics.bus_queue_depth.set(0, (name,))
+        task = subscription._handler_task
+        if task is not None:
+            if not drain:
+                task.cancel()
+            await asyncio.wait([task])
+
+    def publish(self, push, account_id=None):
+        self.published += 1
+        item = push if account_id is None else (account_id, push)
+        collapse_key = None
+        if self._filtered:
+            collapse_key = push.collapseKey
+            if collapse_key is None and push.notification:
+                collapse_key = push.notification.get('collapse_key')
+        metrics = self._metrics
+        for subscription in self._subscriptions.values():
+            if subscription.collapse_keys is not None and collapse_key not in subscription.collapse_keys:
+                continue
+            subscription.put(item)
+            if metrics is not None:
+                metrics.bus_queue_depth.set(len(subscription), (subscription.name,))
+
+    def stats(self):
+        # {subscriber: {'depth', 'maxsize', 'put', 'dropped', 'blocked'}}
+        return {
+            name: {
+                'depth': len(subscription),
+                'maxsize': subscription.maxsize,
+                'put': subscription.put_count,
+                'dropped': subscription.dropped,
+                'blocked': subscription.blocked,
+            }
+            for name, subscription in self._subscriptions.items()
+        }
+
+    def _pause_reading(self, queue):
+        self._blocked_queues += 1
+        if self._blocked_queues == 1:
+            logger.debug('[BUS] subscriber %s is full, pausing sources', queue.name)
+            for source in self._sources:
+                source._pause_reading(self)
+
+    def _resume_reading(self, queue):
+        self._blocked_queues -= 1
+        if self._blocked_queues == 0:
+            for source in self._sources:
+                source._resume_reading(self)
+
+    async def close(self, drain=True):
+        for name in list(self._subscriptions):
+            await self.unsubscribe(name, drain=drain)
@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import mmap
+import os
+import struct
+import time
+
+from .fbns_mqtt import FBNSMQTTClient
+
+# File starts with MAGIC, then frames: FRAME_HEADER (unix time, topic length, payload length), topic, payload
+MAGIC = b'FBNSCAP1'
+FRAME_HEADER = struct.Struct('!dHI')
+
+
+class CaptureFormatError(Exception):
+    pass
+
+
+class CaptureWriter(object):
+    # Appends raw PUBLISH topics and still compressed payloads, pass as FBNSMQTTClient(capture=...)
+    # or to several clients of a pool, frames are written through a buffer of buffer_size bytes
+    def __init__(self, path, buffer_size=64 * 1024):
+        self._path = path
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if not self._file.tell():
+            self._file.write(MAGIC)
+        self.frames = 0
+        self.bytes = 0
+
+    def write(self, topic, payload, timestamp=None):
+        if isinstance(topic, str):
+            topic = topic.encode('utf8')
+        self._file.write(FRAME_HEADER.pack(time.time() if timestamp is None else timestamp, len(topic), len(payload)))
+        self._file.write(topic)
+        self._file.write(payload)
+        self.frames += 1
+        self.bytes += FRAME_HEADER.size + len(topic) + len(payload)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class CaptureReader(object):
+    # Memory maps a capture, iteration yields (timestamp, topic, payload memoryview) without copying payloads.
+    # A frame cut short by a crash of the writer ends iteration.
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < len(MAGIC):
+            self._file.close()
+            raise CaptureFormatError('{path} is not an FBNS capture'.format(**locals()))
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise CaptureFormatError('{path} is not an FBNS capture'.format(**locals()))
+        self.truncated = False
+
+    def __iter__(self):
+        data = memoryview(self._mmap)
+        size = len(data)
+        offset = len(MAGIC)
+        while offset + FRAME_HEADER.size <= size:
+            timestamp, topic_length, payload_length = FRAME_HEADER.unpack_from(data, offset)
+            offset += FRAME_HEADER.size
+            end = offset + topic_length + payload_length
+            if end > size:
+                break
+            topic = str(data[offset:offset + topic_length], 'utf8')
+            yield timestamp, topic, data[offset + topic_length:end]
+            offset = end
+        self.truncated = offset != size
+
+    def close(self):
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Payload views are still referenced, the map is closed when they are collected
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def replay_fast(client, path, qos=1):
+    # Feeds every frame through client.on_message back to back, returns number of frames.
+    # Coroutine callbacks only run once the event loop gets control, see replay().
+    count = 0
+    with CaptureReader(path) as reader:
+        for _, topic, payload in reader:
+            client.on_message(client, topic, payload, qos, {})
+            count += 1
+    return count
+
+
+async def replay(client, path, speed=None, qos=1):
+    # Feeds frames through client.on_message at recorded pacing divided by speed, as fast as possible
+    # when speed is None. Waits while client.pushes() consumers are behind, returns number of frames.
+    loop = asyncio.get_event_loop()
+    count = 0
+    started = first = None
+    with CaptureReader(path) as reader:
+        for timestamp, topic, payload in reader:
+            if speed is not None:
+                if first is None:
+                    started, first = loop.time(), timestamp
+                delay = started + (timestamp - first) / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif not count % 100:
+                await asyncio.sleep(0)
+            while client.reading_paused:
+                await asyncio.sleep(0.001)
+            client.on_message(client, topic, payload, qos, {})
+            count += 1
+    return count
+
+
+def main():
+    # Profiles decode and dispatch of a capture, e.g. python -m cProfile -s cumtime -m fbns_mqtt.capture pushes.cap
+    parser = argparse.ArgumentParser(description='Replay FBNS capture through FBNSMQTTClient.on_message')
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, help='recorded pacing multiplier, as fast as possible if omitted')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    client = FBNSMQTTClient(lean=True, metrics=False)
+    pushes = []
+    client.on_fbns_message = pushes.append
+    started = time.perf_counter()
+    count = loop.run_until_complete(replay(client, args.path, args.speed))
+    elapsed = time.perf_counter() - started
+    print('{} frames, {} pushes in {:.2f}s ({:.0f} frames/sec), {} payloads too large'.format(
+        count, len(pushes), elapsed, count / max(elapsed, 1e-9), client.stats['payloads_too_large']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import time
+
+from gmqtt.client import logger
+
+from .capture import CaptureWriter
+from .metrics import start_metrics_server
+from .pool import FBNSMQTTPool
+from .sinks import NDJSONFileSink, StdoutSink, UnixSocketSink
+from .state import SQLiteStateStore
+from .supervisor import FBNSSupervisor
+
+# Seconds between metrics snapshots of workers
+METRICS_INTERVAL = 5.0
+
+
+def load_accounts_file(path):
+    # JSON object {account_id: credentials or null} or list of account ids.
+    # Credentials are CONNACK data saved by on_fbns_auth: {"ck": ..., "cs": ..., "di": ..., "ds": ...}
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        return {account_id: None for account_id in data}
+    if isinstance(data, dict):
+        return data
+    raise ValueError('{path}: expected JSON object or list of account ids'.format(**locals()))
+
+
+async def merge_saved_auth(accounts, store, fleet=()):
+    # Credentials from the accounts file win over saved ones, saved ones are used for accounts
+    # listed without credentials which are not running yet
+    saved = await store.load_all() if store is not None else {}
+    merged = {}
+    for account_id, auth in accounts.items():
+        if not auth and account_id in saved and account_id not in fleet:
+            auth = saved[account_id].auth
+        merged[account_id] = auth or None
+    return merged
+
+
+class _AccountsReloader(object):
+    # Syncs running accounts with the accounts file on SIGHUP and, with interval, when the file changes
+    def __init__(self, fleet, path, store, interval=None):
+        self._fleet = fleet
+        self._path = path
+        self._store = store
+        self._interval = interval
+        self._stamp = self._file_stamp()
+        self._lock = asyncio.Lock()
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    async def reload(self):
+        async with self._lock:
+            self._stamp = self._file_stamp()
+            try:
+                accounts = load_accounts_file(self._path)
+            except (OSError, ValueError) as exc:
+                logger.error('[CLI] accounts file not reloaded: %s', exc)
+                return
+            accounts = await merge_saved_auth(accounts, self._store, self._fleet)
+            if isinstance(self._fleet, FBNSSupervisor):
+                result = self._fleet.sync_accounts(accounts)
+            else:
+                result = await self._fleet.sync_accounts(accounts)
+            logger.warning('[CLI] accounts reloaded: %s added, %s removed, %s updated',
+                           len(result['added']), len(result['removed']), len(result['updated']))
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            if self._file_stamp() != self._stamp:
+                await self.reload()
+
+
+def make_sink(output, batch_size, flush_interval):
+    # -, file:PATH, unix:PATH or none
+    kwargs = {'batch_size': batch_size, 'flush_interval': flush_interval}
+    if output == '-':
+        return StdoutSink(**kwargs)
+    if output == 'none':
+        return None
+    kind, _, path = output.partition(':')
+    if kind == 'file' and path:
+        return NDJSONFileSink(path, **kwargs)
+    if kind == 'unix' and path:
+        return UnixSocketSink(path, **kwargs)
+    raise ValueError('Unknown output {output!r}, expected -, file:PATH, unix:PATH or none'.format(**locals()))
+
+
+def install_event_loop(name):
+    # Returns name of used event loop implementation
+    if name in ('auto', 'uvloop'):
+        try:
+            import uvloop
+        except ImportError:
+            if name == 'uvloop':
+                raise
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return 'uvloop'
+    return 'asyncio'
+
+
+class _Stats(object):
+    # Periodic throughput line on stderr
+    def __init__(self, fleet, sink, interval):
+        self._fleet = fleet
+        self._sink = sink
+        self._interval = interval
+        self._last_time = time.monotonic()
+        self._last_pushes = 0
+        self.pushes = 0
+
+    def count_push(self, *args):
+        self.pushes += 1
+
+    def report(self):
+        now = time.monotonic()
+        rate = (self.pushes - self._last_pushes) / max(now - self._last_time, 1e-9)
+        self._last_time, self._last_pushes = now, self.pushes
+        states = ' '.join('{}={}'.format(state, count) for state, count in sorted(self._fleet.count_by_state().items()))
+        line = '[fbns-mqtt] accounts {} {} | pushes {} ({:.1f}/s)'.format(len(self._fleet), states, self.pushes, rate)
+        if self._sink is not None:
+            line += ' | sink written {} dropped {} buffered {}'.format(self._sink.written, self._sink.dropped,
+                                                                      len(self._sink))
+        print(line, file=sys.stderr, flush=True)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            self.report()
+
+
+async def listen(args):
+    accounts = load_accounts_file(args.accounts)
+    store = SQLiteStateStore(args.state) if args.state else None
+    sink = make_sink(args.output, args.batch_size, args.flush_interval)
+
+    capture = CaptureWriter(args.capture) if args.capture else None
+    client_kwargs = {'lean': args.lean}
+    if capture is not None:
+        client_kwargs['capture'] = capture
+    pool_kwargs = {
+        'max_concurrent_connects': args.max_concurrent_connects,
+        'connect_interval': args.connect_interval,
+        'client_kwargs': client_kwargs,
+    }
+    if args.workers > 1:
+        # Workers send metrics snapshots to be served by this process
+        fleet = FBNSSupervisor(args.host, args.port, ssl=not args.no_ssl, keepalive=args.keepalive,
+                               workers=args.workers, pool_kwargs=pool_kwargs, state_store=store,
+                               metrics_interval=METRICS_INTERVAL if args.metrics_port else None)
+    else:
+        fleet = FBNSMQTTPool(args.host, args.port, ssl=not args.no_ssl, keepalive=args.keepalive,
+                             state_store=store, **pool_kwargs)
+
+    for account_id, auth in (await merge_saved_auth(accounts, store)).items():
+        fleet.add_account(account_id, auth)
+
+    stats = _Stats(fleet, sink, args.stats_interval)
+
+    def on_fbns_message(account_id, push):
+        stats.count_push()
+        if sink is not None:
+            sink.write(push, account_id)
+
+    fleet.on_fbns_message = on_fbns_message
+
+    loop = asyncio.get_event_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    reloader = _AccountsReloader(fleet, args.accounts, store, args.watch_accounts)
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(reloader.reload()))
+
+    metrics_server = None
+    if args.metrics_port:
+        registry = fleet.metrics_registry if isinstance(fleet, FBNSSupervisor) else None
+        metrics_server = await start_metrics_server(registry, port=args.metrics_port)
+
+    stats_task = asyncio.ensure_future(stats.run()) if args.stats_interval else None
+    watch_task = asyncio.ensure_future(reloader.watch()) if args.watch_accounts else None
+    logger.info('[CLI] %s accounts, keepalive %s, %s', len(accounts), args.keepalive,
+                '{} workers'.format(args.workers) if args.workers > 1 else 'single process')
+    if isinstance(fleet, FBNSSupervisor):
+        await fleet.start()
+    else:
+        asyncio.ensure_future(fleet.connect())
+    try:
+        await stop.wait()
+    finally:
+        if stats_task is not None:
+            stats_task.cancel()
+        if watch_task is not None:
+            watch_task.cancel()
+        if isinstance(fleet, FBNSSupervisor):
+            await fleet.stop()
+        else:
+            await fleet.disconnect()
+        if sink is not None:
+            await sink.close()
+        if store is not None:
+            await store.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if capture is not None:
+            capture.close()
+        stats.report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='fbns-mqtt')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    listen_parser = subparsers.add_parser('listen', help='connect accounts and write received pushes')
+    listen_parser.add_argument('accounts', help='JSON file: {account_id: credentials or null} or [account_id, ...]')
+    listen_parser.add_argument('--state', help='SQLite file keeping received credentials and tokens')
+    listen_parser.add_argument('--output', default='-', help='-, file:PATH, unix:PATH or none (default: stdout)')
+    listen_parser.add_argument('--host', default='mqtt-mini.facebook.com')
+    listen_parser.add_argument('--port', type=int, default=443)
+    listen_parser.add_argument('--no-ssl', action='store_true')
+    listen_parser.add_argument('--keepalive', type=int, default=900)
+    listen_parser.add_argument('--max-concurrent-connects', type=int, default=50)
+    listen_parser.add_argument('--connect-interval', type=float, default=0.0)
+    listen_parser.add_argument('--workers', type=int, default=1, help='worker processes, 1 runs in this process')
+    listen_parser.add_argument('--lean', action='store_true', help='lean sessions, see README')
+    listen_parser.add_argument('--batch-size', type=int, default=500, help='output batch size')
+    listen_parser.add_argument('--flush-interval', type=float, default=1.0, help='output flush interval')
+    listen_parser.add_argument('--stats-interval', type=float, default=10.0, help='0 disables stats')
+    listen_parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this port')
+    listen_parser.add_argument('--loop', choices=('auto', 'asyncio', 'uvloop'), default='auto',
+                               help='auto uses uvloop when installed')
+    listen_parser.add_argument('--watch-accounts', type=float, metavar='SECONDS',
+                               help='check the accounts file this often and apply changes, SIGHUP always does')
+    listen_parser.add_argument('--capture', help='record raw pushes for python -m fbns_mqtt.capture replay')
+    listen_parser.add_argument('--log-level', default='WARNING')
+
+    args = parser.parse_args(argv)
+    if args.capture and args.workers > 1:
+        parser.error('--capture is not supported with --workers')
+    logging.basicConfig(level=args.log_level.upper(), stream=sys.stderr)
+    loop_name = install_event_loop(args.loop)
+    logger.info('[CLI] event loop: %s', loop_name)
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(listen(args))
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import asyncio
+import collections
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from gmqtt.client import logger
+
+
+class PushDeduplicator(object):
+    # Bounded TTL cache of seen push keys, one instance can be shared by many clients.
+    # Only hashes of keys are kept in memory, optional backend shares keys with other
+    # processes in background to deduplicate across them.
+    def __init__(self, maxsize=100000, ttl=3600, backend=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._backend = backend
+        self._entries = collections.OrderedDict()
+        if backend is not None:
+            backend.attach(self)
+
+        self.checked = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def seen(self, key):
+        # Returns True if key was already seen within ttl, otherwise remembers it
+        self.checked += 1
+        now = time.monotonic()
+        key_hash = hash(key)
+        expires = self._entries.get(key_hash)
+        if expires is not None:
+            if expires > now:
+                self.duplicates += 1
+                return True
+            del self._entries[key_hash]
+
+        self._entries[key_hash] = now + self._ttl
+        self._evict(now)
+
+        if self._backend is not None:
+            self._backend.add(key, self._ttl)
+        return False
+
+    def remember(self, key, ttl):
+        # Marks key seen by another process as seen for ttl seconds
+        if ttl <= 0:
+            return
+        key_hash = hash(key)
+        now = time.monotonic()
+        expires = self._entries.get(key_hash)
+        if expires is None or expires < now + ttl:
+            self._entries[key_hash] = now + ttl
+            self._evict(now)
+
+    def _evict(self, now):
+        # Local entries have the same ttl, so the oldest ones are at the front.
+        # Keys remembered from other processes may stay a little longer than their ttl
+        entries = self._entries
+        while len(entries) > self._maxsize:
+            entries.popitem(last=False)
+        while entries:
+            key_hash = next(iter(entries))
+            if entries[key_hash] > now:
+                break
+            del entries[key_hash]
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SQLiteDedupBackend(object):
+    # Shared between processes through one SQLite database in WAL mode. Pushes are only checked
+    # against memory: from the first key on, every flush_interval seconds keys seen by the
+    # deduplicator are written in a batch from a single background thread and keys written by
+    # other processes since the previous batch are read back into the deduplicator.
+    # A push redelivered to two processes within flush_interval of each other is not caught.
+    def __init__(self, path, flush_interval=0.5, purge_interval=300):
+        self._path = path
+        self._flush_interval = flush_interval
+        self._purge_interval = purge_interval
+        self._next_purge = 0
+        # The first batch reads all live keys of other processes
+        self._last_poll = 0
+        self._origin = '{}-{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._deduplicator = None
+        # key -> expires (unix time)
+        self._pending = {}
+        self._flush_handle = None
+        self._flush_task = None
+        self._closed = False
+
+        self.writes = 0
+        self.batches = 0
+        self.errors = 0
+        self.received = 0
+
+        self._db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS fbns_dedup (key TEXT PRIMARY KEY, expires REAL NOT NULL, '
+                         'added REAL, origin TEXT)')
+        # Databases created before keys were read back by other processes
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(fbns_dedup)')}
+        for column in ('added REAL', 'origin TEXT'):
+            if column.split()[0] not in columns:
+                self._db.execute('ALTER TABLE fbns_dedup ADD COLUMN ' + column)
+        self._db.execute('CREATE INDEX IF NOT EXISTS fbns_dedup_added ON fbns_dedup (added)')
+
+    def attach(self, deduplicator):
+        # Keys of other processes are remembered by this deduplicator
+        self._deduplicator = deduplicator
+
+    def add(self, key, ttl):
+        # Called for keys not seen locally, only queues the write
+        self._pending[key] = time.time() + ttl
+        if self._flush_handle is None and self._flush_task is None and not self._closed:
+            self._flush_handle = asyncio.get_event_loop().call_later(self._flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_pending())
+
+    async def _flush_pending(self):
+        loop = asyncio.get_event_loop()
+        keys, self._pending = self._pending, {}
+        try:
+            received = await loop.run_in_executor(self._executor, self._write_batch, keys)
+        except Exception as e:
+            logger.error('[DEDUP] failed to write %s keys', len(keys), exc_info=e)
+            self.errors += 1
+            # Keys seen meanwhile are newer
+            keys.update(self._pending)
+            self._pending = keys
+            return False
+        else:
+            self.writes += len(keys)
+            self.batches += 1
+            self.received += len(received)
+            if self._deduplicator is not None:
+                now = time.time()
+                for key, expires in received:
+                    self._deduplicator.remember(key, expires - now)
+            return True
+        finally:
+            self._flush_task = None
+            # Keeps reading keys of other processes while idle
+            if not self._closed and self._flush_handle is None:
+                self._flush_handle = loop.call_later(self._flush_interval, self._start_flush)
+
+    def _write_batch(self, keys):
+        # Returns [(key, expires)] written by other processes since the previous batch
+        now = time.time()
+        since, self._last_poll = self._last_poll, now
+        db = self._db
+        db.execute('BEGIN')
+        try:
+            if now >= self._next_purge:
+                self._next_purge = now + self._purge_interval
+                db.execute('DELETE FROM fbns_dedup WHERE expires < ?', (now,))
+            db.executemany('INSERT OR REPLACE INTO fbns_dedup (key, expires, added, origin) VALUES (?, ?, ?, ?)',
+                           [(key, expires, now, self._origin) for key, expires in keys.items()])
+            received = db.execute('SELECT key, expires FROM fbns_dedup WHERE added >= ? AND origin != ? '
+                                  'AND expires > ?', (since - self._flush_interval, self._origin, now)).fetchall()
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return received
+
+    async def flush(self):
+        # Writes keys seen so far and reads keys of other processes now
+        while self._flush_task is not None:
+            await asyncio.shield(self._flush_task)
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._start_flush()
+        return await asyncio.shield(self._flush_task)
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            self._closed = True
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._db.close)
+            self._executor.shutdown(wait=False)
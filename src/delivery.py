@@ -0,0 +1,136 @@
+import asyncio
+import collections
+
+# Overflow policies
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_SAMPLE = 'sample'
+
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_SAMPLE)
+
+
+class PushQueueClosed(Exception):
+    pass
+
+
+class PushQueue(object):
+    # Bounded queue fed synchronously from the MQTT read path.
+    # With OVERFLOW_BLOCK the producer can't wait, so items are still accepted
+    # over maxsize and on_full is called to pause the producer until the queue
+    # drains to low_watermark and on_drain is called.
+    # OVERFLOW_SAMPLE accepts every item below low_watermark, only one in 1/sample_rate items above it
+    # and drops the newest when full, so a lagging consumer still sees a sample of recent items.
+    def __init__(self, maxsize=1000, overflow=OVERFLOW_BLOCK, low_watermark=None,
+                 on_full=None, on_drain=None, on_drop=None, sample_rate=0.1):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: {overflow}'.format(**locals()))
+        if maxsize < 1:
+            raise ValueError('maxsize must be positive')
+        if not 0 < sample_rate <= 1:
+            raise ValueError('sample_rate must be in (0, 1]')
+        self._items = collections.deque()
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._low_watermark = maxsize // 2 if low_watermark is None else low_watermark
+        self._on_full = on_full
+        self._on_drain = on_drain
+        self._on_drop = on_drop
+        self._sample_every = max(1, round(1 / sample_rate))
+        self._sample_skipped = 0
+        self._waiter = None
+        self._blocked = False
+        self._closed = False
+
+        self.put_count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @property
+    def overflow(self):
+        return self._overflow
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def blocked(self):
+        return self._blocked
+
+    def put(self, item):
+        if self._closed:
+            return False
+        if self._overflow == OVERFLOW_SAMPLE and len(self._items) >= self._low_watermark:
+            if len(self._items) >= self._maxsize or self._sample_skipped < self._sample_every - 1:
+                self._sample_skipped += 1
+                self._drop(item)
+                return False
+            self._sample_skipped = 0
+        elif len(self._items) >= self._maxsize:
+            if self._overflow == OVERFLOW_DROP_NEWEST:
+                self._drop(item)
+                return False
+            elif self._overflow == OVERFLOW_DROP_OLDEST:
+                self._drop(self._items.popleft())
+            elif not self._blocked:
+                self._blocked = True
+                if self._on_full is not None:
+                    self._on_full(self)
+        self._items.append(item)
+        self.put_count += 1
+        self._wakeup()
+        return True
+
+    def _drop(self, item):
+        self.dropped += 1
+        if self._on_drop is not None:
+            self._on_drop(item)
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _unblock(self):
+        if self._blocked:
+            self._blocked = False
+            if self._on_drain is not None:
+                self._on_drain(self)
+
+    def get_nowait(self):
+        item = self._items.popleft()
+        if self._blocked and len(self._items) <= self._low_watermark:
+            self._unblock()
+        return item
+
+    async def get(self):
+        while not self._items:
+            if self._closed:
+                raise PushQueueClosed
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self.get_nowait()
+
+    def close(self):
+        # Items already in queue can still be consumed
+        self._closed = True
+        self._unblock()
+        self._wakeup()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.get()
+        except PushQueueClosed:
+            raise StopAsyncIteration
@@ -1,37 +1,58 @@
 import asyncio
-import calendar
+import collections
+import functools
 import json
+import logging
 import os
+import string
 import struct
 import time
 import uuid
 import zlib
-from datetime import datetime
-from os import getcwd
-from os.path import relpath
-from urllib.parse import urlsplit, parse_qs
+from datetime import datetime, timedelta
 
-from dateutil.relativedelta import relativedelta
 from gmqtt import Client
 from gmqtt.client import logger
 from gmqtt.mqtt.connection import MQTTConnection
 from gmqtt.mqtt.constants import MQTTCommands
 from gmqtt.mqtt.handler import _empty_callback
 from gmqtt.mqtt.package import PackageFactory
-from gmqtt.mqtt.protocol import MQTTProtocol
+from gmqtt.mqtt.protocol import BaseMQTTProtocol, MQTTProtocol
 from gmqtt.mqtt.utils import pack_variable_byte_integer
-from thriftpy.protocol import TCompactProtocol
-from thriftpy.transport import TMemoryBuffer
-import thriftpy
+from gmqtt.storage import BasePersistentStorage
+
+from .delivery import PushQueue, OVERFLOW_BLOCK
+from .reconnect import ReconnectPolicy
+from .metrics import get_default_metrics
+from .timers import get_keepalive_wheel
+from .tls import FBNSSSLContext, get_default_ssl_context
 
 ABSOLUTE_PATH = lambda x: os.path.abspath(os.path.join(os.path.abspath(os.path.dirname(__file__)), x))
 
+THRIFT_SCHEMA_PATH = ABSOLUTE_PATH('connect.thrift')
+
+_thrift = None
+
+
+def get_thrift():
+    # Schema is parsed on first CONNECT, not at import time
+    global _thrift
+    if _thrift is None:
+        import thriftpy
+        _thrift = thriftpy.load(THRIFT_SCHEMA_PATH, module_name='connect_thrift')
+    return _thrift
+
 
-file_path_rel = relpath(ABSOLUTE_PATH('connect.thrift'), getcwd())
-thrift = thriftpy.load(file_path_rel, module_name="connect_thrift")
+def __getattr__(name):
+    # Backward compatibility for module level `thrift` attribute
+    if name == 'thrift':
+        return get_thrift()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
 
 
 class FBNSAuth(object):
+    __slots__ = ('userId', 'password', 'deviceSecret', 'deviceId', 'clientId', '_connect_template')
+
     def __init__(self, data={}):
         self.userId = int(data.get('ck', 0))
         self.password = data.get('cs', '')
@@ -43,70 +64,272 @@ class FBNSAuth(object):
         else:
             self.clientId = str(uuid.uuid4())[20:]
 
+        self._connect_template = None
+
+    def as_dict(self):
+        # Same keys as CONNACK credentials, FBNSAuth(auth.as_dict()) is equal to auth
+        return {'ck': self.userId, 'cs': self.password, 'ds': self.deviceSecret, 'di': self.deviceId}
+
 
-def _spop(d, k):
-    if k in d:
-        return d.pop(k)
-    return None
+_FBNS_PUSH_KEYS = frozenset(('token', 'ck', 'pn', 'cp', 'fbpushnotif', 'nid', 'bu', 'view_id', 'num_endpoints'))
 
 
 class FBNSPush(object):
+    __slots__ = ('token', 'connectionKey', 'packageName', 'collapseKey', 'payload', 'notificationId',
+                 'isBuffered', 'viewId', 'numEndpoints', '_notification')
+
     def __init__(self, data):
-        self.token = _spop(data, 'token')
-        self.connectionKey = _spop(data, 'ck')
-        self.packageName = _spop(data, 'pn')
-        self.collapseKey = _spop(data, 'cp')
-        self.payload = _spop(data, 'fbpushnotif')
-        self.notificationId = _spop(data, 'nid')
-        self.isBuffered = _spop(data, 'bu')
-        self.viewId = _spop(data, 'view_id')
-        self.numEndpoints = _spop(data, 'num_endpoints')
+        if not _FBNS_PUSH_KEYS.issuperset(data):
+            unexpected = {k: v for k, v in data.items() if k not in _FBNS_PUSH_KEYS}
+            raise Exception('FBNSPush unexpected data: {unexpected}'.format(**locals()))
+
+        get = data.get
+        self.token = get('token')
+        self.connectionKey = get('ck')
+        self.packageName = get('pn')
+        self.collapseKey = get('cp')
+        self.payload = get('fbpushnotif')
+        self.notificationId = get('nid')
+        self.isBuffered = get('bu')
+        self.viewId = get('view_id')
+        self.numEndpoints = get('num_endpoints')
+        self._notification = None
+
+    @property
+    def notification(self):
+        # fbpushnotif JSON is decoded on first access
+        if self._notification is None and self.payload:
+            self._notification = json.loads(self.payload)
+        return self._notification
+
+    def __repr__(self):
+        return '<FBNSPush nid={} cp={}>'.format(self.notificationId, self.collapseKey)
+
+
+USER_AGENT = '[FBAN/MQTT;FBAV/64.0.0.14.96;FBBV/125398467;FBDM/{density=4.0,width=1440,height=2392};FBLC/en_US;FBCR/;FBMF/LGE;FBBD/lge;FBPN/com.instagram.android;FBDV/RS988;FBSV/6.0.1;FBLR/0;FBBK/1;FBCA/armeabi-v7a:armeabi;]'
+APP_ID = 567310203415052
+
+DEFAULT_COMPRESSION_LEVEL = 9
+
+# Limits of received PUBLISH packet on the wire and of its decompressed payload, None - no limit
+DEFAULT_MAX_PACKET_SIZE = 1024 * 1024
+DEFAULT_MAX_PAYLOAD_SIZE = 1024 * 1024
+
+# Python heap of one idle lean session, see tests/test_session_memory.py
+LEAN_SESSION_BYTES = 16384
+
+# Seconds to wait for PINGRESP before the first round trip is measured, and lower bound after that
+PING_TIMEOUT = 30.0
+MIN_PING_TIMEOUT = 5.0
+
+
+def _session_id():
+    # Milliseconds since last Monday 00:00
+    now = datetime.now()
+    last_monday = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int((now.timestamp() - last_monday.timestamp()) * 1000)
+
+
+def _compact_i64(n):
+    # Thrift compact protocol i64 value: zigzag encoded varint
+    n = (n << 1) ^ (n >> 63)
+    out = bytearray()
+    while n & ~0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
 
-        if data:
-            raise Exception('FBNSPush unexpected data: {data}'.format(**locals))
+
+# ClientInfo fields equal for all devices
+_CLIENT_INFO_CONSTANTS = (
+    ('userAgent', USER_AGENT),
+    ('clientCapabilities', 439),
+    ('endpointCapabilities', 128),
+    ('publishFormat', 1),
+    ('noAutomaticForeground', True),
+    ('makeUserAvailableInForeground', False),
+    ('isInitiallyForeground', False),
+    ('networkType', 1),
+    ('networkSubtype', 0),
+    ('clientType', 'device_auth'),
+    ('appId', APP_ID),
+    ('clientStack', 3),
+)
+
+
+def serialize_connect(fbns_auth, session_id):
+    from thriftpy.protocol import TCompactProtocol
+    from thriftpy.transport import TMemoryBuffer
+
+    thrift = get_thrift()
+
+    connect_payload = thrift.Connect()
+    connect_payload.clientIdentifier = fbns_auth.clientId
+
+    client_info = thrift.ClientInfo()
+    for name, value in _CLIENT_INFO_CONSTANTS:
+        setattr(client_info, name, value)
+    client_info.userId = fbns_auth.userId
+    client_info.deviceId = fbns_auth.deviceId
+    client_info.clientMqttSessionId = session_id
+    client_info.subscribeTopics = [int(FBNSMQTTClient.MESSAGE_TOPIC_ID), int(FBNSMQTTClient.REG_RESP_TOPIC_ID)]
+    client_info.deviceSecret = fbns_auth.deviceSecret
+
+    connect_payload.clientInfo = client_info
+    connect_payload.password = fbns_auth.password
+
+    trans = TMemoryBuffer()
+    p = TCompactProtocol(trans)
+    p.write_struct(connect_payload)
+    return trans.getvalue()
+
+
+def deserialize_connect(data):
+    from thriftpy.protocol import TCompactProtocol
+    from thriftpy.transport import TMemoryBuffer
+
+    connect_payload = get_thrift().Connect()
+    TCompactProtocol(TMemoryBuffer(data)).read_struct(connect_payload)
+    return connect_payload
+
+
+class FBNSConnectTemplate(object):
+    # Serialized CONNECT payload of one FBNSAuth split around clientMqttSessionId,
+    # the only field that changes between connects. Compressed once per connect.
+    __slots__ = ('key', '_head', '_tail', '_compression_level')
+
+    def __init__(self, fbns_auth, compression_level):
+        self.key = self.make_key(fbns_auth, compression_level)
+        self._compression_level = compression_level
+
+        # Session id 0 and 1 are both encoded in one byte, so the difference
+        # between two serializations is exactly the session id value
+        data0 = serialize_connect(fbns_auth, 0)
+        data1 = serialize_connect(fbns_auth, 1)
+        pos = 0
+        while data0[pos] == data1[pos]:
+            pos += 1
+
+        self._head = data0[:pos]
+        self._tail = data0[pos + 1:]
+
+    @staticmethod
+    def make_key(fbns_auth, compression_level):
+        return (fbns_auth.clientId, fbns_auth.userId, fbns_auth.password, fbns_auth.deviceId,
+                fbns_auth.deviceSecret, compression_level)
+
+    def build(self, session_id):
+        return zlib.compress(self._head + _compact_i64(session_id) + self._tail, self._compression_level)
+
+
+class FBNSDecodeError(Exception):
+    pass
+
+
+class FBNSPayloadTooLarge(FBNSDecodeError):
+    pass
+
+
+def decompress_payload(payload, max_size=None):
+    # Inflates at most max_size bytes (None - no limit), larger payloads raise FBNSPayloadTooLarge
+    # before the rest is decompressed. payload is any bytes-like object, e.g. memoryview of a packet.
+    if max_size is None:
+        return zlib.decompress(payload)
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload, max_size)
+    if not decompressor.eof:
+        # Output stopped at max_size with input left or more output pending, otherwise the stream is cut short
+        if decompressor.unconsumed_tail or (len(data) == max_size and decompressor.decompress(b'', 1)):
+            raise FBNSPayloadTooLarge('Payload of {} compressed bytes inflates over {} bytes'.format(
+                len(payload), max_size))
+        raise zlib.error('Error -5 while decompressing data: incomplete or truncated stream')
+    return data
+
+
+def decode_payload(payload, max_size=None):
+    return json.loads(decompress_payload(payload, max_size))
+
+
+# Characters JSON encoders write as is. Others may be escaped (\/, \u003c for HTML safe output, \uXXXX
+# for non-ASCII), so values containing them can't be found as plain bytes. Encoders escaping these
+# characters too would make the prefilter drop matching pushes.
+_PREFILTER_CHARS = frozenset(string.ascii_letters + string.digits + '_-.')
+
+
+def _push_prefilter(values):
+    # Byte strings one of which a decompressed push matching values must contain, None if that can't be
+    # told without decoding: None is allowed or a value could be escaped in JSON
+    if values is None:
+        return None
+    needles = []
+    for value in values:
+        if not isinstance(value, str) or not value or not _PREFILTER_CHARS.issuperset(value):
+            return None
+        needles.append(value.encode('ascii'))
+    return tuple(needles)
+
+
+def _prefilter_match(data, prefilter):
+    # prefilter is a tuple of needle groups, every group needs one of its needles in data
+    for needles in prefilter:
+        if not any(needle in data for needle in needles):
+            return False
+    return True
+
+
+def _decode_timed(payload, max_size=None, prefilter=None):
+    # Returns decoded payload, decompressed size, decompress and json decode time.
+    # Payload is None when decompressed data does not pass prefilter and json is not decoded.
+    started = time.perf_counter()
+    data = decompress_payload(payload, max_size)
+    decompressed = time.perf_counter()
+    if prefilter is not None and not _prefilter_match(data, prefilter):
+        return None, len(data), decompressed - started, 0.0
+    result = json.loads(data)
+    return result, len(data), decompressed - started, time.perf_counter() - decompressed
+
+
+def _decode_batch(payloads, max_size=None, prefilters=None):
+    # Executed in thread or process pool. Errors are returned in place of
+    # results to keep batch order, json errors are not picklable.
+    # prefilters has a prefilter or None for every payload.
+    results = []
+    if prefilters is None:
+        prefilters = [None] * len(payloads)
+    for payload, prefilter in zip(payloads, prefilters):
+        try:
+            results.append(_decode_timed(payload, max_size, prefilter))
+        except FBNSPayloadTooLarge as e:
+            results.append(e)
+        except Exception as e:
+            results.append(FBNSDecodeError(repr(e)))
+    return results
+
+
+def _close_callback_item(item):
+    # Dropped coroutine callback must be closed to avoid "never awaited" warning
+    if asyncio.iscoroutine(item):
+        item.close()
 
 
 class FBNSConnectPackageFactor(PackageFactory):
+    compression_level = DEFAULT_COMPRESSION_LEVEL
+
     @classmethod
-    def build_package(cls, fbns_auth: FBNSAuth, clean_session, keepalive, protocol, will_message=None, **kwargs):
-        keepalive = 900
-
-        connect_payload = thrift.Connect()
-        connect_payload.clientIdentifier = fbns_auth.clientId
-
-        client_info = thrift.ClientInfo()
-        client_info.userId = fbns_auth.userId
-        client_info.userAgent = '[FBAN/MQTT;FBAV/64.0.0.14.96;FBBV/125398467;FBDM/{density=4.0,width=1440,height=2392};FBLC/en_US;FBCR/;FBMF/LGE;FBBD/lge;FBPN/com.instagram.android;FBDV/RS988;FBSV/6.0.1;FBLR/0;FBBK/1;FBCA/armeabi-v7a:armeabi;]'
-        client_info.clientCapabilities = 439
-        client_info.endpointCapabilities = 128
-        client_info.publishFormat = 1
-        client_info.noAutomaticForeground = True
-        client_info.makeUserAvailableInForeground = False
-        client_info.deviceId = fbns_auth.deviceId
-        client_info.isInitiallyForeground = False
-        client_info.networkType = 1
-        client_info.networkSubtype = 0
-
-        last_monday = datetime.now() - relativedelta(weekday=calendar.MONDAY, hour=0, minute=0, second=0, microsecond=0)
-        last_monday = last_monday.timestamp()
-        session_id = int((time.time() - last_monday) * 1000)
-
-        client_info.clientMqttSessionId = session_id
-        client_info.subscribeTopics = [int(FBNSMQTTClient.MESSAGE_TOPIC_ID), int(FBNSMQTTClient.REG_RESP_TOPIC_ID)]
-        client_info.clientType = 'device_auth'
-        client_info.appId = 567310203415052  # Const
-        client_info.deviceSecret = fbns_auth.deviceSecret
-        client_info.clientStack = 3
-
-        connect_payload.clientInfo = client_info
-        connect_payload.password = fbns_auth.password
-
-        trans = TMemoryBuffer()
-        p = TCompactProtocol(trans)
-        p.write_struct(connect_payload)
-
-        data = trans.getvalue()
-        prop_bytes = zlib.compress(data, level=9)
+    def get_template(cls, fbns_auth, compression_level):
+        template = fbns_auth._connect_template
+        if template is None or template.key != FBNSConnectTemplate.make_key(fbns_auth, compression_level):
+            template = FBNSConnectTemplate(fbns_auth, compression_level)
+            fbns_auth._connect_template = template
+        return template
+
+    @classmethod
+    def build_package(cls, fbns_auth: FBNSAuth, clean_session, keepalive, protocol, will_message=None,
+                      compression_level=None, **kwargs):
+        if compression_level is None:
+            compression_level = cls.compression_level
+        prop_bytes = cls.get_template(fbns_auth, compression_level).build(_session_id())
 
         remaining_length = 2 + len(protocol.proto_name) + 1 + 1 + 2
 
@@ -141,25 +364,197 @@ class FBNSMQTTProtocol(MQTTProtocol):
     proto_name = b'MQTToT'
     proto_ver = 3
 
+    def __init__(self, *args, max_packet_size=DEFAULT_MAX_PACKET_SIZE, **kwargs):
+        # MQTTProtocol.__init__ only adds a queue and an event which are never used
+        BaseMQTTProtocol.__init__(self, *args, **kwargs)
+        self._read_loop_future = None
+        self.max_packet_size = max_packet_size
+        # Set while packets may be read, created on the first pause
+        self._reading = None
+
+    def connection_lost(self, exc):
+        BaseMQTTProtocol.connection_lost(self, exc)
+        self._connection.cancel_timers()
+        self._connection.put_package((MQTTCommands.DISCONNECT, b''))
+        if self._read_loop_future is not None:
+            self._read_loop_future.cancel()
+            self._read_loop_future = None
+
+    async def _read_loop(self):
+        # Packet body is read at once instead of concatenating chunks. Packets over max_packet_size
+        # are not read, connection is closed like MQTT 5 client does on exceeded Maximum Packet Size.
+        await self._connected.wait()
+        reader = self._stream_reader
+        try:
+            while self._connected.is_set():
+                command, byte = await reader.readexactly(2)
+                remaining_length = byte & 127
+                multiplier = 128
+                while byte & 128:
+                    if multiplier > 128 ** 3:
+                        logger.warning('[MQTT ERR PROTO] RECV MORE THAN 4 bytes for remaining length.')
+                        self._transport.close()
+                        return
+                    byte, = await reader.readexactly(1)
+                    remaining_length += (byte & 127) * multiplier
+                    multiplier *= 128
+                if self.max_packet_size is not None and remaining_length > self.max_packet_size:
+                    self._connection.reject_packet(command, remaining_length)
+                    return
+                packet = await reader.readexactly(remaining_length) if remaining_length else b''
+                self._connection.put_package((command, packet))
+                if self._reading is not None and not self._reading.is_set():
+                    await self._reading.wait()
+        except asyncio.IncompleteReadError:
+            logger.debug("[RECV EMPTY] Connection will be reset automatically.")
+            if not self._transport.is_closing():
+                self._transport.close()
+
+    def pause_read_loop(self):
+        # Stops parsing packets after the current one. Data left unread fills the StreamReader buffer,
+        # which pauses the transport itself, so the socket is not read either.
+        if self._reading is None:
+            self._reading = asyncio.Event()
+        self._reading.clear()
+
+    def resume_read_loop(self):
+        if self._reading is not None:
+            self._reading.set()
+
     async def send_auth_package(self, fbns_auth, clean_session, keepalive, will_message=None, **kwargs):
         pkg = FBNSConnectPackageFactor.build_package(fbns_auth, clean_session, keepalive, self, will_message=will_message, **kwargs)
         self.write_data(pkg)
 
 
 class FBNSMQTTConnection(MQTTConnection):
+    ping_sent_at = None
+    # Smoothed PINGREQ->PINGRESP round trip time, client seeds it from the previous connection
+    srtt = None
+
+    def __init__(self, transport, protocol, clean_session, keepalive):
+        # Same as MQTTConnection.__init__ without unused packet queue,
+        # keepalive timers of all connections are driven by one timer wheel of the event loop
+        self._transport = transport
+        self._protocol = protocol
+        self._protocol.set_connection(self)
+
+        self._clean_session = clean_session
+        self._keepalive = keepalive
+
+        self._last_data_in = self._last_data_out = time.monotonic()
+
+        self._wheel = get_keepalive_wheel()
+        self._ping_timeout_callback = None
+        self._keep_connection_callback = None
+        # keepalive 0 disables PINGREQ as in MQTT
+        if keepalive > 0:
+            self._keep_connection_callback = self._wheel.schedule(self.ping_interval, self._keep_connection)
+
     @classmethod
-    async def create_connection(cls, host, port, ssl, clean_session, keepalive, loop=None):
+    async def create_connection(cls, host, port, ssl, clean_session, keepalive, loop=None,
+                                max_packet_size=DEFAULT_MAX_PACKET_SIZE):
         loop = loop or asyncio.get_event_loop()
-        transport, protocol = await loop.create_connection(FBNSMQTTProtocol, host, port, ssl=ssl)
-        return FBNSMQTTConnection(transport, protocol, clean_session, keepalive)
+        if ssl is True:
+            # One context for all connections instead of a new default context per connection
+            ssl = get_default_ssl_context()
+        transport, protocol = await loop.create_connection(
+            functools.partial(FBNSMQTTProtocol, max_packet_size=max_packet_size), host, port, ssl=ssl)
+        connection = FBNSMQTTConnection(transport, protocol, clean_session, keepalive)
+        if isinstance(ssl, FBNSSSLContext):
+            ssl.handshake_done(transport.get_extra_info('ssl_object'))
+        return connection
+
+    def save_tls_session(self):
+        # Keeps TLS 1.3 session ticket received after the handshake for the next connection
+        ssl_object = self._transport.get_extra_info('ssl_object')
+        if ssl_object is not None and isinstance(ssl_object.context, FBNSSSLContext):
+            ssl_object.context.save_session(ssl_object)
 
     async def auth(self, fbns_auth, will_message=None, **kwargs):
         await self._protocol.send_auth_package(fbns_auth, self._clean_session,
                                                self._keepalive, will_message=will_message, **kwargs)
 
+    def pause_reading(self):
+        self._protocol.pause_read_loop()
+
+    def resume_reading(self):
+        self._protocol.resume_read_loop()
+
+    @property
+    def ping_interval(self):
+        # PINGREQ is sent this long after the last packet in either direction. Twice the round trip time
+        # (1 second until it's measured, at most a quarter of keepalive) is left to reach the server in time
+        margin = 2 * self.srtt if self.srtt is not None else 1.0
+        return max(self._keepalive - min(margin, self._keepalive / 4), 1.0)
+
+    @property
+    def ping_timeout(self):
+        # Connection is closed and reconnected when PINGRESP doesn't arrive this long after PINGREQ
+        timeout = max(4 * self.srtt, MIN_PING_TIMEOUT) if self.srtt is not None else PING_TIMEOUT
+        return min(timeout, max(self._keepalive / 2, MIN_PING_TIMEOUT))
+
+    def put_package(self, pkg):
+        self._last_data_in = time.monotonic()
+        self._handler(*pkg)
+
+    def reject_packet(self, command, length):
+        logger.error('[MQTT ERR] %s byte packet %s is over max_packet_size, closing connection', length, hex(command))
+        self._handler.on_packet_too_large(command, length)
+        self._transport.close()
+
+    def send_package(self, package):
+        self._last_data_out = time.monotonic()
+        super().send_package(package)
+
+    def _send_ping_request(self):
+        self.ping_sent_at = time.monotonic()
+        super()._send_ping_request()
+        self._ping_timeout_callback = self._wheel.schedule(self.ping_timeout, self._check_pingresp, jitter=0)
+
+    def pingresp_received(self):
+        # Returns round trip time of the last PINGREQ, None if it wasn't sent by this connection
+        if self.ping_sent_at is None:
+            return None
+        rtt = time.monotonic() - self.ping_sent_at
+        self.ping_sent_at = None
+        if self._ping_timeout_callback is not None:
+            self._ping_timeout_callback.cancel()
+            self._ping_timeout_callback = None
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        return rtt
+
+    def _check_pingresp(self):
+        self._ping_timeout_callback = None
+        if self.ping_sent_at is not None and not self.is_closing():
+            logger.warning('[KEEP ALIVE] no PINGRESP in %.1f seconds, closing connection',
+                           time.monotonic() - self.ping_sent_at)
+            self._transport.close()
+
     def _keep_connection(self):
-        super()._keep_connection()
-        logger.debug('[KEEP ALIVE]')
+        # Checks idle time, the next check is due when the connection becomes idle for ping_interval
+        self._keep_connection_callback = None
+        if self.is_closing():
+            return
+        interval = self.ping_interval
+        idle = time.monotonic() - min(self._last_data_in, self._last_data_out)
+        if idle >= interval - self._wheel.resolution:
+            if self.ping_sent_at is None:
+                logger.debug('[KEEP ALIVE] idle for %.1f seconds', idle)
+                self._send_ping_request()
+            delay = interval
+        else:
+            delay = interval - idle
+        self._keep_connection_callback = self._wheel.schedule(delay, self._keep_connection)
+
+    def cancel_timers(self):
+        for callback in (self._keep_connection_callback, self._ping_timeout_callback):
+            if callback is not None:
+                callback.cancel()
+        self._keep_connection_callback = self._ping_timeout_callback = None
+
+    async def close(self):
+        self.cancel_timers()
+        self._transport.close()
 
 
 FBNSConnAckReturnCodes = {
@@ -190,6 +585,37 @@ FBNSConnAckReturnCodes = {
 }
 
 
+class NullPersistentStorage(BasePersistentStorage):
+    # Keeps nothing, one instance is shared by all lean clients
+    def push_message_nowait(self, mid, raw_package):
+        return None
+
+    async def push_message(self, mid, raw_package):
+        pass
+
+    async def pop_message(self):
+        return None
+
+    async def remove_message_by_mid(self, mid):
+        pass
+
+    @property
+    async def is_empty(self):
+        return True
+
+    async def wait_empty(self):
+        pass
+
+
+NULL_STORAGE = NullPersistentStorage()
+
+
+@functools.lru_cache(maxsize=None)
+def _register_payload(package_name, app_id, compression_level):
+    message = json.dumps(dict(pkg_name=package_name, appid=app_id))
+    return zlib.compress(message.encode('utf8'), compression_level)
+
+
 class FBNSMQTTClient(Client):
     # MQTT Constants.
     PACKAGE_NAME = 'com.instagram.android'
@@ -206,9 +632,82 @@ class FBNSMQTTClient(Client):
     REG_RESP_TOPIC = '/fbns_reg_resp'
     REG_RESP_TOPIC_ID = '80'
 
-    def __init__(self, *args, **kwargs):
+    # Process wide ConnectRateLimiter shared by all clients, None - no limit
+    connect_rate_limiter = None
+
+    def __init__(self, *args, compression_level=DEFAULT_COMPRESSION_LEVEL,
+                 decode_executor=None, decode_threshold=4096, decode_batch_size=64,
+                 callback_queue_size=1000, callback_overflow=OVERFLOW_BLOCK, deduplicator=None,
+                 reconnect_policy=None, metrics=None, lean=False, state_store=None, account_id=None,
+                 registration=None, max_packet_size=DEFAULT_MAX_PACKET_SIZE,
+                 max_payload_size=DEFAULT_MAX_PAYLOAD_SIZE, capture=None, tracer=None, **kwargs):
+        # Lean sessions trade QoS 1 redelivery for memory: no per client message storage and resend task.
+        # /fbns_reg_req is published again after every CONNACK anyway.
+        if lean:
+            kwargs.setdefault('persistent_storage', NULL_STORAGE)
         super().__init__(client_id='', *args, **kwargs)
+        self._lean = lean
         self.fbns_auth = FBNSAuth()
+        self._compression_level = compression_level
+
+        # fbns_mqtt.state.StateStore, received credentials and token are saved under account_id,
+        # fbns_mqtt.registration.TokenRegistration registers received tokens in background
+        if (state_store is not None or registration is not None) and account_id is None:
+            raise ValueError('account_id is required with state_store and registration')
+        self._state_store = state_store
+        self._registration = registration
+        self._account_id = account_id
+
+        # Aggregated FBNSMetrics shared between clients (default registry if None, False disables)
+        # and per connection counters
+        self._metrics = get_default_metrics() if metrics is None else (metrics or None)
+        self.stats = collections.Counter()
+        self.ping_rtt = None
+
+        self._reconnect_policy = reconnect_policy or ReconnectPolicy()
+        self._reconnect_attempts = 0
+        self._reconnecting = False
+        self._last_connack_code = None
+
+        # Payloads of decode_threshold bytes and more are decoded in decode_executor,
+        # messages received while a batch is in flight are queued behind it to keep order
+        self._decode_executor = decode_executor
+        self._decode_threshold = decode_threshold
+        self._decode_batch_size = decode_batch_size
+        self._decode_pending = collections.deque() if decode_executor is not None else None
+        self._decode_task = None
+
+        # Larger packets close the connection, payloads decompressing to more than max_payload_size
+        # are acknowledged and dropped without being inflated
+        self._max_packet_size = max_packet_size
+        self._max_payload_size = max_payload_size
+
+        # fbns_mqtt.capture.CaptureWriter, received topics and payloads are recorded for replay
+        self.capture = capture
+        # fbns_mqtt.tracing.Tracer, sampled messages are timed by stage, None - no tracing
+        self._tracer = tracer
+        self.current_trace = None
+
+        self._push_filter_keys = None
+        self._push_filter_packages = None
+        self._push_prefilter = None
+        self._push_handlers = {}
+        self.pushes_delivered = collections.Counter()
+        self.pushes_dropped = collections.Counter()
+        self.pushes_duplicated = collections.Counter()
+
+        # PushDeduplicator, drops pushes redelivered after reconnect
+        self._deduplicator = deduplicator
+
+        # Coroutine callbacks and pushes() iterators are fed through bounded queues,
+        # full OVERFLOW_BLOCK queues pause reading from the socket.
+        # Callback queue is created with the first coroutine callback.
+        self._callback_queue = None
+        self._callback_queue_size = callback_queue_size
+        self._callback_overflow = callback_overflow
+        self._callback_task = None
+        self._push_queues = []
+        self._blocked_queues = 0
 
         self._on_fbns_token_callback = _empty_callback
         self._on_fbns_auth_callback = _empty_callback
@@ -244,81 +743,465 @@ class FBNSMQTTClient(Client):
             raise ValueError
         self._on_fbns_token_callback = cb
 
+    def pushes(self, maxsize=1000, overflow=OVERFLOW_BLOCK):
+        # async for push in client.pushes(): ...
+        # Iteration ends when the queue is closed with close()
+        queue = PushQueue(maxsize, overflow, on_full=self._pause_reading, on_drain=self._resume_reading)
+        self._push_queues.append(queue)
+        return queue
+
+    @property
+    def reading_paused(self):
+        # True while a full pushes() or callback queue holds back reading from the socket
+        return self._blocked_queues > 0
+
+    def _pause_reading(self, queue):
+        self._blocked_queues += 1
+        if self._blocked_queues == 1 and self._connection is not None:
+            logger.debug('[PAUSE READING] consumer queue is full')
+            self._connection.pause_reading()
+
+    def _resume_reading(self, queue):
+        self._blocked_queues -= 1
+        if self._blocked_queues == 0 and self._connection is not None:
+            logger.debug('[RESUME READING]')
+            self._connection.resume_reading()
+
+    def _run_callback(self, callback, *args):
+        # Plain callbacks are called in place, coroutines are awaited one by one in callback worker
+        if asyncio.iscoroutinefunction(callback):
+            item = (callback, args)
+        else:
+            item = callback(*args)
+            if not asyncio.iscoroutine(item):
+                return
+        if self._callback_queue is None:
+            self._callback_queue = PushQueue(self._callback_queue_size, self._callback_overflow,
+                                             on_full=self._pause_reading, on_drain=self._resume_reading,
+                                             on_drop=_close_callback_item)
+        if self._callback_queue.put(item) and self._callback_task is None:
+            self._callback_task = asyncio.ensure_future(self._callback_worker())
+
+    async def _callback_worker(self):
+        try:
+            while len(self._callback_queue):
+                item = self._callback_queue.get_nowait()
+                try:
+                    if isinstance(item, tuple):
+                        callback, args = item
+                        item = callback(*args)
+                    await item
+                except Exception as exc:
+                    logger.error('[ERROR IN CALLBACK]', exc_info=exc)
+        finally:
+            self._callback_task = None
+
+    async def drain(self, timeout=None):
+        # Waits for pushes still decoded in executor and queued coroutine callbacks,
+        # e.g. after disconnect(). Returns False if they are not done in timeout seconds
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            tasks = [task for task in (self._decode_task, self._callback_task) if task is not None]
+            if not tasks:
+                return True
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            await asyncio.wait(tasks, timeout=remaining)
+
+    def set_push_filter(self, collapse_keys=None, package_names=None):
+        # Pushes not matching the filter are dropped before FBNSPush is built, None disables the filter.
+        # Payloads are zlib compressed as a whole, so a push is always inflated. Pushes which don't contain
+        # any of the wanted keys and package names as plain bytes are dropped before json is decoded,
+        # unless a value has characters other than ASCII letters, digits, '_', '-' and '.'.
+        self._push_filter_keys = frozenset(collapse_keys) if collapse_keys is not None else None
+        self._push_filter_packages = frozenset(package_names) if package_names is not None else None
+        prefilter = [_push_prefilter(self._push_filter_keys), _push_prefilter(self._push_filter_packages)]
+        prefilter = tuple(needles for needles in prefilter if needles is not None)
+        self._push_prefilter = prefilter or None
+
+    def add_push_handler(self, collapse_key, handler):
+        # Pushes with this collapse key go to handler instead of on_fbns_message
+        if not callable(handler):
+            raise ValueError
+        self._push_handlers[collapse_key] = handler
+
+    def remove_push_handler(self, collapse_key):
+        self._push_handlers.pop(collapse_key, None)
+
+    def _handle_packet(self, cmd, packet):
+        # Same as base handler without formatting debug message of every packet when debug is off
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('[CMD %s] %s', hex(cmd), packet)
+        self.__get_handler__(cmd)(cmd, packet)
+        self._last_msg_in = time.monotonic()
+
+    def _handle_publish_packet(self, cmd, raw_packet):
+        # MQTT 3 PUBLISH without properties, payload is a memoryview of the packet instead of slice copies
+        qos = (cmd & 0x06) >> 1
+        topic_length, = struct.unpack_from('!H', raw_packet)
+        offset = 2 + topic_length
+        if not topic_length:
+            logger.warning('[MQTT ERR PROTO] topic name is empty')
+            return
+        topic = str(raw_packet[2:offset], 'utf8', 'replace')
+        payload = memoryview(raw_packet)[offset:]
+        if qos == 0:
+            self.on_message(self, topic, payload, qos, {})
+            return
+        mid, = struct.unpack_from('!H', raw_packet, offset)
+        payload = payload[2:]
+        if qos == 1:
+            self._handle_qos_1_publish_packet(mid, payload, topic, {})
+        else:
+            self._handle_qos_2_publish_packet(mid, payload, topic, {})
+
     def on_message(self, _, topic, payload, qos, properties):
-        payload = zlib.decompress(payload)
-        payload = json.loads(payload)
+        if self.capture is not None:
+            self.capture.write(topic, payload)
+        self.stats['messages'] += 1
+        self.stats['bytes_compressed'] += len(payload)
+        metrics = self._metrics
+        if metrics is not None:
+            metrics.messages.inc((topic,))
+            metrics.bytes_compressed.inc(amount=len(payload))
+
+        trace = None
+        if self._tracer is not None:
+            trace = self._tracer.start_trace('fbns_message')
+            if trace is not None:
+                trace.attributes.update(topic=topic, size=len(payload), account_id=self._account_id)
+
+        prefilter = self._push_prefilter if topic == self.MESSAGE_TOPIC_ID else None
+        if self._decode_executor is not None and (self._decode_task is not None or
+                                                  len(payload) >= self._decode_threshold):
+            # Queued payload outlives the packet, process pools need it picklable
+            self._decode_pending.append((topic, bytes(payload), trace, prefilter))
+            if self._decode_task is None:
+                self._decode_task = asyncio.ensure_future(self._decode_worker())
+            return
+        try:
+            decoded = _decode_timed(payload, self._max_payload_size, prefilter)
+        except FBNSPayloadTooLarge as exc:
+            self._on_payload_too_large(topic, exc, trace)
+            return
+        self._dispatch_decoded(topic, decoded, trace)
+
+    def _on_payload_too_large(self, topic, exc, trace=None):
+        logger.warning('[DECODE ERROR] %s %s', topic, exc)
+        self.stats['payloads_too_large'] += 1
+        if self._metrics is not None:
+            self._metrics.rejected.inc(('payload',))
+        if trace is not None:
+            trace.attributes['result'] = 'too_large'
+            self._tracer.finish(trace)
+
+    def on_packet_too_large(self, command, length):
+        self.stats['packets_too_large'] += 1
+        if self._metrics is not None:
+            self._metrics.rejected.inc(('packet',))
+
+    def _dispatch_decoded(self, topic, decoded, trace=None):
+        payload, size, decompress_time, json_time = decoded
+        self.stats['bytes_decompressed'] += size
+        if trace is not None:
+            self._dispatch_traced(topic, decoded, trace)
+            return
+        metrics = self._metrics
+        if metrics is None:
+            self._dispatch_message(topic, payload)
+            return
+        metrics.bytes_decompressed.inc(amount=size)
+        metrics.decompress_seconds.observe(decompress_time)
+        metrics.json_seconds.observe(json_time)
+        started = time.perf_counter()
+        self._dispatch_message(topic, payload)
+        metrics.dispatch_seconds.observe(time.perf_counter() - started)
+
+    def _dispatch_traced(self, topic, decoded, trace):
+        # Sampled message, plain callbacks can add spans to client.current_trace while it's dispatched
+        payload, size, decompress_time, json_time = decoded
+        trace.attributes['decompressed_size'] = size
+        trace.add_span('decompress', decompress_time)
+        trace.add_span('decode', json_time)
+        metrics = self._metrics
+        if metrics is not None:
+            metrics.bytes_decompressed.inc(amount=size)
+            metrics.decompress_seconds.observe(decompress_time)
+            metrics.json_seconds.observe(json_time)
+        self.current_trace = trace
+        started = time.perf_counter()
+        try:
+            trace.attributes['result'] = self._dispatch_message(topic, payload)
+        finally:
+            dispatch_time = time.perf_counter() - started
+            self.current_trace = None
+            trace.add_span('dispatch', dispatch_time)
+            if metrics is not None:
+                metrics.dispatch_seconds.observe(dispatch_time)
+            self._tracer.finish(trace)
+
+    async def _decode_worker(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self._decode_pending:
+                size = min(len(self._decode_pending), self._decode_batch_size)
+                batch = [self._decode_pending.popleft() for _ in range(size)]
+                started = time.perf_counter()
+                results = await loop.run_in_executor(self._decode_executor, _decode_batch,
+                                                     [payload for _, payload, _, _ in batch], self._max_payload_size,
+                                                     [prefilter for _, _, _, prefilter in batch])
+                executor_time = time.perf_counter() - started
+                for (topic, _, trace, _), decoded in zip(batch, results):
+                    if trace is not None:
+                        # Decompress and decode spans are measured in executor, this one includes them
+                        trace.add_span('executor', executor_time)
+                    if isinstance(decoded, FBNSPayloadTooLarge):
+                        self._on_payload_too_large(topic, decoded, trace)
+                        continue
+                    if isinstance(decoded, FBNSDecodeError):
+                        logger.error('[DECODE ERROR] %s %s', topic, decoded)
+                        if trace is not None:
+                            trace.attributes['result'] = 'error'
+                            self._tracer.finish(trace)
+                        continue
+                    try:
+                        self._dispatch_decoded(topic, decoded, trace)
+                    except Exception as exc:
+                        logger.error('[ERROR HANDLE PKG]', exc_info=exc)
+        finally:
+            self._decode_task = None
+
+    def _dispatch_message(self, topic, payload):
+        # Returns push result or message kind for tracing
         if topic == self.MESSAGE_TOPIC_ID:
-            push = FBNSPush(payload)
-            self._on_fbns_message(push)
+            return self._dispatch_push(payload)
         elif topic == self.REG_RESP_TOPIC_ID:
             self._on_fbns_register(payload)
-        else:
-            logger.debug('[UNKNOWN MESSAGE] {topic}, {payload}'.format(**locals()))
-
-    def _on_fbns_message(self, payload):
+            return 'register'
+        logger.debug('[UNKNOWN MESSAGE] %s, %s', topic, payload)
+        return 'unknown'
+
+    def _dispatch_push(self, data):
+        if data is None:
+            # Dropped by prefilter without decoding, collapse key is unknown
+            return self._drop_push(None)
+        collapse_key = data.get('cp')
+        notification = None
+        if collapse_key is None and (self._push_filter_keys is not None or self._push_handlers):
+            # No collapse key in envelope, take it from the notification itself
+            fbpushnotif = data.get('fbpushnotif')
+            if fbpushnotif:
+                notification = json.loads(fbpushnotif)
+                collapse_key = notification.get('collapse_key')
+
+        if (self._push_filter_keys is not None and collapse_key not in self._push_filter_keys) or \
+                (self._push_filter_packages is not None and data.get('pn') not in self._push_filter_packages):
+            return self._drop_push(collapse_key)
+
+        if self._deduplicator is not None:
+            push_id = data.get('nid')
+            if not push_id:
+                if notification is None and data.get('fbpushnotif'):
+                    notification = json.loads(data['fbpushnotif'])
+                push_id = notification.get('pi') if notification else None
+            if push_id and self._deduplicator.seen('{}:{}'.format(self.fbns_auth.clientId, push_id)):
+                self.pushes_duplicated[collapse_key] += 1
+                if self._metrics is not None:
+                    self._metrics.pushes.inc((collapse_key or '', 'duplicate'))
+                return 'duplicate'
+
+        push = FBNSPush(data)
+        push._notification = notification
+        self.pushes_delivered[collapse_key] += 1
+        if self._metrics is not None:
+            self._metrics.pushes.inc((collapse_key or '', 'delivered'))
+        self._on_fbns_message(push, collapse_key)
+        return 'delivered'
+
+    def _drop_push(self, collapse_key):
+        self.pushes_dropped[collapse_key] += 1
+        if self._metrics is not None:
+            self._metrics.pushes.inc((collapse_key or '', 'dropped'))
+        return 'dropped'
+
+    def _on_fbns_message(self, payload, collapse_key=None):
         # It's instagram event
-        logger.debug('[FBNS_MSG] {payload}'.format(**locals()))
-        self.on_fbns_message(payload)
+        logger.debug('[FBNS_MSG] %s', payload)
+        if self._push_queues:
+            for queue in self._push_queues:
+                queue.put(payload)
+            if any(queue.closed for queue in self._push_queues):
+                self._push_queues = [queue for queue in self._push_queues if not queue.closed]
+        handler = self._push_handlers.get(collapse_key, self.on_fbns_message)
+        self._run_callback(handler, payload)
 
     def _on_fbns_register(self, payload):
         # Sucsessuf registered in FBNS and we got notification token for Instagram API registration
         if payload.get('error', None):
             error = payload['error']
-            raise Exception('FBNS Register error message: {error}'.format(**logger))
+            raise Exception('FBNS Register error message: {error}'.format(error=error))
         token = payload.get('token')
-        logger.debug('[REG_RESP_TOPIC] {token}'.format(**locals()))
-        self.on_fbns_token(token)
+        logger.debug('[REG_RESP_TOPIC] %s', token)
+        if self._state_store is not None:
+            self._state_store.save_token(self._account_id, token)
+        if self._registration is not None:
+            self._registration.submit(self._account_id, token)
+        self._run_callback(self.on_fbns_token, token)
 
     async def _create_connection(self, host, port, ssl, clean_session, keepalive) -> FBNSMQTTConnection:
-        self._reconnect = True
-        connection = await FBNSMQTTConnection.create_connection(host, port, ssl, clean_session, keepalive)
+        if self.connect_rate_limiter is not None:
+            await self.connect_rate_limiter.acquire()
+        connection = await FBNSMQTTConnection.create_connection(host, port, ssl, clean_session, keepalive,
+                                                                max_packet_size=self._max_packet_size)
+        connection.srtt = self.ping_rtt
+        self.stats['connects'] += 1
+        if self._metrics is not None:
+            self._metrics.connects.inc()
         connection.set_handler(self)
+        if self._blocked_queues:
+            connection.pause_reading()
         return connection
 
     def _on_fbns_connack(self, flags, returncode, data):
         if returncode != 0:
             desc = FBNSConnAckReturnCodes.get(returncode, 'Unknown')
             raise Exception('Connack returncode: {returncode} - {desc}'.format(**locals()))
-        data = data.decode('utf8')
-        logger.debug('[FBNS CONNACK] {data}'.format(**locals()))
+        data = str(data, 'utf8')
+        logger.debug('[FBNS CONNACK] %s', data)
         data = json.loads(data)
-        self.on_fbns_auth(data)
+        # Received credentials are used on reconnect
+        self.fbns_auth = FBNSAuth(data)
+        if self._state_store is not None:
+            self._state_store.save_auth(self._account_id, data)
+        self._run_callback(self.on_fbns_auth, data)
         self._register()
 
     def _register(self):
-        message = json.dumps(dict(pkg_name=self.PACKAGE_NAME, appid=self.FACEBOOK_ANALYTICS_APPLICATION_ID))
-        payload = zlib.compress(message.encode('utf8'), level=9)
+        payload = _register_payload(self.PACKAGE_NAME, self.FACEBOOK_ANALYTICS_APPLICATION_ID,
+                                    self._compression_level)
         self.publish(self.REG_REQ_TOPIC, payload, qos=1)
 
+    async def _resend_qos_messages(self):
+        # Started from Client.__init__, lean sessions have nothing to resend
+        if not self._lean:
+            await super()._resend_qos_messages()
+
     def _handle_connack_packet(self, cmd, packet):
-        super()._handle_connack_packet(cmd, packet)
-        (flags, returncode) = struct.unpack("!BB", packet[:2])
+        # On error base handler stores MQTTConnectError for connect() and schedules reconnect(delay=True)
         if len(packet) < 2:
             raise Exception('Unexpected connack packet without payload')
+        packet = memoryview(packet)
+        super()._handle_connack_packet(cmd, packet)
+        (flags, returncode) = struct.unpack_from("!BB", packet)
+        self._last_connack_code = returncode
+        if self._metrics is not None:
+            self._metrics.connack.inc((str(returncode),))
+        if returncode != 0:
+            desc = FBNSConnAckReturnCodes.get(returncode, ['Unknown'])[0]
+            logger.error('[FBNS CONNACK] returncode: %s - %s', returncode, desc)
+            return
+        self._reconnect_attempts = 0
+        if self._connection is not None:
+            self._connection.save_tls_session()
         payload = packet[4:]
-        payload.decode('utf8')
         self._on_fbns_connack(flags, returncode, payload)
 
+    def _handle_pingresp_packet(self, cmd, packet):
+        super()._handle_pingresp_packet(cmd, packet)
+        connection = self._connection
+        rtt = connection.pingresp_received() if connection is not None else None
+        if rtt is not None:
+            self.ping_rtt = connection.srtt
+            if self._metrics is not None:
+                self._metrics.ping_rtt_seconds.observe(rtt)
+
+    async def reconnect(self, delay=False):
+        # Called by gmqtt with delay=True on lost connection and on CONNACK error, only one reconnect runs
+        # at a time. reconnect_policy decides how long to wait and when to give up, delay=False reconnects
+        # without waiting. No reconnects after disconnect() or a failed connect().
+        if self._reconnecting or not self._is_active:
+            return
+        self._reconnecting = True
+        try:
+            # Same state reset as gmqtt's _disconnect(), the connection is gone already
+            self._clear_topics_aliases()
+            self._connected.clear()
+            if self._connection is not None:
+                await self._connection.close()
+
+            wait = self._reconnect_policy.next_delay(self._reconnect_attempts, self._last_connack_code)
+            if wait is None:
+                logger.error('[RECONNECT] giving up after %s attempts, last CONNACK code: %s',
+                             self._reconnect_attempts, self._last_connack_code)
+                return
+            if not delay:
+                wait = 0.0
+            self._reconnect_attempts += 1
+            self.stats['reconnects'] += 1
+            if self._metrics is not None:
+                self._metrics.reconnects.inc()
+            logger.info('[RECONNECT] attempt %s in %.1f seconds', self._reconnect_attempts, wait)
+            await asyncio.sleep(wait)
+            if not self._is_active:
+                return
+
+            try:
+                self._connection = await self._create_connection(
+                    self._host, self._port, ssl=self._ssl, clean_session=self._clean_session,
+                    keepalive=self._keepalive)
+            except OSError as exc:
+                logger.warning("[CAN'T RECONNECT] %s", exc)
+                self._last_connack_code = None
+                self._reconnecting = False
+                asyncio.ensure_future(self.reconnect(delay=True))
+                return
+            if not self._is_active:
+                await self._connection.close()
+                return
+
+            self._last_connack_code = None
+            await self._connection.auth(self.fbns_auth, will_message=self._will_message,
+                                        compression_level=self._compression_level, **self._connect_properties)
+        finally:
+            self._reconnecting = False
+
     def set_fbns_auth(self, fbns_auth):
         self.fbns_auth = fbns_auth
 
+    async def load_state(self):
+        # Restores credentials saved in state_store, returns AccountState or None
+        if self._state_store is None:
+            raise ValueError('no state_store configured')
+        state = await self._state_store.load(self._account_id)
+        if state is not None and state.auth:
+            self.set_fbns_auth(FBNSAuth(state.auth))
+        if state is not None and self._registration is not None:
+            self._registration.seed(self._account_id, state.registered_token, state.registered_at)
+        return state
+
     async def connect(self, host, port=1883, ssl=False, keepalive=900):
         # Init connection
         self._host = host
         self._port = port
         self._ssl = ssl
         self._keepalive = keepalive
+        self._is_active = True
+        self._error = None
 
         self._connection = await self._create_connection(
             host, port=self._port, ssl=self._ssl, clean_session=self._clean_session, keepalive=keepalive)
 
         await self._connection.auth(self.fbns_auth, will_message=self._will_message,
-                                    **self._connect_properties)
+                                    compression_level=self._compression_level, **self._connect_properties)
         await self._connected.wait()
 
-        loop = asyncio.get_event_loop()
-        while not await self._persistent_storage.is_empty:
-            await loop.create_future()
+        await self._persistent_storage.wait_empty()
 
         if self._error:
+            # Refused connect is not retried behind the caller's back
+            self._is_active = False
+            self._connected.clear()
+            await self._connection.close()
             raise self._error
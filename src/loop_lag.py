@@ -0,0 +1,61 @@
+import asyncio
+import collections
+
+
+class LoopLagMonitor(object):
+    # Measures how late the event loop runs a callback scheduled every `interval` seconds
+    def __init__(self, interval=0.05, samples=10000, loop=None):
+        self._interval = interval
+        self._loop = loop
+        self._samples = collections.deque(maxlen=samples)
+        self._handle = None
+        self._expected = None
+
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def start(self):
+        if self._handle is not None:
+            return
+        self._loop = self._loop or asyncio.get_event_loop()
+        self._schedule()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def reset(self):
+        self._samples.clear()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _schedule(self):
+        self._expected = self._loop.time() + self._interval
+        self._handle = self._loop.call_at(self._expected, self._tick)
+
+    def _tick(self):
+        lag = max(self._loop.time() - self._expected, 0.0)
+        self._samples.append(lag)
+        self.count += 1
+        self.total += lag
+        if lag > self.max:
+            self.max = lag
+        self._schedule()
+
+    def percentile(self, q):
+        if not self._samples:
+            return 0.0
+        samples = sorted(self._samples)
+        return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
@@ -0,0 +1,253 @@
+import asyncio
+import bisect
+import math
+
+from gmqtt.client import logger
+
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labels, extra=''):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_float(value):
+    # Non-finite values are spelled as Prometheus text format expects them
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def _format_value(value):
+    if isinstance(value, float) and not math.isfinite(value):
+        return _format_float(value)
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def get(self, labels=()):
+        return self._values.get(tuple(labels))
+
+    def clear(self):
+        self._values.clear()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for labels, value in sorted(self._values.items()):
+            lines.append('{}{} {}'.format(self.name, _format_labels(self.labelnames, labels), _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, labels=(), amount=1):
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def inc(self, labels=(), amount=1):
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        # Per labels: [count per bucket..., count in +Inf, sum]
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [0] * (len(self.buckets) + 2)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def count(self, labels=()):
+        state = self._values.get(tuple(labels))
+        return sum(state[:-1]) if state else 0
+
+    def sum(self, labels=()):
+        state = self._values.get(tuple(labels))
+        return state[-1] if state else 0.0
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for labels, state in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(self.labelnames, labels, 'le="{}"'.format(le)), cumulative))
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append('{}_sum{} {}'.format(self.name, label_str, _format_float(float(state[-1]))))
+            lines.append('{}_count{} {}'.format(self.name, label_str, cumulative))
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError('Metric {name} is already registered as {metric.kind}'.format(**locals()))
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def __iter__(self):
+        return iter(self._metrics.values())
+
+    def snapshot(self):
+        # Picklable copy of all values, e.g. to send them from a worker process, see merge()
+        return [(metric.kind, metric.name, metric.documentation, metric.labelnames, getattr(metric, 'buckets', None),
+                 {labels: list(value) if isinstance(value, list) else value
+                  for labels, value in metric._values.items()})
+                for metric in self._metrics.values()]
+
+    def merge(self, snapshot, gauges=True):
+        # Adds values of snapshot() of another registry to this one
+        for kind, name, documentation, labelnames, buckets, values in snapshot:
+            if kind == Histogram.kind:
+                metric = self.histogram(name, documentation, labelnames, buckets)
+                for labels, state in values.items():
+                    current = metric._values.get(labels)
+                    if current is None:
+                        metric._values[labels] = list(state)
+                    else:
+                        for index, value in enumerate(state):
+                            current[index] += value
+                continue
+            if kind == Gauge.kind:
+                if not gauges:
+                    continue
+                metric = self.gauge(name, documentation, labelnames)
+            else:
+                metric = self.counter(name, documentation, labelnames)
+            for labels, value in values.items():
+                metric.inc(labels, value)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class FBNSMetrics(object):
+    # Aggregate metrics of all clients using the same registry
+    def __init__(self, registry=None):
+        registry = registry or REGISTRY
+        self.registry = registry
+        self.connects = registry.counter('fbns_connects_total', 'Connections established')
+        self.reconnects = registry.counter('fbns_reconnects_total', 'Reconnect attempts')
+        self.connack = registry.counter('fbns_connack_total', 'CONNACK packets by return code', ('code',))
+        self.messages = registry.counter('fbns_messages_total', 'PUBLISH packets received by topic', ('topic',))
+        self.pushes = registry.counter('fbns_pushes_total', 'Pushes by collapse key and result',
+                                       ('collapse_key', 'result'))
+        self.bytes_compressed = registry.counter('fbns_payload_compressed_bytes_total',
+                                                 'Received payload bytes before zlib decompression')
+        self.bytes_decompressed = registry.counter('fbns_payload_decompressed_bytes_total',
+                                                   'Received payload bytes after zlib decompression')
+        self.decompress_seconds = registry.histogram('fbns_decompress_seconds', 'Payload zlib decompression time')
+        self.json_seconds = registry.histogram('fbns_json_decode_seconds', 'Payload JSON decoding time')
+        self.dispatch_seconds = registry.histogram('fbns_dispatch_seconds', 'Push dispatch time including callbacks')
+        self.ping_rtt_seconds = registry.histogram('fbns_ping_rtt_seconds', 'PINGREQ to PINGRESP round trip time')
+        self.rejected = registry.counter('fbns_rejected_total',
+                                         'Packets over max_packet_size and payloads over max_payload_size',
+                                         ('kind',))
+        self.bus_queue_depth = registry.gauge('fbns_bus_queue_depth', 'Pushes waiting in PushBus subscriber queue',
+                                              ('subscriber',))
+        self.bus_dropped = registry.counter('fbns_bus_dropped_total', 'Pushes dropped by PushBus subscriber queue',
+                                            ('subscriber',))
+        self.tls_handshake_seconds = registry.histogram('fbns_tls_handshake_seconds',
+                                                        'TLS handshake time by session resumption', ('resumed',))
+
+
+_default_metrics = None
+
+
+def get_default_metrics():
+    global _default_metrics
+    if _default_metrics is None:
+        _default_metrics = FBNSMetrics(REGISTRY)
+    return _default_metrics
+
+
+async def start_metrics_server(registry=None, host='127.0.0.1', port=9108):
+    # Minimal HTTP endpoint serving registry in Prometheus text format on any path.
+    # registry may also be a function returning the registry to render, e.g. FBNSSupervisor.metrics_registry
+    registry = registry or REGISTRY
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = (registry() if callable(registry) else registry).render().encode('utf8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as e:
+            logger.debug('[METRICS] bad request: %s', e)
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
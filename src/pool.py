@@ -0,0 +1,412 @@
+import asyncio
+import time
+
+from gmqtt.client import logger
+from gmqtt.mqtt.handler import _empty_callback
+
+from gmqtt.mqtt.handler import MQTTConnectError
+
+from .fbns_mqtt import FBNSMQTTClient, FBNSAuth
+from .reconnect import ReconnectPolicy
+
+# Account states
+STATE_PENDING = 'pending'
+STATE_CONNECTING = 'connecting'
+STATE_CONNECTED = 'connected'
+STATE_FAILED = 'failed'
+STATE_DISCONNECTED = 'disconnected'
+
+
+def auth_as_dict(fbns_auth):
+    # Comparable form of credentials given as FBNSAuth, CONNACK dict or None
+    if fbns_auth is None:
+        return None
+    if isinstance(fbns_auth, dict):
+        fbns_auth = FBNSAuth(fbns_auth)
+    return fbns_auth.as_dict()
+
+
+class FBNSAccount(object):
+    __slots__ = ('account_id', 'client', 'fbns_auth', 'configured_auth', 'state', 'token', 'error',
+                 'connected_at', 'last_message_at', 'messages', 'connects', 'failures',
+                 '_connect_task', '_session_task', '_retry_handle')
+
+    def __init__(self, account_id, fbns_auth=None):
+        self.account_id = account_id
+        self.client = None
+        self.fbns_auth = fbns_auth
+        # Credentials given to add_account() or sync_accounts(), fbns_auth is replaced by received ones
+        self.configured_auth = auth_as_dict(fbns_auth)
+        self.state = STATE_PENDING
+        self.token = None
+        self.error = None
+        self.connected_at = None
+        self.last_message_at = None
+        self.messages = 0
+        self.connects = 0
+        self.failures = 0
+        self._connect_task = None
+        self._session_task = None
+        self._retry_handle = None
+
+    def __repr__(self):
+        return '<FBNSAccount {} {}>'.format(self.account_id, self.state)
+
+
+class FBNSMQTTPool(object):
+    def __init__(self, host='mqtt-mini.facebook.com', port=443, ssl=True, keepalive=900,
+                 max_concurrent_connects=50, connect_interval=0.0, connect_timeout=30,
+                 client_factory=FBNSMQTTClient, client_kwargs=None, reconnect_policy=None, state_store=None,
+                 registration=None, drain_timeout=30):
+        self._host = host
+        self._port = port
+        self._ssl = ssl
+        self._keepalive = keepalive
+        self._connect_interval = connect_interval
+        self._connect_timeout = connect_timeout
+        self._client_factory = client_factory
+        self._client_kwargs = client_kwargs or {}
+        # Retries of failed initial connects, reconnects of established sessions are done by clients
+        self._reconnect_policy = reconnect_policy or ReconnectPolicy()
+        # fbns_mqtt.state.StateStore, credentials and tokens of accounts are saved by pool
+        self._state_store = state_store
+        # fbns_mqtt.registration.TokenRegistration, tokens of accounts are registered in background
+        self._registration = registration
+        # Removed and updated accounts get this long to dispatch pushes already received
+        self._drain_timeout = drain_timeout
+
+        self._connect_semaphore = asyncio.Semaphore(max_concurrent_connects)
+        self._accounts = {}
+        self._push_filter = None
+        self._blocked_queues = 0
+        self._sync_lock = asyncio.Lock()
+
+        self._on_fbns_token_callback = _empty_callback
+        self._on_fbns_auth_callback = _empty_callback
+        self._on_fbns_message_callback = _empty_callback
+        self._on_state_change_callback = _empty_callback
+
+    @property
+    def on_fbns_message(self):
+        return self._on_fbns_message_callback
+
+    @on_fbns_message.setter
+    def on_fbns_message(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_fbns_message_callback = cb
+
+    @property
+    def on_fbns_auth(self):
+        return self._on_fbns_auth_callback
+
+    @on_fbns_auth.setter
+    def on_fbns_auth(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_fbns_auth_callback = cb
+
+    @property
+    def on_fbns_token(self):
+        return self._on_fbns_token_callback
+
+    @on_fbns_token.setter
+    def on_fbns_token(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_fbns_token_callback = cb
+
+    @property
+    def on_state_change(self):
+        return self._on_state_change_callback
+
+    @on_state_change.setter
+    def on_state_change(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_state_change_callback = cb
+
+    @property
+    def accounts(self):
+        return self._accounts
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def __contains__(self, account_id):
+        return account_id in self._accounts
+
+    def get_account(self, account_id):
+        return self._accounts.get(account_id)
+
+    def count_by_state(self):
+        counts = {}
+        for account in self._accounts.values():
+            counts[account.state] = counts.get(account.state, 0) + 1
+        return counts
+
+    def set_push_filter(self, collapse_keys=None, package_names=None):
+        self._push_filter = (collapse_keys, package_names)
+        for account in self._accounts.values():
+            if account.client is not None:
+                account.client.set_push_filter(collapse_keys, package_names)
+
+    def add_account(self, account_id, fbns_auth=None):
+        if account_id in self._accounts:
+            raise ValueError('Account {account_id} is already in pool'.format(**locals()))
+        if isinstance(fbns_auth, dict):
+            fbns_auth = FBNSAuth(fbns_auth)
+        account = FBNSAccount(account_id, fbns_auth)
+        self._accounts[account_id] = account
+        return account
+
+    async def load_accounts(self):
+        # Adds accounts saved in state store, returns number of added accounts
+        if self._state_store is None:
+            raise ValueError('no state_store configured')
+        states = await self._state_store.load_all()
+        if self._registration is not None:
+            self._registration.load_states(states)
+        added = 0
+        for account_id, state in states.items():
+            if account_id in self._accounts:
+                continue
+            account = self.add_account(account_id, state.auth)
+            account.token = state.token
+            added += 1
+        return added
+
+    def connect_account(self, account_id):
+        account = self._accounts[account_id]
+        if account._connect_task is None or account._connect_task.done():
+            account._connect_task = asyncio.ensure_future(self._connect_account(account))
+        return account._connect_task
+
+    async def connect(self):
+        tasks = [self.connect_account(account_id) for account_id, account in self._accounts.items()
+                 if account.state in (STATE_PENDING, STATE_FAILED, STATE_DISCONNECTED)]
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def disconnect_account(self, account_id, drain=False):
+        # With drain pushes received before disconnect are dispatched before returning
+        account = self._accounts[account_id]
+        if account._retry_handle is not None:
+            account._retry_handle.cancel()
+            account._retry_handle = None
+        if account._connect_task is not None and not account._connect_task.done():
+            account._connect_task.cancel()
+        if account._session_task is not None and not account._session_task.done():
+            account._session_task.cancel()
+        account._session_task = None
+        client, account.client = account.client, None
+        if client is not None:
+            try:
+                await client.disconnect()
+            except Exception as e:
+                logger.warning('[POOL] Error while disconnecting account %s: %s', account_id, e)
+            if drain and not await client.drain(self._drain_timeout):
+                logger.warning('[POOL] Account %s pushes were not dispatched in %s seconds',
+                               account_id, self._drain_timeout)
+        self._set_state(account, STATE_DISCONNECTED)
+
+    async def remove_account(self, account_id, drain=False, forget=True):
+        # forget deletes saved state and registration of the account
+        await self.disconnect_account(account_id, drain=drain)
+        if forget:
+            if self._state_store is not None:
+                self._state_store.delete(account_id)
+            if self._registration is not None:
+                self._registration.forget(account_id)
+        return self._accounts.pop(account_id)
+
+    async def update_account(self, account_id, fbns_auth):
+        # Replaces configured credentials, a running session is drained and reconnected with them
+        account = self._accounts[account_id]
+        if isinstance(fbns_auth, dict):
+            fbns_auth = FBNSAuth(fbns_auth)
+        running = account.state != STATE_PENDING and account.state != STATE_DISCONNECTED
+        if running:
+            await self.disconnect_account(account_id, drain=True)
+        account.fbns_auth = fbns_auth
+        account.configured_auth = auth_as_dict(fbns_auth)
+        account.failures = 0
+        if self._state_store is not None and fbns_auth is not None:
+            self._state_store.save_auth(account_id, fbns_auth)
+        if running:
+            await self.connect_account(account_id)
+
+    def diff_accounts(self, accounts):
+        # Returns (added, removed, updated) account ids of desired {account_id: credentials or None}.
+        # Updated are accounts whose given credentials differ from both configured and current ones,
+        # None keeps current credentials.
+        added = [account_id for account_id in accounts if account_id not in self._accounts]
+        removed = [account_id for account_id in self._accounts if account_id not in accounts]
+        updated = []
+        for account_id, fbns_auth in accounts.items():
+            account = self._accounts.get(account_id)
+            auth = auth_as_dict(fbns_auth)
+            if account is None or auth is None:
+                continue
+            if auth != account.configured_auth and auth != auth_as_dict(account.fbns_auth):
+                updated.append(account_id)
+        return added, removed, updated
+
+    async def sync_accounts(self, accounts, forget=True):
+        # Makes pool accounts match desired {account_id: credentials or None}: new accounts are connected,
+        # removed ones drained and disconnected, changed credentials reconnected. Other sessions are
+        # not touched. Returns {'added': [...], 'removed': [...], 'updated': [...]}
+        async with self._sync_lock:
+            added, removed, updated = self.diff_accounts(accounts)
+            for account_id, fbns_auth in accounts.items():
+                account = self._accounts.get(account_id)
+                if fbns_auth is not None and account is not None and account_id not in updated:
+                    # Given credentials are the ones in use, compare the next sync with them
+                    account.configured_auth = auth_as_dict(fbns_auth)
+            for account_id in added:
+                self.add_account(account_id, accounts[account_id])
+            tasks = [self.connect_account(account_id) for account_id in added]
+            tasks += [self.remove_account(account_id, drain=True, forget=forget) for account_id in removed]
+            tasks += [self.update_account(account_id, accounts[account_id]) for account_id in updated]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error('[POOL] account sync failed', exc_info=result)
+            if removed and self._state_store is not None:
+                await self._state_store.flush()
+            if added or removed or updated:
+                logger.info('[POOL] accounts synced: %s added, %s removed, %s updated',
+                            len(added), len(removed), len(updated))
+            return {'added': added, 'removed': removed, 'updated': updated}
+
+    async def disconnect(self):
+        tasks = [asyncio.ensure_future(self.disconnect_account(account_id)) for account_id in list(self._accounts)]
+        if tasks:
+            await asyncio.wait(tasks)
+        if self._state_store is not None:
+            await self._state_store.flush()
+
+    def _create_client(self, account):
+        client = self._client_factory(**self._client_kwargs)
+        if account.fbns_auth is not None:
+            client.set_fbns_auth(account.fbns_auth)
+        if self._push_filter is not None:
+            client.set_push_filter(*self._push_filter)
+        account_id = account.account_id
+        client.on_fbns_auth = lambda auth: self._on_account_auth(account_id, auth)
+        client.on_fbns_token = lambda token: self._on_account_token(account_id, token)
+        client.on_fbns_message = lambda push: self._on_account_message(account_id, push)
+        if self._blocked_queues:
+            client._pause_reading(self)
+        return client
+
+    def _pause_reading(self, queue):
+        # Full OVERFLOW_BLOCK consumer queue (e.g. of PushBus) pauses reading of all accounts
+        self._blocked_queues += 1
+        if self._blocked_queues == 1:
+            for account in self._accounts.values():
+                if account.client is not None:
+                    account.client._pause_reading(self)
+
+    def _resume_reading(self, queue):
+        self._blocked_queues -= 1
+        if self._blocked_queues == 0:
+            for account in self._accounts.values():
+                if account.client is not None:
+                    account.client._resume_reading(self)
+
+    async def _connect_account(self, account):
+        async with self._connect_semaphore:
+            if account.client is None:
+                account.client = self._create_client(account)
+            client = account.client
+            self._set_state(account, STATE_CONNECTING)
+            account.connects += 1
+
+            # FBNSMQTTClient.connect does not return until QoS queue is drained,
+            # so the account is considered connected as soon as CONNACK arrives.
+            connect = asyncio.ensure_future(client.connect(self._host, self._port, ssl=self._ssl,
+                                                           keepalive=self._keepalive))
+            account._session_task = connect
+            connected = asyncio.ensure_future(client._connected.wait())
+            try:
+                done, _ = await asyncio.wait([connect, connected], timeout=self._connect_timeout,
+                                             return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                connect.cancel()
+                connected.cancel()
+                raise
+
+            error = None
+            if connect in done and connect.exception() is not None:
+                error = connect.exception()
+            elif not done:
+                error = asyncio.TimeoutError('CONNACK was not received in {} seconds'.format(self._connect_timeout))
+                connect.cancel()
+            connected.cancel()
+
+            if error is not None:
+                account.error = error
+                account.failures += 1
+                logger.warning('[POOL] Account %s connect failed: %r', account.account_id, error)
+                self._set_state(account, STATE_FAILED)
+                # Client doesn't retry a failed connect() by itself, CONNACK code decides the retry delay
+                returncode = error._code if isinstance(error, MQTTConnectError) else None
+                self._schedule_retry(account, returncode)
+            elif account.state != STATE_CONNECTED:
+                self._set_state(account, STATE_CONNECTED)
+
+            if self._connect_interval:
+                await asyncio.sleep(self._connect_interval)
+
+    def _schedule_retry(self, account, returncode=None):
+        delay = self._reconnect_policy.next_delay(account.failures - 1, returncode)
+        if delay is None:
+            return
+        account_id = account.account_id
+        account._retry_handle = asyncio.get_event_loop().call_later(delay, self._retry_account, account_id)
+
+    def _retry_account(self, account_id):
+        account = self._accounts.get(account_id)
+        if account is not None and account.state == STATE_FAILED:
+            account._retry_handle = None
+            self.connect_account(account_id)
+
+    def _set_state(self, account, state):
+        if account.state == state:
+            return
+        account.state = state
+        if state == STATE_CONNECTED:
+            account.connected_at = time.time()
+            account.error = None
+            account.failures = 0
+        self.on_state_change(account.account_id, state)
+
+    def _on_account_auth(self, account_id, auth):
+        account = self._accounts.get(account_id)
+        if account is not None:
+            account.fbns_auth = FBNSAuth(auth)
+            if account.client is not None:
+                # Reuse received credentials on reconnect
+                account.client.set_fbns_auth(account.fbns_auth)
+            if self._state_store is not None:
+                self._state_store.save_auth(account_id, auth)
+            self._set_state(account, STATE_CONNECTED)
+        return self.on_fbns_auth(account_id, auth)
+
+    def _on_account_token(self, account_id, token):
+        account = self._accounts.get(account_id)
+        if account is not None:
+            account.token = token
+            if self._state_store is not None:
+                self._state_store.save_token(account_id, token)
+            if self._registration is not None:
+                self._registration.submit(account_id, token)
+        return self.on_fbns_token(account_id, token)
+
+    def _on_account_message(self, account_id, push):
+        account = self._accounts.get(account_id)
+        if account is not None:
+            account.messages += 1
+            account.last_message_at = time.time()
+        return self.on_fbns_message(account_id, push)
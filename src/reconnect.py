@@ -0,0 +1,71 @@
+import asyncio
+import random
+import time
+
+
+class ReconnectPolicy(object):
+    # Exponential backoff with jitter, delays depend on the last CONNACK return code:
+    #   fatal_codes - not retried (protocol version, identifier rejected)
+    #   auth_failure_codes - retried only after auth_failure_delay, None disables retry
+    def __init__(self, base_delay=1.0, max_delay=300.0, multiplier=2.0, jitter=0.5, max_attempts=None,
+                 fatal_codes=(1, 2), auth_failure_codes=(4, 5), auth_failure_delay=900.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.fatal_codes = frozenset(fatal_codes)
+        self.auth_failure_codes = frozenset(auth_failure_codes)
+        self.auth_failure_delay = auth_failure_delay
+
+    def next_delay(self, attempt, returncode=None):
+        # Returns seconds to wait before attempt number `attempt` (starting from 0), None to give up
+        if self.max_attempts is not None and attempt >= self.max_attempts:
+            return None
+        if returncode in self.fatal_codes:
+            return None
+        if returncode in self.auth_failure_codes:
+            if self.auth_failure_delay is None:
+                return None
+            delay = max(self.auth_failure_delay, self._backoff(attempt))
+        else:
+            delay = self._backoff(attempt)
+        return delay * (1 - self.jitter * random.random())
+
+    def _backoff(self, attempt):
+        # Avoid float overflow for large attempt numbers
+        if attempt > 64:
+            return self.max_delay
+        return min(self.max_delay, self.base_delay * self.multiplier ** attempt)
+
+
+class ConnectRateLimiter(object):
+    # Token bucket limiting new connections per second. Callers reserve a token
+    # and sleep until it is refilled, so waiters are served in order.
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else max(1, rate))
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+
+        self.acquired = 0
+        self.delayed = 0
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    async def acquire(self):
+        self._refill()
+        self._tokens -= 1
+        self.acquired += 1
+        if self._tokens < 0:
+            self.delayed += 1
+            await asyncio.sleep(-self._tokens / self._rate)
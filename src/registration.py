@@ -0,0 +1,229 @@
+import asyncio
+import collections
+import functools
+import time
+
+from gmqtt.client import logger
+from gmqtt.mqtt.handler import _empty_callback
+
+from .reconnect import ReconnectPolicy, ConnectRateLimiter
+
+
+class TokenRegistration(object):
+    # Background registration of FBNS tokens in application API (e.g. instagram push/register/).
+    # registrar(account_id, token) is a coroutine function or a blocking function run in executor,
+    # it raises on failure. Tokens registered less than ttl seconds ago are not registered again,
+    # only the latest token of an account is kept while it waits, at most `concurrency`
+    # registrations run at a time and at most `rate` start per second (None - no limit).
+    # Failed registrations are retried with retry_policy delays.
+    def __init__(self, registrar, concurrency=10, ttl=24 * 3600, rate=None, retry_policy=None, executor=None,
+                 state_store=None):
+        if not callable(registrar):
+            raise ValueError
+        self._registrar = registrar
+        self._concurrency = concurrency
+        self._ttl = ttl
+        self._rate_limiter = ConnectRateLimiter(rate) if rate else None
+        self._retry_policy = retry_policy or ReconnectPolicy(base_delay=5, max_delay=600, max_attempts=5)
+        self._executor = executor
+        # fbns_mqtt.state.StateStore, successful registrations are saved with save_registration
+        self._state_store = state_store
+
+        # account_id -> (token, unix time of registration)
+        self._registered = {}
+        # account_id -> (token, attempt), waiting accounts are in _queue once
+        self._pending = {}
+        self._in_flight = set()
+        self._retry_handles = {}
+        self._queue = collections.deque()
+        self._wakeup = None
+        self._workers = []
+        self._idle = None
+
+        self.stats = collections.Counter()
+
+        self._on_registered_callback = _empty_callback
+        self._on_failed_callback = _empty_callback
+
+    @property
+    def on_registered(self):
+        return self._on_registered_callback
+
+    @on_registered.setter
+    def on_registered(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_registered_callback = cb
+
+    @property
+    def on_failed(self):
+        # Called with (account_id, token, exception) when retries are exhausted
+        return self._on_failed_callback
+
+    @on_failed.setter
+    def on_failed(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_failed_callback = cb
+
+    def __len__(self):
+        # Registrations waiting, running or scheduled for retry
+        return len(self._pending) + len(self._in_flight) + len(self._retry_handles)
+
+    def seed(self, account_id, token, registered_at):
+        # Remember registration made before, e.g. from AccountState loaded from state store
+        if token:
+            self._registered[account_id] = (token, registered_at)
+
+    def load_states(self, states):
+        # Seeds registrations from {account_id: AccountState}
+        for account_id, state in states.items():
+            self.seed(account_id, state.registered_token, state.registered_at)
+
+    def is_registered(self, account_id, token):
+        registered = self._registered.get(account_id)
+        return registered is not None and registered[0] == token and registered[1] > time.time() - self._ttl
+
+    def submit(self, account_id, token):
+        # Returns False if token is already registered or being registered
+        if self.is_registered(account_id, token):
+            self.stats['skipped'] += 1
+            return False
+        pending = self._pending.get(account_id)
+        if pending is not None and pending[0] == token:
+            self.stats['coalesced'] += 1
+            return False
+
+        retry = self._retry_handles.pop(account_id, None)
+        if retry is not None:
+            # New token replaces the one waiting for retry
+            retry.cancel()
+        if pending is not None:
+            self.stats['coalesced'] += 1
+        self._pending[account_id] = (token, 0)
+        if pending is None and account_id not in self._in_flight:
+            self._enqueue(account_id)
+        self._start_workers()
+        return True
+
+    def forget(self, account_id):
+        self._registered.pop(account_id, None)
+        self._pending.pop(account_id, None)
+        retry = self._retry_handles.pop(account_id, None)
+        if retry is not None:
+            retry.cancel()
+        self._check_idle()
+
+    def _enqueue(self, account_id):
+        self._queue.append(account_id)
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def _start_workers(self):
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self._concurrency)]
+
+    async def _worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if not self._queue:
+                # Workers share one wakeup future, it's replaced after every wakeup
+                if self._wakeup is None or self._wakeup.done():
+                    self._wakeup = loop.create_future()
+                await asyncio.shield(self._wakeup)
+                continue
+            account_id = self._queue.popleft()
+            item = self._pending.pop(account_id, None)
+            if item is None:
+                # Forgotten while waiting
+                self._check_idle()
+                continue
+            if self.is_registered(account_id, item[0]):
+                # Same token was resubmitted while it was being registered
+                self.stats['skipped'] += 1
+                self._check_idle()
+                continue
+            self._in_flight.add(account_id)
+            try:
+                await self._register(account_id, *item)
+            finally:
+                self._in_flight.discard(account_id)
+                if account_id in self._pending:
+                    # New token was submitted during registration
+                    self._enqueue(account_id)
+                self._check_idle()
+
+    async def _register(self, account_id, token, attempt):
+        if self._rate_limiter is not None:
+            await self._rate_limiter.acquire()
+        try:
+            if asyncio.iscoroutinefunction(self._registrar):
+                await self._registrar(account_id, token)
+            else:
+                await asyncio.get_event_loop().run_in_executor(
+                    self._executor, functools.partial(self._registrar, account_id, token))
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            self._retry(account_id, token, attempt, exc)
+            return
+
+        registered_at = time.time()
+        self._registered[account_id] = (token, registered_at)
+        self.stats['registered'] += 1
+        # Errors of the store or callback must not stop the worker
+        try:
+            if self._state_store is not None:
+                self._state_store.save_registration(account_id, token, registered_at)
+            self.on_registered(account_id, token)
+        except Exception as exc:
+            logger.error('[REGISTRATION] account %s after registration', account_id, exc_info=exc)
+
+    def _retry(self, account_id, token, attempt, exc):
+        if account_id in self._pending:
+            # Newer token is waiting, no need to retry this one
+            self.stats['superseded'] += 1
+            return
+        delay = self._retry_policy.next_delay(attempt)
+        if delay is None:
+            self.stats['failed'] += 1
+            logger.error('[REGISTRATION] account %s failed after %s attempts: %r', account_id, attempt + 1, exc)
+            try:
+                self.on_failed(account_id, token, exc)
+            except Exception as callback_exc:
+                logger.error('[REGISTRATION] account %s on_failed', account_id, exc_info=callback_exc)
+            return
+        self.stats['retries'] += 1
+        logger.warning('[REGISTRATION] account %s attempt %s failed: %r, retry in %.1f seconds',
+                       account_id, attempt + 1, exc, delay)
+        self._retry_handles[account_id] = asyncio.get_event_loop().call_later(
+            delay, self._resubmit, account_id, token, attempt + 1)
+
+    def _resubmit(self, account_id, token, attempt):
+        self._retry_handles.pop(account_id, None)
+        if account_id not in self._pending:
+            self._pending[account_id] = (token, attempt)
+            if account_id not in self._in_flight:
+                self._enqueue(account_id)
+
+    def _check_idle(self):
+        if self._idle is not None and not len(self):
+            self._idle.set()
+
+    async def join(self):
+        # Waits until all submitted tokens are registered or failed
+        while len(self):
+            if self._idle is None:
+                self._idle = asyncio.Event()
+            self._idle.clear()
+            await self._idle.wait()
+
+    async def close(self):
+        for handle in self._retry_handles.values():
+            handle.cancel()
+        self._retry_handles.clear()
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.cancel()
+        if workers:
+            await asyncio.wait(workers)
@@ -0,0 +1,305 @@
+import asyncio
+import collections
+import json
+import os
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gmqtt.client import logger
+
+from .fbns_mqtt import FBNSMQTTClient
+
+
+def push_to_dict(push, account_id=None):
+    # JSON serializable FBNSPush with decoded notification
+    return {
+        'account_id': account_id,
+        'received_at': time.time(),
+        'token': push.token,
+        'connectionKey': push.connectionKey,
+        'packageName': push.packageName,
+        'collapseKey': push.collapseKey,
+        'notificationId': push.notificationId,
+        'isBuffered': push.isBuffered,
+        'viewId': push.viewId,
+        'numEndpoints': push.numEndpoints,
+        'notification': push.notification,
+    }
+
+
+class PartialWriteError(Exception):
+    # Raised by _write when only the first `written` bytes of a batch reached the target
+    def __init__(self, written, error):
+        super().__init__(written, error)
+        self.written = written
+        self.error = error
+
+    def __repr__(self):
+        return '{}({} bytes written, {!r})'.format(type(self).__name__, self.written, self.error)
+
+
+class PushSink(object):
+    # Pushes are serialized to NDJSON lines on write() and written in batches:
+    # batch_size lines at once or whatever is buffered flush_interval seconds after the first line.
+    # At most max_buffer lines are kept while the target is slow or unavailable, the oldest are
+    # dropped by write(). consume() waits for room instead of dropping.
+    def __init__(self, batch_size=500, flush_interval=1.0, max_buffer=100000, serializer=push_to_dict):
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_buffer = max(max_buffer, batch_size)
+        self._serializer = serializer
+        self._buffer = collections.deque()
+        self._flush_handle = None
+        self._flush_task = None
+        self._executor = None
+        self._closed = False
+
+        self.written = 0
+        self.batches = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def attach(self, source):
+        # Writes pushes of FBNSMQTTClient, FBNSMQTTPool or FBNSSupervisor
+        if isinstance(source, FBNSMQTTClient):
+            source.on_fbns_message = self.write
+        else:
+            source.on_fbns_message = lambda account_id, push: self.write(push, account_id)
+
+    def write(self, push, account_id=None):
+        if self._closed:
+            raise ValueError('Sink is closed')
+        line = json.dumps(self._serializer(push, account_id), separators=(',', ':')).encode('utf8') + b'\n'
+        self._buffer.append(line)
+        if len(self._buffer) > self._max_buffer:
+            self._buffer.popleft()
+            self.dropped += 1
+        self._schedule_flush()
+
+    async def consume(self, pushes):
+        # async for over client.pushes(), pool or supervisor pushes() queue
+        async for item in pushes:
+            while len(self._buffer) >= self._max_buffer:
+                await self._wait_flush()
+            if isinstance(item, tuple):
+                account_id, push = item
+                self.write(push, account_id)
+            else:
+                self.write(item)
+
+    def _schedule_flush(self):
+        if self._flush_task is not None:
+            return
+        if len(self._buffer) >= self._batch_size:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self._flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        if self._flush_task is None and self._buffer:
+            self._flush_task = asyncio.ensure_future(self._flush_buffer())
+
+    async def _flush_buffer(self):
+        failed = False
+        try:
+            while self._buffer:
+                lines = list(self._buffer)
+                self._buffer.clear()
+                data = b''.join(lines)
+                try:
+                    await self._write(data)
+                except Exception as exc:
+                    if isinstance(exc, PartialWriteError):
+                        # Lines written completely are not sent again, partly written one is sent whole
+                        done = data.count(b'\n', 0, exc.written)
+                        self.written += done
+                        self.bytes += sum(len(line) for line in lines[:done])
+                        lines = lines[done:]
+                    logger.error('[SINK] %s failed to write %s pushes: %r', type(self).__name__, len(lines), exc)
+                    self.errors += 1
+                    self._restore(lines)
+                    failed = True
+                    break
+                self.written += len(lines)
+                self.batches += 1
+                self.bytes += len(data)
+        finally:
+            self._flush_task = None
+        if failed and not self._closed:
+            self._flush_handle = asyncio.get_event_loop().call_later(self._flush_interval, self._start_flush)
+        return not failed
+
+    def _restore(self, lines):
+        # Failed batch goes back in front of lines written meanwhile, over max_buffer the oldest are dropped
+        self._buffer.extendleft(reversed(lines))
+        while len(self._buffer) > self._max_buffer:
+            self._buffer.popleft()
+            self.dropped += 1
+
+    async def _wait_flush(self):
+        if self._flush_task is None:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self._start_flush()
+        if self._flush_task is not None and await asyncio.shield(self._flush_task):
+            return
+        # Target failed, retry is scheduled
+        await asyncio.sleep(self._flush_interval)
+
+    async def flush(self):
+        # Writes buffered pushes, returns False if target failed
+        while self._buffer or self._flush_task is not None:
+            if self._flush_task is None:
+                if self._flush_handle is not None:
+                    self._flush_handle.cancel()
+                self._start_flush()
+            if not await asyncio.shield(self._flush_task):
+                return False
+        return True
+
+    async def _write(self, data):
+        # Blocking targets write in a single thread executor to keep batches ordered
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._write_blocking, data)
+
+    def _write_blocking(self, data):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            self._closed = True
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            if self._executor is not None:
+                await asyncio.get_event_loop().run_in_executor(self._executor, self._close)
+                self._executor.shutdown(wait=False)
+            else:
+                self._close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+class NDJSONFileSink(PushSink):
+    # Appends to path, rotated like logging.handlers.RotatingFileHandler:
+    # path is renamed to path.1, path.1 to path.2 ... up to backup_count when it reaches max_bytes
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backup_count=5, **kwargs):
+        super().__init__(**kwargs)
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._file = None
+        self.rotations = 0
+
+    def _write_blocking(self, data):
+        if self._file is None:
+            self._file = open(self._path, 'ab', buffering=0)
+        if self._max_bytes and self._file.tell() and self._file.tell() + len(data) > self._max_bytes:
+            self._rotate()
+        self._file.write(data)
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self._backup_count:
+            for number in range(self._backup_count - 1, 0, -1):
+                source = '{}.{}'.format(self._path, number)
+                if os.path.exists(source):
+                    os.replace(source, '{}.{}'.format(self._path, number + 1))
+            os.replace(self._path, self._path + '.1')
+        else:
+            os.remove(self._path)
+        self.rotations += 1
+        self._file = open(self._path, 'ab', buffering=0)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class StdoutSink(PushSink):
+    def __init__(self, stream=None, **kwargs):
+        super().__init__(**kwargs)
+        self._stream = stream or sys.stdout.buffer
+
+    def _write_blocking(self, data):
+        self._stream.write(data)
+        self._stream.flush()
+
+
+class UnixSocketSink(PushSink):
+    # Streams NDJSON to a Unix domain socket server, connection is (re)established on write,
+    # pushes are buffered up to max_buffer while the server is unavailable.
+    # Bytes accepted by the socket are counted, after a broken connection only lines not sent
+    # completely are sent again. The line cut off by it is sent whole on the next connection,
+    # so readers drop an unterminated last line of a connection.
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self._path = path
+        self._sock = None
+        self.connects = 0
+
+    async def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.get_event_loop().sock_connect(sock, self._path)
+        except BaseException:
+            sock.close()
+            raise
+        self._sock = sock
+        self.connects += 1
+
+    async def _wait_writable(self):
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        fd = self._sock.fileno()
+        loop.add_writer(fd, waiter.set_result, None)
+        try:
+            await waiter
+        finally:
+            loop.remove_writer(fd)
+
+    async def _write(self, data):
+        if self._sock is None:
+            await self._connect()
+        view = memoryview(data)
+        written = 0
+        try:
+            while written < len(data):
+                try:
+                    written += self._sock.send(view[written:])
+                except (BlockingIOError, InterruptedError):
+                    await self._wait_writable()
+        except OSError as exc:
+            self._close()
+            raise PartialWriteError(written, exc) from exc
+        except asyncio.CancelledError:
+            # Connection would continue in the middle of a line
+            self._close()
+            raise
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
@@ -0,0 +1,261 @@
+import asyncio
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gmqtt.client import logger
+
+
+class StateStoreError(Exception):
+    pass
+
+
+class AccountState(object):
+    # Persisted state of one account: CONNACK credentials dict (ck, cs, di, ds...),
+    # last FBNS token, token last registered in application API and unix timestamps
+    __slots__ = ('account_id', 'auth', 'token', 'auth_updated', 'token_updated', 'registered_token',
+                 'registered_at')
+
+    def __init__(self, account_id, auth=None, token=None, auth_updated=None, token_updated=None,
+                 registered_token=None, registered_at=None):
+        self.account_id = account_id
+        self.auth = auth
+        self.token = token
+        self.auth_updated = auth_updated
+        self.token_updated = token_updated
+        self.registered_token = registered_token
+        self.registered_at = registered_at
+
+    def __repr__(self):
+        return '<AccountState {}>'.format(self.account_id)
+
+
+# Fields of account saved again after delete in the same batch
+_CLEARED_FIELDS = (('auth', None), ('auth_updated', None), ('token', None), ('token_updated', None),
+                   ('registered_token', None), ('registered_at', None))
+
+
+class StateStore(object):
+    # Base class of state backends. save_* and delete only record the change in memory,
+    # changes of one account are coalesced and written in batches by _write_batch,
+    # which runs in a single thread executor with all other storage calls.
+    # A batch is written flush_interval seconds after the first change or
+    # as soon as batch_size accounts are changed.
+    def __init__(self, flush_interval=1.0, batch_size=500):
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        # account_id -> {field: value} of changed fields, None if account is deleted
+        self._pending = {}
+        self._flush_handle = None
+        self._flush_task = None
+        self._closed = False
+
+        self.writes = 0
+        self.batches = 0
+        self.errors = 0
+
+    def _write_batch(self, changes):
+        raise NotImplementedError
+
+    def _load_all(self):
+        raise NotImplementedError
+
+    def _load(self, account_id):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+    def save_auth(self, account_id, auth):
+        # auth is CONNACK credentials dict or FBNSAuth
+        if not isinstance(auth, dict):
+            auth = auth.as_dict()
+        self._update(account_id, auth=auth, auth_updated=time.time())
+
+    def save_token(self, account_id, token):
+        self._update(account_id, token=token, token_updated=time.time())
+
+    def save_registration(self, account_id, token, registered_at=None):
+        self._update(account_id, registered_token=token,
+                     registered_at=time.time() if registered_at is None else registered_at)
+
+    def delete(self, account_id):
+        self._check_closed()
+        self._pending[account_id] = None
+        self._schedule_flush()
+
+    def _check_closed(self):
+        if self._closed:
+            raise StateStoreError('State store is closed')
+
+    def _update(self, account_id, **fields):
+        self._check_closed()
+        changes = self._pending.get(account_id)
+        if changes is None:
+            changes = self._pending[account_id] = dict(_CLEARED_FIELDS) if account_id in self._pending else {}
+        changes.update(fields)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is not None:
+            # Running flush picks up new changes when it's done with current batch
+            return
+        if len(self._pending) >= self._batch_size:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self._flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        if self._flush_task is None and self._pending:
+            self._flush_task = asyncio.ensure_future(self._flush_pending())
+
+    async def _flush_pending(self):
+        loop = asyncio.get_event_loop()
+        failed = False
+        try:
+            while self._pending:
+                changes, self._pending = self._pending, {}
+                try:
+                    await loop.run_in_executor(self._executor, self._write_batch, changes)
+                except Exception as e:
+                    logger.error('[STATE STORE] failed to write %s accounts', len(changes), exc_info=e)
+                    self.errors += 1
+                    self._restore(changes)
+                    failed = True
+                    break
+                self.writes += len(changes)
+                self.batches += 1
+        finally:
+            self._flush_task = None
+        if failed and not self._closed:
+            # Retry after flush_interval
+            self._flush_handle = loop.call_later(self._flush_interval, self._start_flush)
+        return not failed
+
+    def _restore(self, changes):
+        # Put back changes of a failed batch under the ones made while it was written:
+        # a newer delete replaces them, newer fields are applied on top of them,
+        # so a failed delete followed by a save is still written as delete then save
+        for account_id, fields in changes.items():
+            if account_id not in self._pending:
+                self._pending[account_id] = fields
+                continue
+            newer = self._pending[account_id]
+            if newer is None:
+                continue
+            if fields is None:
+                fields = dict(_CLEARED_FIELDS)
+            fields.update(newer)
+            self._pending[account_id] = fields
+
+    async def flush(self):
+        # Write all changes made so far
+        while self._pending or self._flush_task is not None:
+            if self._flush_task is None:
+                if self._flush_handle is not None:
+                    self._flush_handle.cancel()
+                self._start_flush()
+            if not await asyncio.shield(self._flush_task):
+                raise StateStoreError('Failed to write state of {} accounts'.format(len(self._pending)))
+
+    async def load_all(self):
+        # Returns {account_id: AccountState} of all stored accounts
+        await self.flush()
+        return await asyncio.get_event_loop().run_in_executor(self._executor, self._load_all)
+
+    async def load(self, account_id):
+        # Returns AccountState or None
+        await self.flush()
+        return await asyncio.get_event_loop().run_in_executor(self._executor, self._load, account_id)
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            self._closed = True
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._close)
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+# Same order as AccountState arguments
+_SQLITE_COLUMNS = 'account_id, auth, token, auth_updated, token_updated, registered_token, registered_at'
+
+
+class SQLiteStateStore(StateStore):
+    # Accounts are stored in one table of SQLite database in WAL mode,
+    # account ids keep their python type (int or str)
+    def __init__(self, path, flush_interval=1.0, batch_size=500):
+        super().__init__(flush_interval, batch_size)
+        self._path = path
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS fbns_state (account_id PRIMARY KEY, auth TEXT, token TEXT, '
+                         'auth_updated REAL, token_updated REAL, registered_token TEXT, registered_at REAL)')
+        # Databases created before registration columns were added
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(fbns_state)')}
+        for column in ('registered_token TEXT', 'registered_at REAL'):
+            if column.split()[0] not in columns:
+                self._db.execute('ALTER TABLE fbns_state ADD COLUMN ' + column)
+
+    def _write_batch(self, changes):
+        deleted = []
+        auths = []
+        tokens = []
+        registrations = []
+        for account_id, fields in changes.items():
+            if fields is None:
+                deleted.append((account_id,))
+                continue
+            if 'auth' in fields:
+                auths.append((json.dumps(fields['auth']), fields['auth_updated'], account_id))
+            if 'token' in fields:
+                tokens.append((fields['token'], fields['token_updated'], account_id))
+            if 'registered_token' in fields:
+                registrations.append((fields['registered_token'], fields['registered_at'], account_id))
+
+        db = self._db
+        db.execute('BEGIN')
+        try:
+            db.executemany('DELETE FROM fbns_state WHERE account_id = ?', deleted)
+            db.executemany('INSERT OR IGNORE INTO fbns_state (account_id) VALUES (?)',
+                           [(account_id,) for account_id, fields in changes.items() if fields is not None])
+            db.executemany('UPDATE fbns_state SET auth = ?, auth_updated = ? WHERE account_id = ?', auths)
+            db.executemany('UPDATE fbns_state SET token = ?, token_updated = ? WHERE account_id = ?', tokens)
+            db.executemany('UPDATE fbns_state SET registered_token = ?, registered_at = ? WHERE account_id = ?',
+                           registrations)
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    @staticmethod
+    def _make_state(row):
+        account_id, auth, *fields = row
+        return AccountState(account_id, json.loads(auth) if auth else None, *fields)
+
+    def _load_all(self):
+        rows = self._db.execute('SELECT ' + _SQLITE_COLUMNS + ' FROM fbns_state')
+        return {row[0]: self._make_state(row) for row in rows}
+
+    def _load(self, account_id):
+        row = self._db.execute('SELECT ' + _SQLITE_COLUMNS + ' FROM fbns_state WHERE account_id = ?',
+                               (account_id,)).fetchone()
+        return self._make_state(row) if row else None
+
+    def _close(self):
+        self._db.close()
@@ -0,0 +1,554 @@
+import asyncio
+import collections
+import multiprocessing
+import os
+import pickle
+import signal
+import socket
+import struct
+import time
+
+from gmqtt.client import logger
+from gmqtt.mqtt.handler import _empty_callback
+
+from .delivery import PushQueue, OVERFLOW_BLOCK
+from .metrics import REGISTRY, MetricsRegistry
+from .pool import FBNSMQTTPool, auth_as_dict
+from .reconnect import ReconnectPolicy
+
+# Worker -> supervisor events
+EVENT_PUSH = 'push'
+EVENT_AUTH = 'auth'
+EVENT_TOKEN = 'token'
+EVENT_STATE = 'state'
+EVENT_METRICS = 'metrics'
+
+# Supervisor -> worker commands
+COMMAND_ADD = 'add'
+COMMAND_REMOVE = 'remove'
+COMMAND_UPDATE = 'update'
+COMMAND_STOP = 'stop'
+
+_FRAME_HEADER = struct.Struct('!I')
+
+
+def _write_frame(writer, items):
+    # One frame is a length prefixed pickled list of events or commands
+    data = pickle.dumps(items, pickle.HIGHEST_PROTOCOL)
+    writer.write(_FRAME_HEADER.pack(len(data)) + data)
+    return len(data)
+
+
+async def _read_frame(reader):
+    size, = _FRAME_HEADER.unpack(await reader.readexactly(_FRAME_HEADER.size))
+    return pickle.loads(await reader.readexactly(size))
+
+
+class _ShardWorker(object):
+    # Runs in worker process: FBNSMQTTPool of the shard accounts, events are sent
+    # to supervisor in frames of up to batch_size events at most batch_interval apart.
+    # Reading of all sessions is paused while more than write_buffer_size bytes of frames
+    # wait to be read by supervisor, e.g. when its pushes() queue is full.
+    def __init__(self, shard_id, sock, config):
+        self._shard_id = shard_id
+        self._sock = sock
+        self._config = config
+        self._batch_size = config['batch_size']
+        self._batch_interval = config['batch_interval']
+        self._write_buffer_size = config['write_buffer_size']
+        self._events = []
+        self._flush_handle = None
+        self._drain_task = None
+        self._writer = None
+        self._pool = None
+
+    def _emit(self, kind, account_id, value):
+        self._events.append((kind, account_id, value))
+        if len(self._events) >= self._batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self._batch_interval, self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._events and not self._writer.transport.is_closing():
+            events, self._events = self._events, []
+            _write_frame(self._writer, events)
+            if (self._drain_task is None and self._pool is not None and
+                    self._writer.transport.get_write_buffer_size() > self._write_buffer_size):
+                self._drain_task = asyncio.ensure_future(self._wait_drained())
+
+    async def _wait_drained(self):
+        # drain() returns once the buffer is below the transport low water mark
+        self._pool._pause_reading(self)
+        try:
+            await self._writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._drain_task = None
+            self._pool._resume_reading(self)
+
+    def _handle_command(self, command):
+        name = command[0]
+        if name == COMMAND_ADD:
+            _, account_id, auth = command
+            if account_id not in self._pool:
+                self._pool.add_account(account_id, auth)
+            self._pool.connect_account(account_id)
+        elif name == COMMAND_REMOVE:
+            if command[1] in self._pool:
+                asyncio.ensure_future(self._pool.remove_account(command[1], drain=True))
+        elif name == COMMAND_UPDATE:
+            _, account_id, auth = command
+            if account_id in self._pool:
+                asyncio.ensure_future(self._pool.update_account(account_id, auth))
+        else:
+            raise ValueError('Unknown command {!r}'.format(name))
+
+    async def _send_metrics(self):
+        while True:
+            await asyncio.sleep(self._config['metrics_interval'])
+            self._emit(EVENT_METRICS, None, REGISTRY.snapshot())
+
+    async def run(self):
+        reader, self._writer = await asyncio.open_unix_connection(sock=self._sock)
+        self._writer.transport.set_write_buffer_limits(high=self._write_buffer_size)
+        config = self._config
+        self._pool = FBNSMQTTPool(config['host'], config['port'], ssl=config['ssl'], keepalive=config['keepalive'],
+                                  **config['pool_kwargs'])
+        self._pool.on_fbns_message = lambda account_id, push: self._emit(EVENT_PUSH, account_id, push)
+        self._pool.on_fbns_auth = lambda account_id, auth: self._emit(EVENT_AUTH, account_id, auth)
+        self._pool.on_fbns_token = lambda account_id, token: self._emit(EVENT_TOKEN, account_id, token)
+        self._pool.on_state_change = lambda account_id, state: self._emit(EVENT_STATE, account_id, state)
+        metrics_task = None
+        if config['metrics_interval']:
+            metrics_task = asyncio.ensure_future(self._send_metrics())
+        try:
+            while True:
+                commands = await _read_frame(reader)
+                if any(command[0] == COMMAND_STOP for command in commands):
+                    break
+                for command in commands:
+                    self._handle_command(command)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # Supervisor is gone
+            pass
+        finally:
+            await self._pool.disconnect()
+            if metrics_task is not None:
+                metrics_task.cancel()
+                self._emit(EVENT_METRICS, None, REGISTRY.snapshot())
+            self._flush()
+            try:
+                if self._drain_task is not None:
+                    # Only one drain() may wait at a time
+                    await self._drain_task
+                await self._writer.drain()
+            except ConnectionError:
+                pass
+            self._writer.close()
+
+
+def _run_shard(shard_id, sock, config, inherited):
+    # Worker process entry point
+    for inherited_sock in inherited:
+        # Supervisor ends of other shards, copied by fork
+        inherited_sock.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for metric in REGISTRY:
+        # Values of supervisor copied by fork, workers only report their own
+        metric.clear()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(_ShardWorker(shard_id, sock, config).run())
+
+
+class _Shard(object):
+    def __init__(self, shard_id):
+        self.shard_id = shard_id
+        self.accounts = set()
+        self.process = None
+        self.sock = None
+        self.writer = None
+        self.started_at = None
+        self.restarts = 0
+        self.alive = False
+        self.task = None
+        # Last REGISTRY.snapshot() sent by the worker
+        self.metrics = None
+
+    def __repr__(self):
+        return '<Shard {} pid={} accounts={}>'.format(self.shard_id, self.process and self.process.pid,
+                                                     len(self.accounts))
+
+
+class FBNSSupervisor(object):
+    # Shards accounts across worker processes, each running FBNSMQTTPool on its own event loop.
+    # Pushes, credentials, tokens and state changes of all workers are merged into one stream
+    # of callbacks and pushes() queues. Crashed workers are restarted with restart_policy delays
+    # and the same accounts; when restart_policy gives up, accounts of the shard are moved to
+    # remaining workers. pool_kwargs are passed to FBNSMQTTPool in workers and must be picklable.
+    # With metrics_interval workers send their metrics this often, see metrics_registry().
+    def __init__(self, host='mqtt-mini.facebook.com', port=443, ssl=True, keepalive=900, workers=None,
+                 pool_kwargs=None, batch_size=100, batch_interval=0.05, restart_policy=None, stable_after=60,
+                 state_store=None, registration=None, start_method=None, write_buffer_size=1024 * 1024,
+                 metrics_interval=None):
+        self._config = {
+            'host': host,
+            'port': port,
+            'ssl': ssl,
+            'keepalive': keepalive,
+            'pool_kwargs': pool_kwargs or {},
+            'batch_size': batch_size,
+            'batch_interval': batch_interval,
+            'write_buffer_size': write_buffer_size,
+            'metrics_interval': metrics_interval,
+        }
+        self._context = multiprocessing.get_context(start_method)
+        self._restart_policy = restart_policy or ReconnectPolicy(base_delay=1, max_delay=60, max_attempts=10)
+        # Worker running this long is considered recovered, its restart attempts are reset
+        self._stable_after = stable_after
+        self._state_store = state_store
+        self._registration = registration
+
+        self._shards = [_Shard(shard_id) for shard_id in range(workers or os.cpu_count() or 1)]
+        self._shard_of = {}
+        self._auths = {}
+        # Credentials given to add_account() or sync_accounts(), _auths has received ones
+        self._configured_auths = {}
+        self._states = {}
+        self._push_queues = []
+        self._blocked_queues = 0
+        self._reading_resumed = asyncio.Event()
+        self._reading_resumed.set()
+        self._started = False
+        self._stopping = False
+        # Counters and histograms of exited workers, so totals don't go back on restart
+        self._retired_metrics = MetricsRegistry()
+
+        self.stats = collections.Counter()
+
+        self._on_fbns_token_callback = _empty_callback
+        self._on_fbns_auth_callback = _empty_callback
+        self._on_fbns_message_callback = _empty_callback
+        self._on_state_change_callback = _empty_callback
+
+    @property
+    def on_fbns_message(self):
+        return self._on_fbns_message_callback
+
+    @on_fbns_message.setter
+    def on_fbns_message(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_fbns_message_callback = cb
+
+    @property
+    def on_fbns_auth(self):
+        return self._on_fbns_auth_callback
+
+    @on_fbns_auth.setter
+    def on_fbns_auth(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_fbns_auth_callback = cb
+
+    @property
+    def on_fbns_token(self):
+        return self._on_fbns_token_callback
+
+    @on_fbns_token.setter
+    def on_fbns_token(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_fbns_token_callback = cb
+
+    @property
+    def on_state_change(self):
+        return self._on_state_change_callback
+
+    @on_state_change.setter
+    def on_state_change(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_state_change_callback = cb
+
+    @property
+    def shards(self):
+        return self._shards
+
+    def __len__(self):
+        return len(self._shard_of)
+
+    def __contains__(self, account_id):
+        return account_id in self._shard_of
+
+    def get_state(self, account_id):
+        return self._states.get(account_id)
+
+    def count_by_state(self):
+        return dict(collections.Counter(self._states.values()))
+
+    def metrics_registry(self):
+        # Registry of this process with metrics of all workers added, pass to start_metrics_server()
+        registry = MetricsRegistry()
+        registry.merge(REGISTRY.snapshot())
+        registry.merge(self._retired_metrics.snapshot())
+        for shard in self._shards:
+            if shard.metrics is not None:
+                registry.merge(shard.metrics)
+        return registry
+
+    def pushes(self, maxsize=10000, overflow=OVERFLOW_BLOCK):
+        # async for account_id, push in supervisor.pushes(): ...
+        # Full OVERFLOW_BLOCK queue stops reading frames from all workers
+        queue = PushQueue(maxsize, overflow, on_full=self._pause_reading, on_drain=self._resume_reading)
+        self._push_queues.append(queue)
+        return queue
+
+    def _pause_reading(self, queue):
+        self._blocked_queues += 1
+        self._reading_resumed.clear()
+
+    def _resume_reading(self, queue):
+        self._blocked_queues -= 1
+        if not self._blocked_queues:
+            self._reading_resumed.set()
+
+    def add_account(self, account_id, fbns_auth=None):
+        if account_id in self._shard_of:
+            raise ValueError('Account {account_id} is already supervised'.format(**locals()))
+        if fbns_auth is not None and not isinstance(fbns_auth, dict):
+            fbns_auth = fbns_auth.as_dict()
+        self._auths[account_id] = fbns_auth
+        self._configured_auths[account_id] = auth_as_dict(fbns_auth)
+        self._assign(account_id, self._least_loaded_shard())
+
+    def remove_account(self, account_id, forget=True):
+        # Worker drains pushes of the account before disconnecting it
+        shard = self._shard_of.pop(account_id)
+        shard.accounts.discard(account_id)
+        self._auths.pop(account_id, None)
+        self._configured_auths.pop(account_id, None)
+        self._states.pop(account_id, None)
+        self._send(shard, [(COMMAND_REMOVE, account_id)])
+        if forget:
+            if self._state_store is not None:
+                self._state_store.delete(account_id)
+            if self._registration is not None:
+                self._registration.forget(account_id)
+
+    def update_account(self, account_id, fbns_auth):
+        # Worker drains and reconnects the account with new credentials
+        shard = self._shard_of[account_id]
+        if fbns_auth is not None and not isinstance(fbns_auth, dict):
+            fbns_auth = fbns_auth.as_dict()
+        self._auths[account_id] = fbns_auth
+        self._configured_auths[account_id] = auth_as_dict(fbns_auth)
+        if self._state_store is not None and fbns_auth is not None:
+            self._state_store.save_auth(account_id, fbns_auth)
+        self._send(shard, [(COMMAND_UPDATE, account_id, fbns_auth)])
+
+    def diff_accounts(self, accounts):
+        # Same as FBNSMQTTPool.diff_accounts()
+        added = [account_id for account_id in accounts if account_id not in self._shard_of]
+        removed = [account_id for account_id in self._shard_of if account_id not in accounts]
+        updated = []
+        for account_id, fbns_auth in accounts.items():
+            auth = auth_as_dict(fbns_auth)
+            if account_id not in self._shard_of or auth is None:
+                continue
+            if auth != self._configured_auths.get(account_id) and auth != auth_as_dict(self._auths.get(account_id)):
+                updated.append(account_id)
+        return added, removed, updated
+
+    def sync_accounts(self, accounts, forget=True):
+        # Same as FBNSMQTTPool.sync_accounts(), workers apply changes in background
+        added, removed, updated = self.diff_accounts(accounts)
+        for account_id, fbns_auth in accounts.items():
+            if fbns_auth is not None and account_id in self._shard_of and account_id not in updated:
+                self._configured_auths[account_id] = auth_as_dict(fbns_auth)
+        for account_id in removed:
+            self.remove_account(account_id, forget=forget)
+        for account_id in added:
+            self.add_account(account_id, accounts[account_id])
+        for account_id in updated:
+            self.update_account(account_id, accounts[account_id])
+        if added or removed or updated:
+            logger.info('[SUPERVISOR] accounts synced: %s added, %s removed, %s updated',
+                        len(added), len(removed), len(updated))
+        return {'added': added, 'removed': removed, 'updated': updated}
+
+    async def load_accounts(self):
+        # Adds accounts saved in state store, returns number of added accounts
+        if self._state_store is None:
+            raise ValueError('no state_store configured')
+        states = await self._state_store.load_all()
+        if self._registration is not None:
+            self._registration.load_states(states)
+        added = 0
+        for account_id, state in states.items():
+            if account_id not in self._shard_of:
+                self.add_account(account_id, state.auth)
+                added += 1
+        return added
+
+    def _least_loaded_shard(self, exclude=None):
+        shards = [shard for shard in self._shards if shard is not exclude and (shard.alive or not self._started)]
+        if not shards:
+            raise RuntimeError('No live workers')
+        return min(shards, key=lambda shard: len(shard.accounts))
+
+    def _assign(self, account_id, shard):
+        self._shard_of[account_id] = shard
+        shard.accounts.add(account_id)
+        self._send(shard, [(COMMAND_ADD, account_id, self._auths.get(account_id))])
+
+    def _send(self, shard, commands):
+        if shard.alive and not shard.writer.transport.is_closing():
+            self.stats['bytes_sent'] += _write_frame(shard.writer, commands)
+
+    async def start(self):
+        self._started = True
+        await asyncio.gather(*[self._start_shard(shard) for shard in self._shards])
+
+    async def _start_shard(self, shard):
+        parent_sock, child_sock = socket.socketpair()
+        inherited = []
+        if self._context.get_start_method() == 'fork':
+            inherited = [other.sock for other in self._shards if other.sock is not None]
+        process = self._context.Process(target=_run_shard, args=(shard.shard_id, child_sock, self._config, inherited),
+                                        name='fbns-shard-{}'.format(shard.shard_id), daemon=True)
+        process.start()
+        child_sock.close()
+
+        reader, writer = await asyncio.open_unix_connection(sock=parent_sock)
+        shard.process = process
+        shard.sock = parent_sock
+        shard.writer = writer
+        shard.started_at = time.monotonic()
+        shard.alive = True
+        self.stats['workers_started'] += 1
+        logger.info('[SUPERVISOR] shard %s started, pid %s, %s accounts', shard.shard_id, process.pid,
+                    len(shard.accounts))
+        self._send(shard, [(COMMAND_ADD, account_id, self._auths.get(account_id)) for account_id in shard.accounts])
+        shard.task = asyncio.ensure_future(self._read_shard(shard, reader))
+
+    async def _read_shard(self, shard, reader):
+        try:
+            while True:
+                if not self._reading_resumed.is_set():
+                    await self._reading_resumed.wait()
+                events = await _read_frame(reader)
+                self.stats['frames'] += 1
+                for event in events:
+                    if event[0] == EVENT_METRICS:
+                        shard.metrics = event[2]
+                        continue
+                    try:
+                        self._handle_event(*event)
+                    except Exception as exc:
+                        logger.error('[SUPERVISOR] error in event handler', exc_info=exc)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            shard.alive = False
+            shard.writer.close()
+            shard.sock = None
+        if not self._stopping:
+            await self._on_shard_exit(shard)
+
+    def _handle_event(self, kind, account_id, value):
+        if account_id not in self._shard_of:
+            # Removed while the event was in flight
+            return
+        if kind == EVENT_PUSH:
+            self.stats['pushes'] += 1
+            if self._push_queues:
+                for queue in self._push_queues:
+                    queue.put((account_id, value))
+                if any(queue.closed for queue in self._push_queues):
+                    self._push_queues = [queue for queue in self._push_queues if not queue.closed]
+            self._run_callback(self.on_fbns_message, account_id, value)
+        elif kind == EVENT_AUTH:
+            # Restarted or rebalanced worker connects with received credentials
+            self._auths[account_id] = value
+            if self._state_store is not None:
+                self._state_store.save_auth(account_id, value)
+            self._run_callback(self.on_fbns_auth, account_id, value)
+        elif kind == EVENT_TOKEN:
+            if self._state_store is not None:
+                self._state_store.save_token(account_id, value)
+            if self._registration is not None:
+                self._registration.submit(account_id, value)
+            self._run_callback(self.on_fbns_token, account_id, value)
+        elif kind == EVENT_STATE:
+            self._states[account_id] = value
+            self._run_callback(self.on_state_change, account_id, value)
+
+    @staticmethod
+    def _run_callback(callback, *args):
+        result = callback(*args)
+        if asyncio.iscoroutine(result):
+            asyncio.ensure_future(result)
+
+    async def _on_shard_exit(self, shard):
+        if shard.metrics is not None:
+            self._retired_metrics.merge(shard.metrics, gauges=False)
+            shard.metrics = None
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, shard.process.join)
+        self.stats['workers_exited'] += 1
+        uptime = time.monotonic() - shard.started_at
+        if uptime >= self._stable_after:
+            shard.restarts = 0
+        logger.error('[SUPERVISOR] shard %s (pid %s) exited with code %s after %.1f seconds',
+                     shard.shard_id, shard.process.pid, shard.process.exitcode, uptime)
+
+        delay = self._restart_policy.next_delay(shard.restarts)
+        if delay is None:
+            self._rebalance(shard)
+            return
+        shard.restarts += 1
+        self.stats['restarts'] += 1
+        await asyncio.sleep(delay)
+        if not self._stopping:
+            await self._start_shard(shard)
+
+    def _rebalance(self, shard):
+        # Give accounts of a shard which is not restarted any more to live shards
+        accounts, shard.accounts = shard.accounts, set()
+        logger.error('[SUPERVISOR] shard %s is not restarted, moving %s accounts', shard.shard_id, len(accounts))
+        if not any(other.alive for other in self._shards):
+            logger.error('[SUPERVISOR] no live workers left')
+            shard.accounts = accounts
+            return
+        for account_id in accounts:
+            self.stats['rebalanced'] += 1
+            self._assign(account_id, self._least_loaded_shard(exclude=shard))
+
+    async def stop(self, timeout=10):
+        self._stopping = True
+        for shard in self._shards:
+            self._send(shard, [(COMMAND_STOP,)])
+        tasks = [shard.task for shard in self._shards if shard.task is not None]
+        if tasks:
+            # Workers disconnect their sessions and send remaining events before exit
+            await asyncio.wait(tasks, timeout=timeout)
+        for shard in self._shards:
+            if shard.process is not None and shard.process.is_alive():
+                shard.process.terminate()
+            if shard.task is not None and not shard.task.done():
+                shard.task.cancel()
+        if self._state_store is not None:
+            await self._state_store.flush()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
@@ -0,0 +1,118 @@
+import asyncio
+import random
+import weakref
+
+from gmqtt.client import logger
+
+
+class TimerWheelEntry(object):
+    __slots__ = ('callback', 'args', 'rounds', 'slot')
+
+    def __init__(self, callback, args, rounds):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.slot = None
+
+    def cancel(self):
+        # Same as asyncio.TimerHandle.cancel(), safe to call more than once
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+
+    def cancelled(self):
+        return self.slot is None
+
+
+class TimerWheel(object):
+    # Hashed timing wheel: one loop timer ticking every `resolution` seconds runs callbacks of all
+    # entries due in that tick instead of a TimerHandle per entry in the event loop heap.
+    # Callbacks run up to `resolution` seconds early. Delays are shortened at random by up to
+    # `jitter` of their length, so entries scheduled at the same time spread out over the next rounds.
+    # The timer only ticks while there are entries.
+    def __init__(self, resolution=1.0, slots=1024, jitter=0.0, loop=None):
+        self.resolution = resolution
+        self._jitter = jitter
+        # Weak reference, wheels kept per loop in _wheels must not keep their loop alive
+        self._loop_ref = weakref.ref(loop or asyncio.get_event_loop())
+        self._slots = [set() for _ in range(slots)]
+        self._position = 0
+        self._next_tick = None
+        self._handle = None
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots)
+
+    @property
+    def _loop(self):
+        return self._loop_ref()
+
+    def schedule(self, delay, callback, *args, jitter=None):
+        # Returns entry with cancel() like loop.call_later()
+        jitter = self._jitter if jitter is None else jitter
+        if jitter:
+            delay -= delay * jitter * random.random()
+        ticks = max(1, int(delay / self.resolution))
+        slots = len(self._slots)
+        entry = TimerWheelEntry(callback, args, (ticks - 1) // slots)
+        entry.slot = self._slots[(self._position + ticks) % slots]
+        entry.slot.add(entry)
+        if self._handle is None:
+            self._next_tick = self._loop.time() + self.resolution
+            self._handle = self._loop.call_at(self._next_tick, self._tick)
+        return entry
+
+    def _tick(self):
+        # Ticks missed while the loop was blocked are run now
+        now = self._loop.time()
+        while self._next_tick <= now:
+            self._advance()
+            self._next_tick += self.resolution
+        if any(self._slots):
+            self._handle = self._loop.call_at(self._next_tick, self._tick)
+        else:
+            self._handle = None
+
+    def _advance(self):
+        self._position = (self._position + 1) % len(self._slots)
+        slot = self._slots[self._position]
+        if not slot:
+            return
+        due = []
+        for entry in slot:
+            if entry.rounds:
+                entry.rounds -= 1
+            else:
+                due.append(entry)
+        for entry in due:
+            slot.discard(entry)
+            entry.slot = None
+        for entry in due:
+            try:
+                entry.callback(*entry.args)
+            except Exception as exc:
+                logger.error('[TIMER WHEEL] callback %r failed', entry.callback, exc_info=exc)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for slot in self._slots:
+            for entry in slot:
+                entry.slot = None
+            slot.clear()
+
+
+_wheels = weakref.WeakKeyDictionary()
+
+
+def get_keepalive_wheel():
+    # Wheel of the current event loop shared by keepalive timers of all connections
+    loop = asyncio.get_event_loop()
+    for other in [other for other in _wheels if other.is_closed()]:
+        # Entries left on a closed loop may still reference it through their callbacks
+        _wheels.pop(other).close()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = _wheels[loop] = TimerWheel(resolution=1.0, slots=1024, jitter=0.1, loop=loop)
+    return wheel
@@ -0,0 +1,89 @@
+import collections
+import ssl
+import time
+
+from gmqtt.client import logger
+
+from .metrics import get_default_metrics
+
+# AEAD suites with ECDHE key exchange, TLS 1.3 suites are not affected by set_ciphers
+CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20'
+
+
+class FBNSSSLContext(ssl.SSLContext):
+    # Client context shared by connections: the latest TLS session of every server host name is kept
+    # and offered by the next connection to that host, a resumed handshake skips certificate
+    # verification and key exchange. Handshakes are counted in stats and observed in
+    # fbns_tls_handshake_seconds metric (default registry if metrics is None, False disables).
+    def __new__(cls, protocol=ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        return super().__new__(cls, protocol)
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT, metrics=None):
+        super().__init__()
+        self._metrics = get_default_metrics() if metrics is None else (metrics or None)
+        # server_hostname -> ssl.SSLSession
+        self._sessions = {}
+        self.stats = collections.Counter()
+        self.handshake_time = 0.0
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        # Called by asyncio for every TLS connection
+        if session is None and not server_side:
+            session = self.get_session(server_hostname)
+        sslobj = super().wrap_bio(incoming, outgoing, server_side=server_side, server_hostname=server_hostname,
+                                  session=session)
+        sslobj.fbns_handshake_started = time.monotonic()
+        return sslobj
+
+    def get_session(self, server_hostname):
+        session = self._sessions.get(server_hostname)
+        if session is not None and session.time + session.timeout <= time.time():
+            del self._sessions[server_hostname]
+            self.stats['sessions_expired'] += 1
+            return None
+        return session
+
+    def save_session(self, ssl_object):
+        # TLS 1.3 tickets arrive after the handshake, so this is called again once data was received
+        session = ssl_object.session
+        if session is not None and (session.has_ticket or session.id):
+            self._sessions[ssl_object.server_hostname] = session
+
+    def clear_sessions(self):
+        self._sessions.clear()
+
+    def handshake_done(self, ssl_object):
+        started = getattr(ssl_object, 'fbns_handshake_started', None)
+        elapsed = time.monotonic() - started if started is not None else 0.0
+        resumed = ssl_object.session_reused
+        self.stats['handshakes'] += 1
+        self.stats['resumed' if resumed else 'full'] += 1
+        self.handshake_time += elapsed
+        if self._metrics is not None:
+            self._metrics.tls_handshake_seconds.observe(elapsed, ('1' if resumed else '0',))
+        logger.debug('[TLS] %s handshake with %s in %.1f ms', 'resumed' if resumed else 'full',
+                     ssl_object.server_hostname, elapsed * 1000)
+        self.save_session(ssl_object)
+
+
+def create_ssl_context(cafile=None, capath=None, cadata=None, metrics=None):
+    # Verifying client context, system CA certificates are loaded unless cafile, capath or cadata is given
+    context = FBNSSSLContext(metrics=metrics)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.set_ciphers(CIPHERS)
+    if cafile or capath or cadata:
+        context.load_verify_locations(cafile, capath, cadata)
+    else:
+        context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    return context
+
+
+_default_context = None
+
+
+def get_default_ssl_context():
+    # Used by connections made with ssl=True, loading CA certificates is done once per process
+    global _default_context
+    if _default_context is None:
+        _default_context = create_ssl_context()
+    return _default_context
@@ -0,0 +1,82 @@
+import collections
+import contextlib
+import random
+import time
+
+from gmqtt.mqtt.handler import _empty_callback
+
+
+class Trace(object):
+    # Spans of one received message in the order they ran: (name, seconds)
+    __slots__ = ('trace_id', 'name', 'started_at', 'duration', 'attributes', 'spans', '_started')
+
+    def __init__(self, name):
+        self.trace_id = '{:016x}'.format(random.getrandbits(64))
+        self.name = name
+        self.started_at = time.time()
+        self.duration = None
+        self.attributes = {}
+        self.spans = []
+        self._started = time.perf_counter()
+
+    def add_span(self, name, duration):
+        self.spans.append((name, duration))
+
+    @contextlib.contextmanager
+    def span(self, name):
+        # with trace.span('my_handler'): ...
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.spans.append((name, time.perf_counter() - started))
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'spans': [{'name': name, 'duration': duration} for name, duration in self.spans],
+        }
+
+    def __repr__(self):
+        return '<Trace {} {} {}>'.format(self.name, self.trace_id, ' '.join(
+            '{}={:.3f}ms'.format(name, duration * 1000) for name, duration in self.spans))
+
+
+class Tracer(object):
+    # Head-based sampling: the decision is made when a message is received, only sampled messages
+    # are timed and passed to on_trace. Clients without tracer don't trace at all, share one tracer
+    # between clients with FBNSMQTTClient(tracer=...) or client_kwargs of the pool.
+    def __init__(self, sample_rate=0.01, keep=1000):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be in [0, 1]')
+        self.sample_rate = sample_rate
+        # Last finished traces
+        self.recent = collections.deque(maxlen=keep)
+        self.sampled = 0
+        self._on_trace_callback = _empty_callback
+
+    @property
+    def on_trace(self):
+        return self._on_trace_callback
+
+    @on_trace.setter
+    def on_trace(self, cb):
+        if not callable(cb):
+            raise ValueError
+        self._on_trace_callback = cb
+
+    def start_trace(self, name):
+        # Returns None for messages not sampled
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        self.sampled += 1
+        return Trace(name)
+
+    def finish(self, trace):
+        trace.duration = time.perf_counter() - trace._started
+        self.recent.append(trace)
+        self.on_trace(trace)
@@ -0,0 +1,56 @@
+import asyncio
+import subprocess
+import sys
+
+import pytest
+
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+
+
+@pytest.fixture
+def loop():
+    # New event loop per test, tests run coroutines with loop.run_until_complete()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    # gmqtt clients start _resend_qos_messages tasks that run until the loop is closed
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        loop.run_until_complete(asyncio.wait(tasks))
+    loop.run_until_complete(loop.shutdown_asyncgens())
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def receive(loop):
+    # receive(client, payloads) feeds push payloads to client.on_message and waits until they are dispatched
+    def receive(client, payloads):
+        async def run():
+            for payload in payloads:
+                client.on_message(client, FBNSMQTTClient.MESSAGE_TOPIC_ID, payload, 1, {})
+            await client.drain(5)
+
+        loop.run_until_complete(run())
+
+    return receive
+
+
+@pytest.fixture
+def start_broker():
+    # Starts python -m fbns_mqtt.broker with given arguments in another process, returns its port
+    brokers = []
+
+    def start(*args):
+        broker = subprocess.Popen([sys.executable, '-u', '-m', 'fbns_mqtt.broker', '--port', '0'] + list(args),
+                                  stdout=subprocess.PIPE, universal_newlines=True)
+        brokers.append(broker)
+        return int(broker.stdout.readline().rsplit(':', 1)[1])
+
+    yield start
+    for broker in brokers:
+        broker.terminate()
+        broker.wait()
+        broker.stdout.close()
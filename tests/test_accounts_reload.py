@@ -0,0 +1,95 @@
+import asyncio
+import json
+import logging
+import os
+
+import pytest
+
+from fbns_mqtt.broker import FBNSTestBroker
+from fbns_mqtt.cli import _AccountsReloader
+from fbns_mqtt.pool import FBNSMQTTPool, STATE_CONNECTED
+from fbns_mqtt.state import SQLiteStateStore
+from fbns_mqtt.supervisor import FBNSSupervisor
+
+TIMEOUT = 10
+
+
+@pytest.fixture(autouse=True)
+def quiet_logs(caplog):
+    caplog.set_level(logging.CRITICAL)
+
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    # File changes are detected by mtime and size
+    os.utime(path, ns=(os.stat(path).st_mtime_ns + 10 ** 9,) * 2)
+
+
+async def wait_until(predicate):
+    for _ in range(int(TIMEOUT / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return False
+
+
+def test_reload_and_watch_sync_running_pool(loop, tmp_path):
+    accounts = os.path.join(str(tmp_path), 'accounts.json')
+
+    async def run():
+        async with FBNSTestBroker() as broker:
+            store = SQLiteStateStore(os.path.join(str(tmp_path), 'state.sqlite'))
+            pool = FBNSMQTTPool('127.0.0.1', broker.port, ssl=False, state_store=store,
+                                client_kwargs={'metrics': False, 'lean': True})
+            for account_id in ('a', 'b'):
+                pool.add_account(account_id)
+            await asyncio.wait_for(pool.connect(), TIMEOUT)
+            client_a = pool.get_account('a').client
+            reloader = _AccountsReloader(pool, accounts, store, interval=0.02)
+            watch = asyncio.ensure_future(reloader.watch())
+            try:
+                write_json(accounts, ['a', 'c'])
+                await reloader.reload()
+                reloaded = sorted(pool.accounts), pool.count_by_state()
+
+                # Watcher applies changes of the file, bad JSON keeps running accounts
+                with open(accounts, 'w') as f:
+                    f.write('[')
+                await asyncio.sleep(0.1)
+                kept = sorted(pool.accounts)
+                write_json(accounts, ['a', 'c', 'd'])
+                watched = await wait_until(lambda: pool.count_by_state() == {STATE_CONNECTED: 3})
+                same_client = pool.get_account('a').client is client_a
+            finally:
+                watch.cancel()
+                await pool.disconnect()
+                saved = await store.load_all()
+                await store.close()
+            return reloaded, kept, watched, same_client, saved
+
+    reloaded, kept, watched, same_client, saved = loop.run_until_complete(run())
+    assert reloaded == (['a', 'c'], {STATE_CONNECTED: 2})
+    assert kept == ['a', 'c']
+    assert watched
+    # Sessions of accounts still listed are not touched
+    assert same_client
+    # Removed account is forgotten by the state store
+    assert set(saved) == {'a', 'c', 'd'}
+
+
+def test_supervisor_sync_accounts_diff(loop):
+    async def run():
+        supervisor = FBNSSupervisor('127.0.0.1', 1, workers=2)
+        supervisor.add_account('a', {'ck': 1, 'cs': 'p'})
+        supervisor.add_account('b')
+        # Credentials received by a worker replace configured ones
+        supervisor._auths['b'] = {'ck': 2, 'cs': 'received'}
+        unchanged = supervisor.sync_accounts({'a': {'ck': 1, 'cs': 'p'}, 'b': {'ck': 2, 'cs': 'received'}})
+        result = supervisor.sync_accounts({'a': {'ck': 1, 'cs': 'rotated'}, 'c': None})
+        return unchanged, result, sorted(account_id for account_id in ('a', 'b', 'c') if account_id in supervisor)
+
+    unchanged, result, accounts = loop.run_until_complete(run())
+    assert unchanged == {'added': [], 'removed': [], 'updated': []}
+    assert result == {'added': ['c'], 'removed': ['b'], 'updated': ['a']}
+    assert accounts == ['a', 'c']
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+
+import pytest
+
+from fbns_mqtt.broker import FBNSTestBroker
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient, FBNSPush
+from fbns_mqtt.pool import FBNSMQTTPool, STATE_CONNECTED
+
+TIMEOUT = 10
+
+
+@pytest.fixture(autouse=True)
+def quiet_logs(caplog):
+    caplog.set_level(logging.ERROR)
+
+
+@pytest.mark.parametrize('lean', [False, True])
+def test_connect_token_push(loop, lean):
+    async def run():
+        async with FBNSTestBroker(push_rate=100) as broker:
+            client = FBNSMQTTClient(metrics=False, lean=lean)
+            tokens = []
+            auths = []
+            pushes = asyncio.Queue()
+            client.on_fbns_token = tokens.append
+            client.on_fbns_auth = auths.append
+            client.on_fbns_message = pushes.put_nowait
+            session = asyncio.ensure_future(client.connect('127.0.0.1', broker.port))
+            try:
+                push = await asyncio.wait_for(pushes.get(), TIMEOUT)
+                for _ in range(100):
+                    if tokens:
+                        break
+                    await asyncio.sleep(0.05)
+            finally:
+                await client.disconnect()
+                session.cancel()
+            return broker, client, tokens, auths, push
+
+    broker, client, tokens, auths, push = loop.run_until_complete(run())
+    assert isinstance(push, FBNSPush)
+    assert push.notification is not None
+    # New device gets credentials in CONNACK and a token for /fbns_reg_req
+    assert broker.stats['new_devices'] == 1
+    assert auths and auths[0]['ck'] == client.fbns_auth.userId
+    assert tokens and tokens[0] in broker.tokens.values()
+    assert client.stats['messages'] >= 1
+
+
+def test_pool_sync_accounts(loop):
+    async def run():
+        async with FBNSTestBroker() as broker:
+            pool = FBNSMQTTPool('127.0.0.1', broker.port, ssl=False,
+                                client_kwargs={'metrics': False, 'lean': True})
+            for account_id in ('a', 'b', 'c'):
+                pool.add_account(account_id)
+            await asyncio.wait_for(pool.connect(), TIMEOUT)
+            clients = {account_id: account.client for account_id, account in pool.accounts.items()}
+            auth_c = pool.get_account('c').fbns_auth.as_dict()
+
+            # Received credentials given back don't reconnect
+            result = await pool.sync_accounts({'a': None, 'b': None, 'c': auth_c})
+            assert result == {'added': [], 'removed': [], 'updated': []}
+
+            result = await pool.sync_accounts({'a': None, 'c': dict(auth_c, cs='rotated'), 'd': None})
+            try:
+                same_client = pool.get_account('a').client is clients['a']
+                return result, pool.count_by_state(), same_client, pool.get_account('a'), pool.get_account('c')
+            finally:
+                await pool.disconnect()
+
+    result, states, same_client, account_a, account_c = loop.run_until_complete(run())
+    assert result == {'added': ['d'], 'removed': ['b'], 'updated': ['c']}
+    assert states == {STATE_CONNECTED: 3}
+    assert same_client and account_a.connects == 1
+    assert account_c.connects == 2 and account_c.fbns_auth.password == 'rotated'
@@ -0,0 +1,100 @@
+import asyncio
+
+from fbns_mqtt.broker import make_push
+from fbns_mqtt.bus import PushBus
+from fbns_mqtt.delivery import OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient, FBNSPush
+from fbns_mqtt.metrics import FBNSMetrics, MetricsRegistry
+from fbns_mqtt.pool import FBNSMQTTPool
+
+
+def pushes(*collapse_keys):
+    return [FBNSPush(make_push(16, collapse_key=collapse_key)) for collapse_key in collapse_keys]
+
+
+def test_subscribers_get_same_pushes_filtered_by_collapse_key(loop):
+    async def run():
+        bus = PushBus(metrics=False)
+        client = FBNSMQTTClient(metrics=False)
+        bus.attach(client)
+        handled = []
+        bus.subscribe('all', handled.append)
+        comments = bus.subscribe('comments', collapse_keys={'comment'})
+        items = pushes('comment', 'like', 'comment')
+        for push in items:
+            client.on_fbns_message(push)
+        await asyncio.sleep(0.01)
+        received = [comments.get_nowait() for _ in range(len(comments))]
+        await bus.close()
+        return items, handled, received
+
+    items, handled, received = loop.run_until_complete(run())
+    assert handled == items
+    assert received == [items[0], items[2]]
+    assert received[0] is handled[0]
+
+
+def test_slow_subscriber_drops_oldest_without_blocking_others(loop):
+    registry = MetricsRegistry()
+
+    async def run():
+        bus = PushBus(metrics=FBNSMetrics(registry))
+        client = FBNSMQTTClient(metrics=False)
+        bus.attach(client)
+        fast = []
+        bus.subscribe('fast', fast.append)
+        slow = bus.subscribe('slow', maxsize=2, overflow=OVERFLOW_DROP_OLDEST)
+        items = pushes(*['comment'] * 5)
+        for push in items:
+            client.on_fbns_message(push)
+            await asyncio.sleep(0)
+        paused = client.reading_paused
+        stats = bus.stats()
+        queued = [slow.get_nowait() for _ in range(len(slow))]
+        await bus.close()
+        return items, fast, queued, stats, paused
+
+    items, fast, queued, stats, paused = loop.run_until_complete(run())
+    assert fast == items
+    assert queued == items[-2:]
+    assert not paused
+    assert stats['slow']['dropped'] == 3 and stats['slow']['depth'] == 2
+    assert registry.get('fbns_bus_dropped_total').get(('slow',)) == 3
+
+
+def test_full_blocking_subscriber_pauses_all_sources(loop):
+    async def run():
+        bus = PushBus(metrics=False)
+        clients = [FBNSMQTTClient(metrics=False), FBNSMQTTClient(metrics=False)]
+        for client in clients:
+            bus.attach(client)
+        blocking = bus.subscribe('blocking', maxsize=2, overflow=OVERFLOW_BLOCK)
+        # Put over maxsize blocks, sources resume at half of maxsize
+        for push in pushes('comment', 'comment', 'comment'):
+            clients[0].on_fbns_message(push)
+        paused = [client.reading_paused for client in clients]
+        blocking.get_nowait()
+        blocking.get_nowait()
+        resumed = [client.reading_paused for client in clients]
+        await bus.close()
+        return paused, resumed
+
+    paused, resumed = loop.run_until_complete(run())
+    assert paused == [True, True]
+    assert resumed == [False, False]
+
+
+def test_pool_source_items_carry_account_id(loop):
+    async def run():
+        bus = PushBus(metrics=False)
+        pool = FBNSMQTTPool(client_kwargs={'metrics': False})
+        bus.attach(pool)
+        handled = []
+        bus.subscribe('all', lambda account_id, push: handled.append((account_id, push)))
+        push, = pushes('comment')
+        pool.on_fbns_message('a', push)
+        await bus.close()
+        return push, handled
+
+    push, handled = loop.run_until_complete(run())
+    assert handled == [('a', push)]
@@ -0,0 +1,94 @@
+import asyncio
+import json
+import logging
+import os
+import zlib
+
+import pytest
+
+from fbns_mqtt.broker import FBNSTestBroker, make_push
+from fbns_mqtt.capture import CaptureFormatError, CaptureReader, CaptureWriter, replay, replay_fast
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+
+TIMEOUT = 10
+
+
+def push_payload(n):
+    return zlib.compress(json.dumps(make_push(32, nid=str(n))).encode())
+
+
+def test_recorded_pushes_replay_the_same(loop, tmp_path, caplog):
+    caplog.set_level(logging.ERROR)
+    path = os.path.join(str(tmp_path), 'pushes.cap')
+
+    async def record():
+        with CaptureWriter(path) as capture:
+            async with FBNSTestBroker(push_rate=200) as broker:
+                client = FBNSMQTTClient(metrics=False, lean=True, capture=capture)
+                pushes = []
+                client.on_fbns_message = pushes.append
+                await asyncio.wait_for(client.connect('127.0.0.1', broker.port), TIMEOUT)
+                while len(pushes) < 20:
+                    await asyncio.sleep(0.01)
+                await client.disconnect()
+            return pushes, capture.frames
+
+    async def play():
+        client = FBNSMQTTClient(metrics=False, lean=True)
+        pushes = []
+        client.on_fbns_message = pushes.append
+        count = await replay(client, path)
+        return pushes, count
+
+    recorded, frames = loop.run_until_complete(record())
+    replayed, count = loop.run_until_complete(play())
+    # Token registration response is captured too
+    assert count == frames > len(recorded)
+    assert [push.notificationId for push in replayed] == [push.notificationId for push in recorded]
+    assert replayed[0].notification == recorded[0].notification
+
+
+def test_reader_stops_at_truncated_frame(tmp_path):
+    path = os.path.join(str(tmp_path), 'pushes.cap')
+    payloads = [push_payload(n) for n in range(3)]
+    with CaptureWriter(path) as capture:
+        for n, payload in enumerate(payloads):
+            capture.write(FBNSMQTTClient.MESSAGE_TOPIC_ID, payload, timestamp=n)
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 1)
+
+    with CaptureReader(path) as reader:
+        frames = [(timestamp, topic, bytes(payload)) for timestamp, topic, payload in reader]
+        assert reader.truncated
+    assert [timestamp for timestamp, _, _ in frames] == [0, 1]
+    assert frames[1] == (1, FBNSMQTTClient.MESSAGE_TOPIC_ID, payloads[1])
+
+
+def test_reader_rejects_other_files(tmp_path):
+    path = os.path.join(str(tmp_path), 'pushes.cap')
+    with open(path, 'wb') as f:
+        f.write(b'not a capture')
+    with pytest.raises(CaptureFormatError):
+        CaptureReader(path)
+
+
+def test_replay_fast_and_paced(loop, tmp_path):
+    path = os.path.join(str(tmp_path), 'pushes.cap')
+    with CaptureWriter(path) as capture:
+        for n in range(5):
+            capture.write(FBNSMQTTClient.MESSAGE_TOPIC_ID, push_payload(n), timestamp=1000 + n * 0.05)
+
+    async def run():
+        client = FBNSMQTTClient(metrics=False, lean=True)
+        pushes = []
+        client.on_fbns_message = pushes.append
+        fast = replay_fast(client, path)
+        started = loop.time()
+        # Recorded 0.2 seconds played twice as fast
+        paced = await replay(client, path, speed=2.0)
+        return fast, paced, loop.time() - started, pushes
+
+    fast, paced, elapsed, pushes = loop.run_until_complete(run())
+    assert fast == paced == 5
+    assert 0.09 <= elapsed < 0.5
+    assert [push.notificationId for push in pushes] == [str(n) for n in range(5)] * 2
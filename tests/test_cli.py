@@ -0,0 +1,118 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from fbns_mqtt.cli import load_accounts_file, make_sink, merge_saved_auth
+from fbns_mqtt.sinks import NDJSONFileSink, StdoutSink, UnixSocketSink
+from fbns_mqtt.state import SQLiteStateStore
+
+TIMEOUT = 20
+
+
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def test_load_accounts_file(tmp_path):
+    path = os.path.join(str(tmp_path), 'accounts.json')
+    write_json(path, ['a', 'b'])
+    assert load_accounts_file(path) == {'a': None, 'b': None}
+    write_json(path, {'a': {'ck': 1}, 'b': None})
+    assert load_accounts_file(path) == {'a': {'ck': 1}, 'b': None}
+    write_json(path, 'a')
+    with pytest.raises(ValueError):
+        load_accounts_file(path)
+
+
+def test_make_sink():
+    assert isinstance(make_sink('-', 10, 1.0), StdoutSink)
+    assert isinstance(make_sink('file:pushes.ndjson', 10, 1.0), NDJSONFileSink)
+    assert isinstance(make_sink('unix:/run/pushes.sock', 10, 1.0), UnixSocketSink)
+    assert make_sink('none', 10, 1.0) is None
+    with pytest.raises(ValueError):
+        make_sink('file:', 10, 1.0)
+
+
+def test_merge_saved_auth(loop, tmp_path):
+    async def run():
+        store = SQLiteStateStore(os.path.join(str(tmp_path), 'state.sqlite'))
+        store.save_auth('a', {'ck': 1})
+        store.save_auth('b', {'ck': 2})
+        await store.flush()
+        try:
+            merged = await merge_saved_auth({'a': None, 'b': {'ck': 3}, 'c': None}, store)
+            running = await merge_saved_auth({'a': None}, store, fleet={'a'})
+        finally:
+            await store.close()
+        return merged, running
+
+    merged, running = loop.run_until_complete(run())
+    # Accounts file wins, saved credentials fill accounts listed without them
+    assert merged == {'a': {'ck': 1}, 'b': {'ck': 3}, 'c': None}
+    # Running accounts keep the credentials they received
+    assert running == {'a': None}
+
+
+def wait_for(predicate):
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as f:
+        return f.read().count(b'\n')
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_listen_writes_pushes_and_saves_state(loop, tmp_path, start_broker, workers):
+    port = start_broker('--push-rate', '100')
+    directory = str(tmp_path)
+    accounts = os.path.join(directory, 'accounts.json')
+    output = os.path.join(directory, 'pushes.ndjson')
+    state = os.path.join(directory, 'state.sqlite')
+    write_json(accounts, ['a', 'b'])
+
+    process = subprocess.Popen([sys.executable, '-m', 'fbns_mqtt.cli', 'listen', accounts, '--host', '127.0.0.1',
+                                '--port', str(port), '--no-ssl', '--output', 'file:' + output, '--state', state,
+                                '--flush-interval', '0.05', '--stats-interval', '0', '--loop', 'asyncio',
+                                '--workers', str(workers), '--log-level', 'CRITICAL'],
+                               stderr=subprocess.PIPE, universal_newlines=True)
+    try:
+        received = wait_for(lambda: count_lines(output) >= 10)
+        process.send_signal(signal.SIGTERM)
+        _, stderr = process.communicate(timeout=TIMEOUT)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    assert received
+    assert process.returncode == 0
+    assert 'pushes' in stderr
+    with open(output) as f:
+        pushes = [json.loads(line) for line in f]
+    assert {push['account_id'] for push in pushes} == {'a', 'b'}
+    assert all(push['notification'] for push in pushes)
+
+    async def load():
+        store = SQLiteStateStore(state)
+        try:
+            return await store.load_all()
+        finally:
+            await store.close()
+
+    saved = loop.run_until_complete(load())
+    assert set(saved) == {'a', 'b'}
+    assert all(account.auth and account.token for account in saved.values())
@@ -0,0 +1,38 @@
+import zlib
+
+import pytest
+
+from fbns_mqtt.fbns_mqtt import FBNSAuth, FBNSConnectTemplate, deserialize_connect, serialize_connect
+
+AUTHS = [
+    FBNSAuth(),
+    FBNSAuth({'ck': 567310203415052, 'cs': 'password', 'di': '9f0ac3c3-0f1e-4c47-b71c-3c3a5b4f3a44',
+              'ds': 'device-secret'}),
+]
+
+SESSION_IDS = [0, 1, 63, 64, 127, 128, 8191, 8192, 604800000, 2 ** 40, -1]
+
+
+@pytest.mark.parametrize('fbns_auth', AUTHS)
+@pytest.mark.parametrize('session_id', SESSION_IDS)
+def test_build_matches_serialize_connect(fbns_auth, session_id):
+    template = FBNSConnectTemplate(fbns_auth, 9)
+    assert zlib.decompress(template.build(session_id)) == serialize_connect(fbns_auth, session_id)
+
+
+def test_template_is_reused_for_many_sessions():
+    fbns_auth = AUTHS[1]
+    template = FBNSConnectTemplate(fbns_auth, 9)
+    for session_id in (5, 500000, 5):
+        connect = deserialize_connect(zlib.decompress(template.build(session_id)))
+        assert connect.clientInfo.clientMqttSessionId == session_id
+        assert connect.clientInfo.userId == fbns_auth.userId
+        assert connect.password == fbns_auth.password
+
+
+def test_make_key_changes_with_credentials():
+    key = FBNSConnectTemplate.make_key(AUTHS[1], 9)
+    other = FBNSAuth(AUTHS[1].as_dict())
+    other.password = 'rotated'
+    assert FBNSConnectTemplate.make_key(other, 9) != key
+    assert FBNSConnectTemplate.make_key(AUTHS[1], 6) != key
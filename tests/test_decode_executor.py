@@ -0,0 +1,57 @@
+import asyncio
+import json
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from fbns_mqtt.broker import make_push
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.loop_lag import LoopLagMonitor
+
+THRESHOLD = 4096
+
+
+def push_payload(n, size):
+    push = make_push(64, nid=str(n))
+    # Random token doesn't compress, compressed size stays close to size
+    push['token'] = os.urandom(size // 2).hex()
+    return zlib.compress(json.dumps(push).encode())
+
+
+def test_executor_decoded_pushes_keep_arrival_order(loop, receive):
+    # Small payloads arriving while large ones are in the executor wait behind them
+    sizes = [64, 20000, 64, 64, 20000, 20000, 64, 20000, 64]
+    payloads = [push_payload(n, size) for n, size in enumerate(sizes)]
+    assert len(payloads[1]) >= THRESHOLD > len(payloads[0])
+    with ThreadPoolExecutor(2) as executor:
+        client = FBNSMQTTClient(metrics=False, decode_executor=executor, decode_threshold=THRESHOLD,
+                                decode_batch_size=2)
+        pushes = []
+        client.on_fbns_message = pushes.append
+        receive(client, payloads)
+
+    assert [push.notificationId for push in pushes] == [str(n) for n in range(len(sizes))]
+    assert client.stats['bytes_decompressed'] == sum(len(zlib.decompress(payload)) for payload in payloads)
+
+
+def test_loop_lag_monitor_reports_blocked_loop(loop):
+    monitor = LoopLagMonitor(interval=0.01)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        # Blocks the loop, the next tick runs about 0.2 seconds late
+        time.sleep(0.2)
+        await asyncio.sleep(0.05)
+        monitor.stop()
+
+    loop.run_until_complete(run())
+    stats = monitor.stats()
+    assert 0.15 <= stats['max'] < 1.0
+    assert stats['count'] >= 5
+    assert stats['p50'] < 0.1
+    assert stats['mean'] == monitor.total / monitor.count
+
+    monitor.reset()
+    assert monitor.stats() == {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0}
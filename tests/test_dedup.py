@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from fbns_mqtt import dedup
+from fbns_mqtt.dedup import PushDeduplicator, SQLiteDedupBackend
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(dedup.time, 'monotonic', clock)
+    return clock
+
+
+def test_duplicates_within_ttl(clock):
+    deduplicator = PushDeduplicator(ttl=60)
+    assert not deduplicator.seen('nid-1')
+    assert deduplicator.seen('nid-1')
+    assert not deduplicator.seen('nid-2')
+    assert deduplicator.checked == 3
+    assert deduplicator.duplicates == 1
+
+
+def test_key_is_new_again_after_ttl(clock):
+    deduplicator = PushDeduplicator(ttl=60)
+    deduplicator.seen('nid-1')
+    clock.now += 59
+    assert deduplicator.seen('nid-1')
+    clock.now += 1
+    assert not deduplicator.seen('nid-1')
+    # Seen again from now on
+    assert deduplicator.seen('nid-1')
+
+
+def test_expired_keys_are_evicted(clock):
+    deduplicator = PushDeduplicator(ttl=60)
+    for index in range(10):
+        deduplicator.seen(index)
+    clock.now += 30
+    deduplicator.seen('late')
+    clock.now += 31
+    deduplicator.seen('new')
+    assert len(deduplicator) == 2
+
+
+def test_oldest_keys_are_evicted_over_maxsize(clock):
+    deduplicator = PushDeduplicator(maxsize=3, ttl=60)
+    for key in 'abcd':
+        deduplicator.seen(key)
+    assert len(deduplicator) == 3
+    assert not deduplicator.seen('a')
+    assert deduplicator.seen('d')
+
+
+def test_remember_keeps_later_expiry(clock):
+    deduplicator = PushDeduplicator(ttl=60)
+    deduplicator.remember('remote', 10)
+    assert deduplicator.seen('remote')
+    deduplicator.remember('remote', 0)
+    clock.now += 11
+    assert not deduplicator.seen('remote')
+
+
+def test_sqlite_backend_shares_keys_between_processes(loop, tmp_path):
+    path = os.path.join(str(tmp_path), 'dedup.sqlite')
+    # Two backends on one file have different origins like two processes
+    first = PushDeduplicator(backend=SQLiteDedupBackend(path, flush_interval=60))
+    second = PushDeduplicator(backend=SQLiteDedupBackend(path, flush_interval=60))
+
+    async def run():
+        assert not first.seen('nid-1')
+        assert not second.seen('nid-2')
+        await first._backend.flush()
+        await second._backend.flush()
+        await first._backend.flush()
+        assert first.seen('nid-2')
+        assert second.seen('nid-1')
+        # Keys are shared by the next flush only
+        assert not first.seen('nid-3')
+        assert not second.seen('nid-3')
+        await first._backend.close()
+        await second._backend.close()
+
+    loop.run_until_complete(run())
+    assert first._backend.writes == 2
+    assert first._backend.errors == 0
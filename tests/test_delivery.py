@@ -0,0 +1,136 @@
+import asyncio
+import logging
+
+import pytest
+
+from fbns_mqtt.broker import FBNSTestBroker
+from fbns_mqtt.delivery import (OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, OVERFLOW_SAMPLE,
+                                PushQueue, PushQueueClosed)
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+
+TIMEOUT = 10
+
+
+def drain(queue):
+    return [queue.get_nowait() for _ in range(len(queue))]
+
+
+def test_block_accepts_over_maxsize_and_signals_full_and_drain():
+    events = []
+    queue = PushQueue(4, OVERFLOW_BLOCK, on_full=lambda q: events.append('full'),
+                      on_drain=lambda q: events.append('drain'))
+    for item in range(6):
+        assert queue.put(item)
+    assert len(queue) == 6
+    assert queue.blocked
+    assert events == ['full']
+
+    # Unblocks at low watermark, maxsize // 2 by default
+    for expected in range(4):
+        assert queue.get_nowait() == expected
+    assert not queue.blocked
+    assert events == ['full', 'drain']
+    assert drain(queue) == [4, 5]
+    assert queue.dropped == 0
+
+
+def test_drop_oldest():
+    dropped = []
+    queue = PushQueue(3, OVERFLOW_DROP_OLDEST, on_drop=dropped.append)
+    for item in range(5):
+        assert queue.put(item)
+    assert drain(queue) == [2, 3, 4]
+    assert dropped == [0, 1]
+    assert queue.dropped == 2
+
+
+def test_drop_newest():
+    dropped = []
+    queue = PushQueue(3, OVERFLOW_DROP_NEWEST, on_drop=dropped.append)
+    results = [queue.put(item) for item in range(5)]
+    assert results == [True, True, True, False, False]
+    assert drain(queue) == [0, 1, 2]
+    assert dropped == [3, 4]
+
+
+def test_sample_keeps_one_in_n_above_low_watermark():
+    queue = PushQueue(10, OVERFLOW_SAMPLE, low_watermark=4, sample_rate=0.25)
+    for item in range(20):
+        queue.put(item)
+    # All items below low watermark, then every 4th one until full
+    assert drain(queue) == [0, 1, 2, 3, 7, 11, 15, 19]
+    assert queue.dropped == 12
+
+
+def test_sample_drops_newest_when_full():
+    queue = PushQueue(4, OVERFLOW_SAMPLE, low_watermark=2, sample_rate=1)
+    for item in range(6):
+        queue.put(item)
+    assert drain(queue) == [0, 1, 2, 3]
+    assert queue.dropped == 2
+
+
+@pytest.mark.parametrize('kwargs', [{'overflow': 'unknown'}, {'maxsize': 0}, {'sample_rate': 0}])
+def test_invalid_arguments(kwargs):
+    with pytest.raises(ValueError):
+        PushQueue(**kwargs)
+
+
+def test_async_iteration_ends_after_close(loop):
+    queue = PushQueue(10)
+
+    async def consume():
+        return [item async for item in queue]
+
+    task = loop.create_task(consume())
+    queue.put(1)
+    queue.put(2)
+    loop.call_soon(queue.close)
+    assert loop.run_until_complete(task) == [1, 2]
+    assert not queue.put(3)
+    with pytest.raises(PushQueueClosed):
+        loop.run_until_complete(queue.get())
+
+
+def test_close_unblocks_producer():
+    events = []
+    queue = PushQueue(1, OVERFLOW_BLOCK, on_full=lambda q: events.append('full'),
+                      on_drain=lambda q: events.append('drain'))
+    queue.put(1)
+    queue.put(2)
+    queue.close()
+    assert events == ['full', 'drain']
+
+
+def test_full_queue_stops_reading_from_flooding_broker(loop, caplog):
+    caplog.set_level(logging.ERROR)
+    maxsize = 20
+
+    async def run():
+        async with FBNSTestBroker(push_rate=20000, push_sizes=[(64, 1)]) as broker:
+            client = FBNSMQTTClient(metrics=False, lean=True)
+            queue = client.pushes(maxsize=maxsize)
+            put = queue.put
+            sizes = []
+
+            def tracking_put(item):
+                result = put(item)
+                sizes.append(len(queue))
+                return result
+
+            queue.put = tracking_put
+            await asyncio.wait_for(client.connect('127.0.0.1', broker.port), TIMEOUT)
+            received = 0
+            async for _ in queue:
+                received += 1
+                await asyncio.sleep(0.002)
+                if received == 200:
+                    break
+            await client.disconnect()
+            return broker.stats['pushes'], received, max(sizes)
+
+    sent, received, max_size = loop.run_until_complete(run())
+    # Broker keeps publishing into socket buffers while the client doesn't read
+    assert sent > 2 * received
+    # Packet that fills the queue is the last one read until the queue drains
+    assert max_size <= maxsize + 1
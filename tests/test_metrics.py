@@ -0,0 +1,77 @@
+import asyncio
+
+from fbns_mqtt.metrics import MetricsRegistry, start_metrics_server
+
+
+def test_render_counter_gauge_histogram():
+    registry = MetricsRegistry()
+    registry.counter('c_total', 'Counter').inc()
+    pushes = registry.counter('pushes_total', 'Pushes', ('collapse_key', 'result'))
+    pushes.inc(('com"ment', 'delivered'), 2)
+    registry.gauge('g', 'Gauge').set(0.25)
+    registry.histogram('h_seconds', 'Histogram', buckets=(0.1, 1.0)).observe(0.5)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE c_total counter' in lines
+    assert 'c_total 1' in lines
+    assert 'pushes_total{collapse_key="com\\"ment",result="delivered"} 2' in lines
+    assert 'g 0.25' in lines
+    assert 'h_seconds_bucket{le="0.1"} 0' in lines
+    assert 'h_seconds_bucket{le="1.0"} 1' in lines
+    assert 'h_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'h_seconds_sum 0.5' in lines
+    assert 'h_seconds_count 1' in lines
+
+
+def test_render_non_finite_values():
+    registry = MetricsRegistry()
+    gauge = registry.gauge('g', 'Gauge', ('kind',))
+    gauge.set(float('inf'), ('pos',))
+    gauge.set(float('-inf'), ('neg',))
+    gauge.set(float('nan'), ('nan',))
+    registry.histogram('h', 'Histogram', buckets=(1.0,)).observe(float('inf'))
+
+    lines = registry.render().splitlines()
+    assert 'g{kind="pos"} +Inf' in lines
+    assert 'g{kind="neg"} -Inf' in lines
+    assert 'g{kind="nan"} NaN' in lines
+    assert 'h_bucket{le="+Inf"} 1' in lines
+    assert 'h_sum +Inf' in lines
+
+
+def test_merge_snapshot():
+    worker = MetricsRegistry()
+    worker.counter('c_total', 'Counter').inc(amount=3)
+    worker.gauge('g', 'Gauge').set(2)
+    worker.histogram('h', 'Histogram', buckets=(1.0,)).observe(0.5)
+
+    total = MetricsRegistry()
+    total.merge(worker.snapshot())
+    total.merge(worker.snapshot(), gauges=False)
+
+    assert total.get('c_total').get() == 6
+    assert total.get('g').get() == 2
+    assert total.get('h').count() == 2 and total.get('h').sum() == 1.0
+
+
+def test_metrics_server(loop):
+    registry = MetricsRegistry()
+    registry.counter('c_total', 'Counter').inc()
+
+    async def run():
+        server = await start_metrics_server(registry, port=0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = await reader.read()
+            writer.close()
+            return response
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    response = loop.run_until_complete(run())
+    head, body = response.split(b'\r\n\r\n', 1)
+    assert head.startswith(b'HTTP/1.0 200 OK')
+    assert body.decode() == registry.render()
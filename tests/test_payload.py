@@ -0,0 +1,48 @@
+import json
+import zlib
+
+import pytest
+
+from fbns_mqtt.fbns_mqtt import FBNSDecodeError, FBNSPayloadTooLarge, decode_payload, decompress_payload
+
+DATA = json.dumps({'token': 'x' * 200, 'ck': 1, 'fbpushnotif': json.dumps({'m': 'y' * 300})}).encode()
+PAYLOAD = zlib.compress(DATA)
+
+
+def test_no_limit():
+    assert decompress_payload(PAYLOAD) == DATA
+    assert decompress_payload(PAYLOAD, None) == DATA
+
+
+def test_under_and_exactly_at_limit():
+    assert decompress_payload(PAYLOAD, len(DATA) + 1) == DATA
+    assert decompress_payload(PAYLOAD, len(DATA)) == DATA
+
+
+def test_memoryview_payload():
+    packet = b'\x00\x02' + PAYLOAD
+    assert decompress_payload(memoryview(packet)[2:], len(DATA)) == DATA
+
+
+def test_over_limit():
+    with pytest.raises(FBNSPayloadTooLarge):
+        decompress_payload(PAYLOAD, len(DATA) - 1)
+    assert issubclass(FBNSPayloadTooLarge, FBNSDecodeError)
+
+
+def test_bomb_is_not_inflated():
+    bomb = zlib.compress(b'\x00' * (64 * 1024 * 1024))
+    with pytest.raises(FBNSPayloadTooLarge):
+        decompress_payload(bomb, 1024 * 1024)
+
+
+@pytest.mark.parametrize('max_size', [None, len(DATA), len(DATA) + 100])
+def test_truncated_stream(max_size):
+    with pytest.raises(zlib.error):
+        decompress_payload(PAYLOAD[:-4], max_size)
+    with pytest.raises(zlib.error):
+        decompress_payload(PAYLOAD[:len(PAYLOAD) // 2], max_size)
+
+
+def test_decode_payload():
+    assert decode_payload(PAYLOAD, len(DATA)) == json.loads(DATA.decode())
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+
+import pytest
+
+from fbns_mqtt.broker import FBNSTestBroker, make_push
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.pool import FBNSMQTTPool, STATE_CONNECTED, STATE_FAILED
+from fbns_mqtt.reconnect import ReconnectPolicy
+
+TIMEOUT = 10
+
+CLIENT_KWARGS = {'metrics': False, 'lean': True}
+
+
+@pytest.fixture(autouse=True)
+def quiet_logs(caplog):
+    caplog.set_level(logging.CRITICAL)
+
+
+async def wait_until(predicate):
+    for _ in range(int(TIMEOUT / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return False
+
+
+class CountingClient(FBNSMQTTClient):
+    # Records how many connects run at the same time
+    running = 0
+    max_running = 0
+
+    async def connect(self, *args, **kwargs):
+        cls = type(self)
+        cls.running += 1
+        cls.max_running = max(cls.max_running, cls.running)
+        try:
+            await asyncio.sleep(0.02)
+            await super().connect(*args, **kwargs)
+        finally:
+            cls.running -= 1
+
+
+def test_connects_are_bounded_by_max_concurrent_connects(loop):
+    async def run():
+        async with FBNSTestBroker() as broker:
+            pool = FBNSMQTTPool('127.0.0.1', broker.port, ssl=False, max_concurrent_connects=2,
+                                client_factory=CountingClient, client_kwargs=CLIENT_KWARGS)
+            for account_id in range(6):
+                pool.add_account(account_id)
+            try:
+                await asyncio.wait_for(pool.connect(), TIMEOUT)
+                return pool.count_by_state()
+            finally:
+                await pool.disconnect()
+
+    assert loop.run_until_complete(run()) == {STATE_CONNECTED: 6}
+    assert CountingClient.max_running == 2
+
+
+def test_pushes_are_routed_to_their_account(loop):
+    async def run():
+        async with FBNSTestBroker() as broker:
+            pool = FBNSMQTTPool('127.0.0.1', broker.port, ssl=False, client_kwargs=CLIENT_KWARGS)
+            received = []
+            pool.on_fbns_message = lambda account_id, push: received.append((account_id, push.notificationId))
+            for account_id in ('a', 'b', 'c'):
+                pool.add_account(account_id)
+            try:
+                await asyncio.wait_for(pool.connect(), TIMEOUT)
+                # Every session gets pushes tagged with the user id it connected with
+                for session in broker.sessions.values():
+                    for _ in range(2):
+                        broker.publish_push(session, make_push(16, nid=str(session.auth['ck'])))
+                await wait_until(lambda: len(received) == 6)
+                user_ids = {account_id: str(account.fbns_auth.userId)
+                            for account_id, account in pool.accounts.items()}
+                messages = {account_id: account.messages for account_id, account in pool.accounts.items()}
+            finally:
+                await pool.disconnect()
+            return received, user_ids, messages
+
+    received, user_ids, messages = loop.run_until_complete(run())
+    assert len(received) == 6
+    assert all(user_ids[account_id] == nid for account_id, nid in received)
+    assert messages == {'a': 2, 'b': 2, 'c': 2}
+
+
+def test_connect_timeout_is_retried_by_policy(loop):
+    async def silent(reader, writer):
+        # Accepts the connection but never answers CONNECT
+        await reader.read()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(silent, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        policy = ReconnectPolicy(base_delay=0.01, max_delay=0.05, jitter=0, max_attempts=2)
+        pool = FBNSMQTTPool('127.0.0.1', port, ssl=False, connect_timeout=0.1, reconnect_policy=policy,
+                            client_kwargs=CLIENT_KWARGS)
+        account = pool.add_account('a')
+        try:
+            await asyncio.wait_for(pool.connect(), TIMEOUT)
+            first_error = account.error
+            # First failure and two retries, then the policy gives up
+            retried = await wait_until(lambda: account.connects == 3 and account.state == STATE_FAILED and
+                                       not (account._connect_task and not account._connect_task.done()))
+            await asyncio.sleep(0.1)
+            return first_error, retried, account.connects, account.state, account._retry_handle
+        finally:
+            await pool.disconnect()
+            server.close()
+            await server.wait_closed()
+
+    first_error, retried, connects, state, retry_handle = loop.run_until_complete(run())
+    assert isinstance(first_error, asyncio.TimeoutError)
+    assert retried
+    assert connects == 3 and state == STATE_FAILED
+    assert retry_handle is None
@@ -0,0 +1,107 @@
+import importlib.util
+import json
+import os
+
+import pytest
+
+from fbns_mqtt import fbns_mqtt
+from fbns_mqtt.fbns_mqtt import FBNSPush
+
+
+def load_example(name):
+    # examples/ is not a package, its scripts import each other from their own directory
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', name + '.py')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+notification_data = load_example('instagram_notification_data')
+BadgeCount = notification_data.BadgeCount
+InstagramNotification = notification_data.InstagramNotification
+
+NOTIFICATION = {
+    't': '',
+    'm': 'someone commented: "nice shot"',
+    'tt': 'someone commented: "nice shot"',
+    'ig': 'comments_v2?media_id=1111111111111111111_1111111111&target_comment_id=11111111111111111',
+    'collapse_key': 'comment',
+    'i': 'https://scontent.cdninstagram.com/t51.2885-15/e35/1.jpg',
+    'a': 'https://scontent.cdninstagram.com/t51.2885-19/s150x150/2.jpg',
+    'sound': 'default',
+    'pi': '5a1f7a9e2d3c4b00bc64f2f1d8e6a1c3',
+    'c': 'comment',
+    'u': 2222222222,
+    's': '1111111111',
+    'igo': '',
+    'bc': json.dumps({'dt': 0, 'ac': 1}),
+    'ia': '',
+    'SuppressBadge': '1',
+}
+
+ENVELOPE = {
+    'token': 'AbCdEfGhIjKlMnOp',
+    'ck': '2222222222',
+    'pn': 'com.instagram.android',
+    'cp': 'comment',
+    'fbpushnotif': json.dumps(NOTIFICATION),
+    'nid': '5a1f7a9e-2d3c-4b00-bc64-f2f1d8e6a1c3',
+    'bu': '1',
+}
+
+
+class JSONCounter(object):
+    # Stands in for the json module of fbns_mqtt.fbns_mqtt and counts decoded payloads
+    def __init__(self):
+        self.loads_calls = 0
+
+    def loads(self, data):
+        self.loads_calls += 1
+        return json.loads(data)
+
+    def __getattr__(self, name):
+        return getattr(json, name)
+
+
+def test_notification_is_decoded_on_first_access_only(monkeypatch):
+    counter = JSONCounter()
+    monkeypatch.setattr(fbns_mqtt, 'json', counter)
+    push = FBNSPush(ENVELOPE)
+    assert counter.loads_calls == 0
+    notification = push.notification
+    assert push.notification is notification
+    assert counter.loads_calls == 1
+    assert notification == NOTIFICATION
+
+    empty = FBNSPush({k: v for k, v in ENVELOPE.items() if k != 'fbpushnotif'})
+    assert empty.notification is None
+    assert counter.loads_calls == 1
+
+
+def test_push_rejects_unknown_fields():
+    with pytest.raises(Exception):
+        FBNSPush(dict(ENVELOPE, unknown=1))
+
+
+def test_instagram_notification_parses_envelope():
+    push = FBNSPush(ENVELOPE)
+    assert (push.packageName, push.collapseKey, push.isBuffered) == ('com.instagram.android', 'comment', '1')
+    notification = InstagramNotification(push.notification)
+    assert notification.collapseKey == 'comment'
+    assert notification.message == NOTIFICATION['m']
+    assert notification.intendedRecipientUserId == 2222222222 and notification.sourceUserId == '1111111111'
+    assert notification.actionPath == 'comments_v2'
+    assert notification.actionParams == {'media_id': '1111111111111111111_1111111111',
+                                         'target_comment_id': '11111111111111111'}
+    badge = notification.badgeCount
+    assert isinstance(badge, BadgeCount) and notification.badgeCount is badge
+    assert (badge.td, badge.activities) == (0, 1)
+    # Same result from the fbpushnotif string
+    from_string = InstagramNotification(push.payload)
+    assert (from_string.pushId, from_string.actionParams) == (notification.pushId, notification.actionParams)
+
+    for obj in (push, notification, badge):
+        assert not hasattr(obj, '__dict__')
+    with pytest.raises(Exception):
+        InstagramNotification(dict(NOTIFICATION, unknown=1))
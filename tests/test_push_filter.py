@@ -0,0 +1,102 @@
+import asyncio
+import json
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from fbns_mqtt import fbns_mqtt
+from fbns_mqtt.broker import make_push
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+
+
+def push_payload(collapse_key, **fields):
+    push = make_push(64, collapse_key=collapse_key)
+    push.update(fields)
+    return zlib.compress(json.dumps(push).encode())
+
+
+class JSONCounter(object):
+    # Stands in for the json module of fbns_mqtt.fbns_mqtt and counts decoded payloads
+    def __init__(self):
+        self.loads_calls = 0
+
+    def loads(self, data):
+        self.loads_calls += 1
+        return json.loads(data)
+
+    def __getattr__(self, name):
+        return getattr(json, name)
+
+
+@pytest.fixture
+def json_counter(monkeypatch):
+    counter = JSONCounter()
+    monkeypatch.setattr(fbns_mqtt, 'json', counter)
+    return counter
+
+
+@pytest.mark.parametrize('executor', [False, True])
+def test_filtered_push_skips_handlers_and_json(loop, receive, json_counter, executor):
+    asyncio.set_event_loop(loop)
+    client = FBNSMQTTClient(metrics=False, decode_executor=ThreadPoolExecutor(1) if executor else None,
+                            decode_threshold=0)
+    delivered = []
+    comments = []
+    client.on_fbns_message = delivered.append
+    client.add_push_handler('comment', comments.append)
+    client.set_push_filter(collapse_keys={'comment', 'direct_v2_message'})
+
+    receive(client, [push_payload('like'), push_payload('comment'), push_payload('direct_v2_message')])
+
+    assert [push.collapseKey for push in comments] == ['comment']
+    assert [push.collapseKey for push in delivered] == ['direct_v2_message']
+    # Collapse key of a push dropped before decoding is unknown
+    assert client.pushes_dropped == {None: 1}
+    assert sum(client.pushes_delivered.values()) == 2
+    assert json_counter.loads_calls == 2
+
+
+def test_push_passing_prefilter_is_dropped_by_decoded_fields(loop, receive, json_counter):
+    asyncio.set_event_loop(loop)
+    client = FBNSMQTTClient(metrics=False)
+    delivered = []
+    client.on_fbns_message = delivered.append
+    client.set_push_filter(collapse_keys={'comment'}, package_names={FBNSMQTTClient.PACKAGE_NAME})
+
+    # Wanted key and package appear in the payload, but not as collapse key and package name
+    receive(client, [push_payload('like', t='comment'),
+                           push_payload('comment', pn='other', t=FBNSMQTTClient.PACKAGE_NAME)])
+
+    assert delivered == []
+    assert client.pushes_dropped == {'like': 1, 'comment': 1}
+    assert json_counter.loads_calls == 2
+
+
+def escaped_payload(collapse_key, escapes):
+    # Payload from a JSON encoder escaping characters json.dumps writes as is
+    data = json.dumps(make_push(64, collapse_key=collapse_key))
+    for char, escaped in escapes:
+        data = data.replace(char, escaped)
+    return zlib.compress(data.encode())
+
+
+@pytest.mark.parametrize('collapse_key, payload', [
+    ('déjà_vu', push_payload('déjà_vu')),
+    ('direct/v2', escaped_payload('direct/v2', [('/', '\\/')])),
+    ('<b>', escaped_payload('<b>', [('<', '\\u003c'), ('>', '\\u003e')])),
+])
+def test_prefilter_is_disabled_for_values_escaped_in_json(loop, receive, json_counter, collapse_key, payload):
+    asyncio.set_event_loop(loop)
+    client = FBNSMQTTClient(metrics=False)
+    delivered = []
+    client.on_fbns_message = delivered.append
+    client.set_push_filter(collapse_keys={'comment', collapse_key})
+    assert client._push_prefilter is None
+    assert collapse_key.encode() not in zlib.decompress(payload)
+
+    receive(client, [payload, push_payload('like')])
+
+    assert [push.collapseKey for push in delivered] == [collapse_key]
+    assert client.pushes_dropped == {'like': 1}
+    assert json_counter.loads_calls == 2
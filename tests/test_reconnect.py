@@ -0,0 +1,161 @@
+import asyncio
+import logging
+
+import pytest
+from gmqtt.mqtt.handler import MQTTConnectError
+
+from fbns_mqtt.broker import FBNSTestBroker
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.pool import FBNSMQTTPool, STATE_CONNECTED, STATE_FAILED
+from fbns_mqtt.reconnect import ReconnectPolicy
+
+TIMEOUT = 10
+
+FAST_POLICY = ReconnectPolicy(base_delay=0.01, max_delay=0.05, jitter=0)
+
+
+@pytest.fixture(autouse=True)
+def quiet_logs(caplog):
+    caplog.set_level(logging.CRITICAL)
+
+
+async def wait_until(predicate):
+    for _ in range(int(TIMEOUT / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return False
+
+
+def test_policy_delays():
+    policy = ReconnectPolicy(base_delay=1, max_delay=10, jitter=0, max_attempts=5)
+    assert [policy.next_delay(attempt) for attempt in range(6)] == [1, 2, 4, 8, 10, None]
+    assert policy.next_delay(0, returncode=2) is None
+    assert policy.next_delay(0, returncode=4) == policy.auth_failure_delay
+    jittered = ReconnectPolicy(base_delay=1, jitter=0.5).next_delay(0)
+    assert 0.5 <= jittered <= 1
+
+
+def test_reconnect_after_broker_closes_connection(loop):
+    async def run():
+        async with FBNSTestBroker() as broker:
+            client = FBNSMQTTClient(metrics=False, reconnect_policy=FAST_POLICY)
+            auths = []
+            client.on_fbns_auth = auths.append
+            await asyncio.wait_for(client.connect('127.0.0.1', broker.port), TIMEOUT)
+            for session in list(broker.sessions.values()):
+                session.writer.close()
+            try:
+                reconnected = await wait_until(lambda: len(auths) == 2)
+            finally:
+                await client.disconnect()
+            return broker, client, auths, reconnected
+
+    broker, client, auths, reconnected = loop.run_until_complete(run())
+    assert reconnected
+    assert broker.stats['connects'] == 2
+    assert client.stats['connects'] == 2 and client.stats['reconnects'] == 1
+    # Credentials received in the first CONNACK are used for the second CONNECT
+    assert broker.stats['new_devices'] == 1
+    assert auths[1]['ck'] == auths[0]['ck']
+
+
+def test_no_reconnect_after_disconnect(loop):
+    async def run():
+        async with FBNSTestBroker() as broker:
+            client = FBNSMQTTClient(metrics=False, reconnect_policy=FAST_POLICY)
+            await asyncio.wait_for(client.connect('127.0.0.1', broker.port), TIMEOUT)
+            await client.disconnect()
+            await asyncio.sleep(0.2)
+            return broker, client
+
+    broker, client = loop.run_until_complete(run())
+    assert broker.stats['connects'] == 1
+    assert client.stats['reconnects'] == 0
+
+
+def test_failed_connect_is_not_retried_in_background(loop):
+    async def run():
+        async with FBNSTestBroker(connack_code=3) as broker:
+            client = FBNSMQTTClient(metrics=False, reconnect_policy=FAST_POLICY)
+            try:
+                with pytest.raises(MQTTConnectError):
+                    await asyncio.wait_for(client.connect('127.0.0.1', broker.port), TIMEOUT)
+                last_code = client._last_connack_code
+                await asyncio.sleep(0.2)
+                connects = broker.stats['connects']
+                # Caller retries, error of the failed attempt is not raised again
+                broker.connack_code = 0
+                await asyncio.wait_for(client.connect('127.0.0.1', broker.port), TIMEOUT)
+            finally:
+                await client.disconnect()
+            return client, last_code, connects
+
+    client, last_code, connects = loop.run_until_complete(run())
+    assert last_code == 3
+    assert connects == 1
+    assert client.stats['reconnects'] == 0
+    assert client.fbns_auth.userId
+
+
+def test_reconnect_after_connack_error(loop):
+    async def run():
+        async with FBNSTestBroker() as broker:
+            client = FBNSMQTTClient(metrics=False, reconnect_policy=FAST_POLICY)
+            try:
+                await asyncio.wait_for(client.connect('127.0.0.1', broker.port), TIMEOUT)
+                broker.connack_code = 3
+                for session in list(broker.sessions.values()):
+                    session.writer.close()
+                refused = await wait_until(lambda: broker.stats['connack_3'] >= 2)
+                broker.connack_code = 0
+                connected = await wait_until(lambda: broker.stats['connack_0'] == 2 and client.is_connected)
+            finally:
+                await client.disconnect()
+            return client, refused, connected
+
+    client, refused, connected = loop.run_until_complete(run())
+    assert refused and connected
+    assert client.stats['reconnects'] >= 3
+
+
+def test_reconnect_resets_connected_state_during_backoff(loop):
+    async def run():
+        async with FBNSTestBroker() as broker:
+            policy = ReconnectPolicy(base_delay=0.3, jitter=0)
+            client = FBNSMQTTClient(metrics=False, reconnect_policy=policy)
+            try:
+                await asyncio.wait_for(client.connect('127.0.0.1', broker.port), TIMEOUT)
+                client._server_topics_aliases[1] = 'topic'
+                for session in list(broker.sessions.values()):
+                    session.writer.close()
+                await asyncio.sleep(0.1)
+                waiting = client._connected.is_set(), dict(client._server_topics_aliases)
+                reconnected = await wait_until(lambda: client.is_connected)
+            finally:
+                await client.disconnect()
+            return waiting, reconnected
+
+    waiting, reconnected = loop.run_until_complete(run())
+    assert waiting == (False, {})
+    assert reconnected
+
+
+def test_pool_account_connects_after_connack_error(loop):
+    async def run():
+        async with FBNSTestBroker(connack_code=3) as broker:
+            pool = FBNSMQTTPool('127.0.0.1', broker.port, ssl=False, reconnect_policy=FAST_POLICY,
+                                client_kwargs={'metrics': False, 'lean': True, 'reconnect_policy': FAST_POLICY})
+            pool.add_account('a')
+            try:
+                await asyncio.wait_for(pool.connect(), TIMEOUT)
+                failed = pool.get_account('a').state
+                broker.connack_code = 0
+                connected = await wait_until(lambda: pool.get_account('a').state == STATE_CONNECTED)
+            finally:
+                await pool.disconnect()
+            return failed, connected
+
+    failed, connected = loop.run_until_complete(run())
+    assert failed == STATE_FAILED
+    assert connected
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+from fbns_mqtt.broker import FBNSTestBroker
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.reconnect import ReconnectPolicy
+from fbns_mqtt.registration import TokenRegistration
+
+
+def test_token_is_registered_once(loop):
+    calls = []
+
+    async def registrar(account_id, token):
+        calls.append((account_id, token))
+        await asyncio.sleep(0.02)
+
+    async def run():
+        registration = TokenRegistration(registrar, concurrency=2)
+        assert registration.submit('a', 't1')
+        assert not registration.submit('a', 't1')
+        await asyncio.sleep(0.005)
+        # Resubmitted while in flight
+        registration.submit('a', 't1')
+        await asyncio.sleep(0.1)
+        assert not registration.submit('a', 't1')
+        await registration.close()
+        return registration
+
+    registration = loop.run_until_complete(run())
+    assert calls == [('a', 't1')]
+    assert registration.stats['registered'] == 1
+
+
+def test_new_token_replaces_registered_one(loop):
+    calls = []
+
+    async def registrar(account_id, token):
+        calls.append(token)
+
+    async def run():
+        registration = TokenRegistration(registrar)
+        registration.submit('a', 't1')
+        await asyncio.sleep(0.01)
+        registration.submit('a', 't2')
+        await asyncio.sleep(0.01)
+        await registration.close()
+
+    loop.run_until_complete(run())
+    assert calls == ['t1', 't2']
+
+
+def test_worker_survives_failing_callbacks(loop, caplog):
+    calls = []
+    failed = []
+
+    async def registrar(account_id, token):
+        calls.append(token)
+        if token == 'bad':
+            raise OSError('API is down')
+
+    def on_registered(account_id, token):
+        if token == 't1':
+            raise RuntimeError('callback failed')
+
+    def on_failed(account_id, token, exc):
+        failed.append(token)
+        raise RuntimeError('callback failed')
+
+    async def run():
+        registration = TokenRegistration(registrar, concurrency=1, retry_policy=ReconnectPolicy(max_attempts=0))
+        registration.on_registered = on_registered
+        registration.on_failed = on_failed
+        for account_id, token in (('a', 't1'), ('b', 'bad'), ('c', 't2')):
+            registration.submit(account_id, token)
+        await asyncio.wait_for(registration.join(), 5)
+        await registration.close()
+        return registration
+
+    registration = loop.run_until_complete(run())
+    assert calls == ['t1', 'bad', 't2']
+    assert failed == ['bad']
+    assert registration.is_registered('c', 't2')
+    assert registration.stats['registered'] == 2
+
+
+def test_register_error_from_broker_is_reported(loop, caplog):
+    caplog.set_level(logging.ERROR)
+    tokens = []
+
+    async def run():
+        async with FBNSTestBroker(register_error='x') as broker:
+            client = FBNSMQTTClient(metrics=False, lean=True)
+            client.on_fbns_token = tokens.append
+            await asyncio.wait_for(client.connect('127.0.0.1', broker.port), 5)
+            for _ in range(100):
+                if any(record.exc_info for record in caplog.records):
+                    break
+                await asyncio.sleep(0.01)
+            await client.disconnect()
+
+    loop.run_until_complete(run())
+    errors = [record.exc_info[1] for record in caplog.records if record.exc_info]
+    assert [str(exc) for exc in errors] == ['FBNS Register error message: x']
+    assert tokens == []
@@ -0,0 +1,37 @@
+import logging
+import tracemalloc
+
+from benchmarks.bench_session_memory import connect_sessions
+from fbns_mqtt.fbns_mqtt import LEAN_SESSION_BYTES
+from fbns_mqtt.pool import FBNSMQTTPool, STATE_CONNECTED
+
+SESSIONS = 200
+WARMUP_SESSIONS = 20
+
+
+def test_lean_session_heap_is_under_budget(loop, start_broker, caplog):
+    # Broker runs in another process so its memory is not traced
+    broker_port = start_broker()
+    caplog.set_level(logging.ERROR)
+    pool = FBNSMQTTPool('127.0.0.1', broker_port, ssl=False, max_concurrent_connects=100,
+                        client_kwargs={'metrics': False, 'lean': True})
+
+    async def measure():
+        # Warm up sessions load the thrift schema and fill interpreter caches
+        await connect_sessions(pool, 0, WARMUP_SESSIONS)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            await connect_sessions(pool, WARMUP_SESSIONS, SESSIONS)
+            return tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+
+    try:
+        heap = loop.run_until_complete(measure())
+        connected = pool.count_by_state().get(STATE_CONNECTED, 0)
+    finally:
+        loop.run_until_complete(pool.disconnect())
+
+    assert connected == WARMUP_SESSIONS + SESSIONS
+    assert heap / SESSIONS <= LEAN_SESSION_BYTES
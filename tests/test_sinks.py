@@ -0,0 +1,104 @@
+import asyncio
+import io
+import json
+import os
+
+from fbns_mqtt.sinks import NDJSONFileSink, StdoutSink, UnixSocketSink
+
+
+def serializer(push, account_id):
+    return {'account_id': account_id, 'n': push}
+
+
+def read_lines(data):
+    return [json.loads(line) for line in data.splitlines()]
+
+
+def test_stdout_sink_writes_batches(loop):
+    stream = io.BytesIO()
+
+    async def run():
+        async with StdoutSink(stream, batch_size=3, flush_interval=60, serializer=serializer) as sink:
+            sink.write(0, 'a')
+            sink.write(1, 'a')
+            await asyncio.sleep(0.05)
+            # Less than batch_size waits for flush_interval
+            waiting = sink.written
+            sink.write(2, 'a')
+            await asyncio.sleep(0.05)
+            written = sink.written
+            sink.write(3, 'b')
+        return sink, waiting, written
+
+    sink, waiting, written = loop.run_until_complete(run())
+    assert (waiting, written) == (0, 3)
+    lines = read_lines(stream.getvalue())
+    assert [(line['account_id'], line['n']) for line in lines] == [('a', 0), ('a', 1), ('a', 2), ('b', 3)]
+    assert sink.written == 4 and sink.batches == 2 and sink.dropped == 0
+
+
+def test_file_sink_rotates(loop, tmp_path):
+    path = os.path.join(str(tmp_path), 'pushes.ndjson')
+
+    async def run():
+        async with NDJSONFileSink(path, max_bytes=100, backup_count=2, batch_size=1,
+                                  serializer=serializer) as sink:
+            for n in range(20):
+                sink.write(n)
+                await sink.flush()
+        return sink
+
+    sink = loop.run_until_complete(run())
+    assert sink.rotations > 2
+    assert sorted(os.listdir(str(tmp_path))) == ['pushes.ndjson', 'pushes.ndjson.1', 'pushes.ndjson.2']
+    numbers = []
+    for name in ('pushes.ndjson.2', 'pushes.ndjson.1', 'pushes.ndjson'):
+        with open(os.path.join(str(tmp_path), name), 'rb') as f:
+            numbers += [line['n'] for line in read_lines(f.read())]
+    assert numbers == list(range(20 - len(numbers), 20))
+
+
+def test_unix_socket_sink_resends_only_unsent_lines(loop, tmp_path):
+    path = os.path.join(str(tmp_path), 'pushes.sock')
+    received = []
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        if len(connections) == 1:
+            # First connection breaks in the middle of a line
+            data = await reader.readexactly(1000)
+        else:
+            data = await reader.read()
+        received.append(data)
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_unix_server(handle, path)
+        try:
+            sink = UnixSocketSink(path, batch_size=20000, flush_interval=0.01, max_buffer=20000,
+                                  serializer=serializer)
+            for n in range(20000):
+                sink.write(n)
+            while sink.connects < 2 or len(sink):
+                await asyncio.sleep(0.01)
+            await sink.close()
+            while len(received) < 2:
+                await asyncio.sleep(0.01)
+            return sink
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    sink = loop.run_until_complete(asyncio.wait_for(run(), 10))
+    first, second = received
+    assert not first.endswith(b'\n')
+    # Unterminated last line of the first connection is dropped by the reader
+    first_numbers = [line['n'] for line in read_lines(first.rsplit(b'\n', 1)[0])]
+    second_numbers = [line['n'] for line in read_lines(second)]
+    assert first_numbers == list(range(len(first_numbers)))
+    # No line is received twice, lines still in socket buffers of the broken connection are lost
+    assert second_numbers == list(range(second_numbers[0], 20000))
+    assert second_numbers[0] >= len(first_numbers)
+    assert sink.errors == 1 and sink.connects == 2
+    assert sink.written == 20000
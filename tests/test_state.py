@@ -0,0 +1,178 @@
+import asyncio
+import os
+
+import pytest
+
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.pool import FBNSMQTTPool
+from fbns_mqtt.state import SQLiteStateStore, StateStore, StateStoreError
+from fbns_mqtt.supervisor import FBNSSupervisor
+
+
+class MemoryStateStore(StateStore):
+    # Records written batches, fails the next `fail` batches
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches_written = []
+        self.fail = 0
+
+    def _write_batch(self, changes):
+        if self.fail:
+            self.fail -= 1
+            raise OSError('disk is full')
+        self.batches_written.append(changes)
+
+
+def test_changes_of_one_account_are_coalesced(loop):
+    store = MemoryStateStore(flush_interval=60)
+    store.save_auth('a', {'ck': 1, 'cs': 'p', 'di': 'd', 'ds': 's'})
+    store.save_token('a', 't1')
+    store.save_token('a', 't2')
+    store.save_token('b', 'b1')
+    loop.run_until_complete(store.flush())
+
+    assert len(store.batches_written) == 1
+    changes = store.batches_written[0]
+    assert set(changes) == {'a', 'b'}
+    assert changes['a']['token'] == 't2'
+    assert changes['a']['auth']['ck'] == 1
+    assert store.writes == 2
+    assert store.batches == 1
+
+
+def test_batch_is_written_after_flush_interval(loop):
+    store = MemoryStateStore(flush_interval=0.01)
+    store.save_token('a', 't')
+    assert not store.batches_written
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert len(store.batches_written) == 1
+
+
+def test_batch_is_written_at_batch_size(loop):
+    store = MemoryStateStore(flush_interval=60, batch_size=3)
+    for account_id in range(3):
+        store.save_token(account_id, 't')
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert len(store.batches_written) == 1
+
+
+def test_delete_then_save_clears_fields(loop):
+    store = MemoryStateStore(flush_interval=60)
+    store.delete('a')
+    store.save_token('a', 't')
+    loop.run_until_complete(store.flush())
+    changes = store.batches_written[0]['a']
+    assert changes['token'] == 't'
+    assert changes['auth'] is None
+
+
+def test_failed_batch_is_retried(loop):
+    store = MemoryStateStore(flush_interval=0.01)
+    store.fail = 1
+    store.save_token('a', 't1')
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert store.errors == 1
+    assert len(store.batches_written) == 1
+    assert store.batches_written[0]['a']['token'] == 't1'
+
+
+def test_flush_raises_on_failure(loop):
+    store = MemoryStateStore(flush_interval=60)
+    store.fail = 1
+    store.save_token('a', 't')
+    with pytest.raises(StateStoreError):
+        loop.run_until_complete(store.flush())
+    # Change is kept and written by the next flush
+    loop.run_until_complete(store.flush())
+    assert store.batches_written[0]['a']['token'] == 't'
+
+
+def test_newer_changes_win_over_restored_ones(loop):
+    store = MemoryStateStore(flush_interval=60)
+    store.save_token('a', 'old')
+    store.save_auth('a', {'ck': 1})
+    changes = store._pending
+    store._pending = {}
+    store.save_token('a', 'new')
+    store._restore(changes)
+    assert store._pending['a']['token'] == 'new'
+    assert store._pending['a']['auth']['ck'] == 1
+
+
+def test_restored_delete_is_kept_under_newer_save(loop):
+    store = MemoryStateStore(flush_interval=60)
+    store.delete('a')
+    changes = store._pending
+    store._pending = {}
+    store.save_token('a', 'new')
+    store._restore(changes)
+    fields = store._pending['a']
+    assert fields['token'] == 'new'
+    assert fields['auth'] is None and fields['registered_token'] is None
+
+
+def test_newer_delete_wins_over_restored_save(loop):
+    store = MemoryStateStore(flush_interval=60)
+    store.save_token('a', 'old')
+    changes = store._pending
+    store._pending = {}
+    store.delete('a')
+    store._restore(changes)
+    assert store._pending['a'] is None
+
+
+def test_sqlite_store_round_trip(loop, tmp_path):
+    path = os.path.join(str(tmp_path), 'state.sqlite')
+
+    async def run():
+        store = SQLiteStateStore(path, flush_interval=60)
+        store.save_auth('a', {'ck': 1, 'cs': 'p'})
+        store.save_token('a', 't')
+        store.save_registration('a', 't', registered_at=5.0)
+        store.save_token(2, 'int-id')
+        store.save_token('gone', 'x')
+        await store.flush()
+        store.delete('gone')
+        await store.close()
+        with pytest.raises(StateStoreError):
+            store.save_token('a', 'closed')
+
+        store = SQLiteStateStore(path)
+        try:
+            return await store.load_all(), await store.load('a')
+        finally:
+            await store.close()
+
+    states, state = loop.run_until_complete(run())
+    assert set(states) == {'a', 2}
+    assert state.auth == {'ck': 1, 'cs': 'p'}
+    assert (state.token, state.registered_token, state.registered_at) == ('t', 't', 5.0)
+
+
+def test_client_load_state(loop, tmp_path):
+    path = os.path.join(str(tmp_path), 'state.sqlite')
+
+    async def run():
+        store = SQLiteStateStore(path)
+        store.save_auth('a', {'ck': 1, 'cs': 'p', 'di': 'd', 'ds': 's'})
+        await store.flush()
+        try:
+            client = FBNSMQTTClient(metrics=False, state_store=store, account_id='a')
+            state = await client.load_state()
+            missing = await FBNSMQTTClient(metrics=False, state_store=store, account_id='b').load_state()
+        finally:
+            await store.close()
+        with pytest.raises(ValueError):
+            await FBNSMQTTClient(metrics=False).load_state()
+        return client, state, missing
+
+    client, state, missing = loop.run_until_complete(run())
+    assert state.auth['ck'] == 1
+    assert client.fbns_auth.userId == 1 and client.fbns_auth.password == 'p'
+    assert missing is None
+
+
+@pytest.mark.parametrize('owner', [FBNSMQTTPool, FBNSSupervisor])
+def test_load_accounts_requires_state_store(loop, owner):
+    with pytest.raises(ValueError):
+        loop.run_until_complete(owner('127.0.0.1', 1).load_accounts())
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import os
+import signal
+
+import pytest
+
+from fbns_mqtt.broker import FBNSTestBroker
+from fbns_mqtt.pool import STATE_CONNECTED
+from fbns_mqtt.reconnect import ReconnectPolicy
+from fbns_mqtt.supervisor import FBNSSupervisor
+
+TIMEOUT = 20
+ACCOUNTS = ['a', 'b', 'c', 'd']
+
+
+@pytest.fixture(autouse=True)
+def quiet_logs(caplog):
+    caplog.set_level(logging.CRITICAL)
+
+
+async def wait_until(predicate):
+    for _ in range(int(TIMEOUT / 0.05)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+def all_connected(supervisor):
+    return supervisor.count_by_state() == {STATE_CONNECTED: len(ACCOUNTS)}
+
+
+def test_accounts_are_sharded_and_pushes_merged(loop):
+    async def run():
+        async with FBNSTestBroker(push_rate=200) as broker:
+            supervisor = FBNSSupervisor('127.0.0.1', broker.port, ssl=False, workers=2, batch_interval=0.01,
+                                        start_method='fork', metrics_interval=0.1,
+                                        pool_kwargs={'client_kwargs': {'lean': True}})
+            pushes = supervisor.pushes()
+            tokens = {}
+            supervisor.on_fbns_token = tokens.__setitem__
+            for account_id in ACCOUNTS:
+                supervisor.add_account(account_id)
+            async with supervisor:
+                connected = await wait_until(lambda: all_connected(supervisor) and len(tokens) == len(ACCOUNTS))
+                account_id, push = await asyncio.wait_for(pushes.get(), TIMEOUT)
+                got_metrics = await wait_until(lambda: all(shard.metrics for shard in supervisor.shards))
+                registry = supervisor.metrics_registry()
+                shard_accounts = [set(shard.accounts) for shard in supervisor.shards]
+            return connected, account_id, push, got_metrics, registry, shard_accounts, tokens, broker
+
+    connected, account_id, push, got_metrics, registry, shard_accounts, tokens, broker = \
+        loop.run_until_complete(run())
+    assert connected
+    assert account_id in ACCOUNTS and push.notification is not None
+    assert [len(accounts) for accounts in shard_accounts] == [2, 2]
+    assert set(tokens.values()) == set(broker.tokens.values())
+    assert got_metrics
+    # Connects of both workers are summed
+    assert registry.get('fbns_connects_total').get() >= len(ACCOUNTS)
+
+
+def test_crashed_worker_is_restarted_with_its_accounts(loop):
+    async def run():
+        async with FBNSTestBroker() as broker:
+            supervisor = FBNSSupervisor('127.0.0.1', broker.port, ssl=False, workers=2, batch_interval=0.01,
+                                        start_method='fork', restart_policy=ReconnectPolicy(base_delay=0.01),
+                                        pool_kwargs={'client_kwargs': {'lean': True, 'metrics': False}})
+            for account_id in ACCOUNTS:
+                supervisor.add_account(account_id)
+            async with supervisor:
+                assert await wait_until(lambda: all_connected(supervisor))
+                shard = supervisor.shards[0]
+                accounts = set(shard.accounts)
+                pid = shard.process.pid
+                os.kill(pid, signal.SIGKILL)
+                restarted = await wait_until(lambda: shard.alive and shard.process.pid != pid and
+                                             supervisor.stats['workers_started'] == 3)
+                new_devices = broker.stats['new_devices']
+                reconnected = await wait_until(lambda: broker.stats['connects'] >= len(ACCOUNTS) + len(accounts))
+                return restarted, reconnected, accounts, set(shard.accounts), new_devices, broker, supervisor
+
+    restarted, reconnected, accounts, restarted_accounts, new_devices, broker, supervisor = \
+        loop.run_until_complete(run())
+    assert restarted and reconnected
+    assert restarted_accounts == accounts
+    assert supervisor.stats['restarts'] == 1
+    # Restarted worker connects with credentials received before the crash
+    assert new_devices == len(ACCOUNTS) and broker.stats['new_devices'] == len(ACCOUNTS)
@@ -0,0 +1,27 @@
+import json
+import subprocess
+import sys
+
+CHECK_CODE = '''
+import json
+import sys
+
+from fbns_mqtt import fbns_mqtt
+
+result = {'imported': fbns_mqtt._thrift is not None, 'thriftpy': 'thriftpy' in sys.modules,
+          'dateutil': 'dateutil' in sys.modules}
+auth = fbns_mqtt.FBNSAuth({'ck': 1, 'cs': 'p', 'di': 'd', 'ds': 's'})
+package = fbns_mqtt.FBNSConnectPackageFactor.build_package(auth, True, 900, fbns_mqtt.FBNSMQTTProtocol)
+result['first_use'] = fbns_mqtt._thrift is not None
+result['schema'] = fbns_mqtt.thrift is fbns_mqtt.get_thrift()
+result['user_id'] = fbns_mqtt.deserialize_connect(fbns_mqtt.serialize_connect(auth, 5)).clientInfo.userId
+print(json.dumps(result))
+'''
+
+
+def test_schema_loads_on_first_use_from_other_directory(tmp_path):
+    # Fresh interpreter, this one has the schema loaded by other tests
+    out = subprocess.check_output([sys.executable, '-c', CHECK_CODE], cwd=str(tmp_path))
+    result = json.loads(out.decode())
+    assert result == {'imported': False, 'thriftpy': False, 'dateutil': False,
+                      'first_use': True, 'schema': True, 'user_id': 1}
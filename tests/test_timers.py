@@ -0,0 +1,170 @@
+import asyncio
+import gc
+import logging
+import time
+import weakref
+
+import pytest
+
+from fbns_mqtt import fbns_mqtt, timers
+from fbns_mqtt.broker import FBNSTestBroker
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.reconnect import ReconnectPolicy
+from fbns_mqtt.timers import TimerWheel
+
+RESOLUTION = 0.01
+TIMEOUT = 10
+
+
+def test_callbacks_run_in_order_of_delay(loop):
+    wheel = TimerWheel(resolution=RESOLUTION, slots=8, loop=loop)
+    fired = []
+    started = loop.time()
+    for name, delay in (('c', 0.15), ('a', 0.03), ('b', 0.05)):
+        wheel.schedule(delay, lambda name: fired.append((name, loop.time() - started)), name)
+    assert len(wheel) == 3
+
+    loop.run_until_complete(asyncio.sleep(0.25))
+    assert [name for name, _ in fired] == ['a', 'b', 'c']
+    # Up to one resolution early, later only by loop scheduling
+    for (name, elapsed), delay in zip(fired, (0.03, 0.05, 0.15)):
+        assert delay - RESOLUTION - 0.001 <= elapsed < delay + 0.1
+    assert len(wheel) == 0
+    # Wheel stops ticking without entries
+    assert wheel._handle is None
+
+
+def test_delay_longer_than_one_revolution(loop):
+    # 8 slots of 10 ms, 0.2 s needs more than two rounds
+    wheel = TimerWheel(resolution=RESOLUTION, slots=8, loop=loop)
+    fired = []
+    wheel.schedule(0.2, fired.append, 'late')
+    wheel.schedule(0.02, fired.append, 'early')
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert fired == ['early']
+    loop.run_until_complete(asyncio.sleep(0.15))
+    assert fired == ['early', 'late']
+
+
+def test_cancel(loop):
+    wheel = TimerWheel(resolution=RESOLUTION, slots=8, loop=loop)
+    fired = []
+    entry = wheel.schedule(0.03, fired.append, 'cancelled')
+    wheel.schedule(0.04, fired.append, 'kept')
+    assert not entry.cancelled()
+    entry.cancel()
+    entry.cancel()
+    assert entry.cancelled()
+    assert len(wheel) == 1
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert fired == ['kept']
+
+
+def test_failing_callback_does_not_stop_others(loop):
+    wheel = TimerWheel(resolution=RESOLUTION, slots=8, loop=loop)
+    fired = []
+    wheel.schedule(0.02, lambda: 1 / 0)
+    wheel.schedule(0.02, fired.append, 'ok')
+    loop.run_until_complete(asyncio.sleep(0.06))
+    assert fired == ['ok']
+
+
+def test_missed_ticks_are_caught_up(loop):
+    wheel = TimerWheel(resolution=RESOLUTION, slots=8, loop=loop)
+    fired = []
+    wheel.schedule(0.02, fired.append, 'a')
+    wheel.schedule(0.05, fired.append, 'b')
+    # Loop blocked past both entries
+    loop.call_soon(time.sleep, 0.08)
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert fired == ['a', 'b']
+
+
+def test_close_drops_entries(loop):
+    wheel = TimerWheel(resolution=RESOLUTION, slots=8, loop=loop)
+    entry = wheel.schedule(0.02, lambda: None)
+    wheel.close()
+    assert entry.cancelled()
+    assert len(wheel) == 0
+    assert wheel._handle is None
+
+
+def test_keepalive_wheel_is_shared_per_loop_and_released_with_it():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        wheel = timers.get_keepalive_wheel()
+        assert timers.get_keepalive_wheel() is wheel
+        wheel.schedule(100, lambda: None)
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+    loop_ref = weakref.ref(loop)
+    del loop, wheel
+
+    other = asyncio.new_event_loop()
+    asyncio.set_event_loop(other)
+    try:
+        assert timers.get_keepalive_wheel() is not None
+        gc.collect()
+        assert loop_ref() is None
+    finally:
+        other.close()
+        asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def fast_keepalive_wheel(loop):
+    # Keepalive checks of connections on this loop run within 10 ms of being due instead of 1 s
+    wheel = timers._wheels[loop] = TimerWheel(resolution=RESOLUTION, slots=256, loop=loop)
+    yield wheel
+    wheel.close()
+
+
+async def wait_until(predicate):
+    for _ in range(int(TIMEOUT / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return False
+
+
+def test_pingreq_is_sent_every_keepalive(loop, fast_keepalive_wheel):
+    async def run():
+        async with FBNSTestBroker() as broker:
+            client = FBNSMQTTClient(metrics=False, lean=True)
+            await asyncio.wait_for(client.connect('127.0.0.1', broker.port, keepalive=1), TIMEOUT)
+            session, = broker.sessions.values()
+            keepalive = session.keepalive
+            await asyncio.sleep(2.5)
+            await client.disconnect()
+            return keepalive, broker.stats['pingreq'], client.ping_rtt
+
+    keepalive, pingreq, ping_rtt = loop.run_until_complete(run())
+    assert keepalive == 1
+    assert pingreq >= 2
+    assert ping_rtt is not None
+
+
+def test_missing_pingresp_closes_connection_and_reconnects(loop, fast_keepalive_wheel, monkeypatch, caplog):
+    caplog.set_level(logging.CRITICAL)
+    monkeypatch.setattr(fbns_mqtt, 'MIN_PING_TIMEOUT', 0.2)
+
+    async def run():
+        async with FBNSTestBroker(pingresp=False) as broker:
+            policy = ReconnectPolicy(base_delay=0.01, max_delay=0.05, jitter=0)
+            client = FBNSMQTTClient(metrics=False, lean=True, reconnect_policy=policy)
+            await asyncio.wait_for(client.connect('127.0.0.1', broker.port, keepalive=1), TIMEOUT)
+            connection = client._connection
+            try:
+                # PINGRESP is waited for keepalive / 2 at most
+                timeout = connection.ping_timeout
+                reconnected = await wait_until(lambda: broker.stats['connects'] == 2 and client.is_connected)
+            finally:
+                await client.disconnect()
+            return broker, reconnected, timeout, client._connection is connection
+
+    broker, reconnected, timeout, same_connection = loop.run_until_complete(run())
+    assert timeout == 0.5
+    assert reconnected and not same_connection
+    assert broker.stats['pingreq'] >= 1
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import shutil
+import ssl
+
+import pytest
+
+from benchmarks.bench_tls_handshake import HOST, generate_certificate
+from fbns_mqtt.broker import FBNSTestBroker
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient
+from fbns_mqtt.metrics import FBNSMetrics, MetricsRegistry
+from fbns_mqtt.tls import create_ssl_context, get_default_ssl_context
+
+pytestmark = pytest.mark.skipif(shutil.which('openssl') is None, reason='openssl command is required')
+
+TIMEOUT = 10
+
+
+@pytest.fixture(autouse=True)
+def quiet_logs(caplog):
+    caplog.set_level(logging.CRITICAL)
+
+
+@pytest.fixture
+def certificate(tmp_path):
+    return generate_certificate(str(tmp_path))
+
+
+@pytest.mark.parametrize('max_version', [ssl.TLSVersion.TLSv1_2, ssl.TLSVersion.TLSv1_3])
+def test_connections_resume_tls_session(loop, certificate, max_version):
+    certfile, keyfile = certificate
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(certfile, keyfile)
+    server_context.maximum_version = max_version
+    registry = MetricsRegistry()
+    context = create_ssl_context(cafile=certfile, metrics=FBNSMetrics(registry))
+
+    async def run():
+        async with FBNSTestBroker(HOST, ssl=server_context) as broker:
+            for _ in range(3):
+                client = FBNSMQTTClient(lean=True, metrics=False)
+                await asyncio.wait_for(client.connect(HOST, broker.port, ssl=context), TIMEOUT)
+                await client.disconnect()
+            return broker
+
+    broker = loop.run_until_complete(run())
+    assert broker.stats['connects'] == 3
+    assert context.stats['handshakes'] == 3
+    assert context.stats['full'] == 1 and context.stats['resumed'] == 2
+    handshakes = registry.get('fbns_tls_handshake_seconds')
+    assert handshakes.count(('0',)) == 1 and handshakes.count(('1',)) == 2
+
+
+def test_untrusted_certificate_is_rejected(loop, certificate):
+    certfile, keyfile = certificate
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(certfile, keyfile)
+    # System CA certificates don't include the self-signed one
+    context = create_ssl_context(metrics=False)
+
+    async def run():
+        async with FBNSTestBroker(HOST, ssl=server_context) as broker:
+            client = FBNSMQTTClient(lean=True, metrics=False)
+            with pytest.raises(ssl.SSLCertVerificationError):
+                await asyncio.wait_for(client.connect(HOST, broker.port, ssl=context), TIMEOUT)
+
+    loop.run_until_complete(run())
+    assert context.stats['handshakes'] == 0
+
+
+class FakeSession(object):
+    def __init__(self, time, timeout):
+        self.time = time
+        self.timeout = timeout
+
+
+def test_expired_session_is_not_offered():
+    context = create_ssl_context(metrics=False)
+    context._sessions['fresh'] = fresh = FakeSession(2 ** 40, 300)
+    context._sessions['old'] = FakeSession(0, 300)
+    assert context.get_session('fresh') is fresh
+    assert context.get_session('old') is None
+    assert 'old' not in context._sessions
+    assert context.stats['sessions_expired'] == 1
+
+
+def test_default_context_is_shared():
+    assert get_default_ssl_context() is get_default_ssl_context()
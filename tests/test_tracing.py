@@ -0,0 +1,78 @@
+import asyncio
+import json
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from fbns_mqtt.broker import make_push
+from fbns_mqtt.fbns_mqtt import FBNSMQTTClient, FBNSPush
+from fbns_mqtt.tracing import Tracer
+
+PAYLOAD = zlib.compress(json.dumps(make_push(64, collapse_key='comment')).encode())
+
+
+def test_sampled_message_is_timed_by_stage(loop, receive):
+    asyncio.set_event_loop(loop)
+    tracer = Tracer(sample_rate=1)
+    traces = []
+    tracer.on_trace = traces.append
+    client = FBNSMQTTClient(metrics=False, tracer=tracer, account_id='a')
+
+    def handler(push):
+        with client.current_trace.span('handler'):
+            pass
+
+    client.on_fbns_message = handler
+    receive(client, [PAYLOAD])
+
+    trace, = traces
+    assert [name for name, _ in trace.spans] == ['decompress', 'decode', 'handler', 'dispatch']
+    assert trace.attributes['result'] == 'delivered'
+    assert trace.attributes['account_id'] == 'a' and trace.attributes['size'] == len(PAYLOAD)
+    assert trace.duration >= sum(duration for name, duration in trace.spans if name != 'handler')
+    assert list(tracer.recent) == [trace]
+    assert trace.to_dict()['spans'][0]['name'] == 'decompress'
+    assert client.current_trace is None
+
+
+def test_executor_decoded_message_has_executor_span(loop, receive):
+    asyncio.set_event_loop(loop)
+    tracer = Tracer(sample_rate=1)
+    client = FBNSMQTTClient(metrics=False, tracer=tracer, decode_executor=ThreadPoolExecutor(1),
+                            decode_threshold=0)
+    client.set_push_filter(collapse_keys={'like'})
+    receive(client, [PAYLOAD])
+
+    trace, = tracer.recent
+    assert [name for name, _ in trace.spans] == ['executor', 'decompress', 'decode', 'dispatch']
+    assert trace.attributes['result'] == 'dropped'
+
+
+def test_messages_not_sampled_are_not_traced(loop, receive):
+    asyncio.set_event_loop(loop)
+    tracer = Tracer(sample_rate=0)
+    pushes = []
+    client = FBNSMQTTClient(metrics=False, tracer=tracer)
+    client.on_fbns_message = pushes.append
+    receive(client, [PAYLOAD])
+
+    assert len(pushes) == 1
+    assert tracer.sampled == 0 and not tracer.recent
+    with pytest.raises(ValueError):
+        Tracer(sample_rate=2)
+
+
+def test_debug_messages_are_not_formatted_when_debug_is_off(loop, receive, monkeypatch, caplog):
+    asyncio.set_event_loop(loop)
+    caplog.set_level(logging.INFO)
+    formatted = []
+    monkeypatch.setattr(FBNSPush, '__repr__', lambda push: formatted.append(push) or '<FBNSPush>')
+    client = FBNSMQTTClient(metrics=False)
+    receive(client, [PAYLOAD])
+    assert formatted == []
+
+    caplog.set_level(logging.DEBUG)
+    receive(client, [PAYLOAD])
+    assert formatted